@@ -0,0 +1,339 @@
+#!/opt/local/bin/python
+# Copyright 2016 University of Southampton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+import pygit2
+from metagit import *
+
+
+# Generates synthetic repositories and times the metagit operations against them.
+#
+# Command line syntax:
+#   benchmark.py [--commits N,...] [--files N,...] [--branches N,...]
+#                [--shape linear|branched|merged] [--density D,...] [--output FILE]
+#
+# Examples:
+#   benchmark.py --commits 10,100,1000 --files 100
+#   benchmark.py --commits 500 --shape merged --branches 4 --output bench_output.txt
+
+class SyntheticRepositoryConfig:
+	shape_linear = "linear"      # A single line of commits
+	shape_branched = "branched"  # Side branches that are never merged
+	shape_merged = "merged"      # Side branches merged back into master
+	shapes = [shape_linear, shape_branched, shape_merged]
+
+	def __init__(self, commits, files, branches=0, shape=shape_linear, density=0.1, changes=1, filesperdir=50, seed=0):
+		self.commits = commits          # Length of the master branch
+		self.files = files              # Number of files in each commit
+		self.branches = branches        # Number of side branches
+		self.shape = shape              # How side branches relate to master
+		self.density = density          # Fraction of file versions with metadata
+		self.changes = changes          # Files modified in each commit
+		self.filesperdir = filesperdir  # Files in each directory
+		self.seed = seed
+
+	def as_dict(self):
+		return {
+			"commits": self.commits,
+			"files": self.files,
+			"branches": self.branches,
+			"shape": self.shape,
+			"density": self.density,
+			"changes": self.changes}
+
+
+class SyntheticRepository:
+
+	# Builds the repository described by config in a new directory under basedir
+	def __init__(self, config, basedir=None):
+		self.config = config
+		self.random = random.Random(config.seed)
+		self.workdir = tempfile.mkdtemp(prefix="metagit-bench-", dir=basedir)
+		self.repo = pygit2.init_repository(self.workdir)
+		self.committime = 1400000000
+
+		self.paths = [self.file_path(i) for i in range(config.files)]
+		self.blobs = {}
+		self.versions = {}
+		self.versionsseen = []  # (path, commit id) for each new file version
+
+		self.build()
+
+	def file_path(self, filenumber):
+		return os.path.join("dir%04d" % (filenumber // self.config.filesperdir), "file%06d.txt" % filenumber)
+
+	def new_version(self, path):
+		self.versions[path] = self.versions.get(path, 0) + 1
+		self.blobs[path] = self.repo.create_blob("%s version %d\n" % (path, self.versions[path]))
+
+	def write_tree(self):
+		dirs = {}
+		for path in self.paths:
+			dirname, filename = os.path.split(path)
+			dirs.setdefault(dirname, []).append((filename, self.blobs[path]))
+
+		toptreebuilder = self.repo.TreeBuilder()
+		for dirname, entries in sorted(dirs.items()):
+			treebuilder = self.repo.TreeBuilder()
+			for filename, blobid in entries:
+				treebuilder.insert(filename, blobid, pygit2.GIT_FILEMODE_BLOB)
+			toptreebuilder.insert(dirname, treebuilder.write(), pygit2.GIT_FILEMODE_TREE)
+
+		return toptreebuilder.write()
+
+	def commit(self, refname, parents, changedpaths):
+		self.committime += 60
+		signature = pygit2.Signature('Benchmark', 'benchmark@example.com', self.committime, 0)
+		commitid = self.repo.create_commit(refname, signature, signature, "Synthetic commit", self.write_tree(), parents)
+		for path in changedpaths:
+			self.versionsseen.append((path, commitid))
+		return commitid
+
+	def modify(self, count):
+		changedpaths = self.random.sample(self.paths, min(count, len(self.paths)))
+		for path in changedpaths:
+			self.new_version(path)
+		return changedpaths
+
+	def build(self):
+		config = self.config
+
+		for path in self.paths:
+			self.new_version(path)
+		tip = self.commit("refs/heads/master", [], self.paths)
+
+		# Spread the branch points evenly along master
+		branchpoints = set()
+		if config.shape != SyntheticRepositoryConfig.shape_linear and config.branches > 0:
+			step = max(1, config.commits // (config.branches + 1))
+			branchpoints = set(step * (i + 1) for i in range(config.branches))
+
+		branchnumber = 0
+		for commitnumber in range(1, config.commits):
+			tip = self.commit("refs/heads/master", [tip], self.modify(config.changes))
+
+			if commitnumber in branchpoints:
+				savedblobs = dict(self.blobs)
+				branchtip = self.build_branch("refs/heads/branch%d" % branchnumber, tip)
+				branchnumber += 1
+
+				if config.shape == SyntheticRepositoryConfig.shape_merged:
+					# Merging brings in the files modified on the branch
+					mergedpaths = [path for path in self.paths if self.blobs[path] != savedblobs[path]]
+					tip = self.commit("refs/heads/master", [tip, branchtip], mergedpaths)
+				else:
+					self.blobs = savedblobs
+
+		self.repo.set_head("refs/heads/master")
+		self.head = tip
+
+	def build_branch(self, refname, startcommit):
+		tip = startcommit
+		for i in range(3):
+			tip = self.commit(refname, [tip], self.modify(self.config.changes))
+		return tip
+
+	# Attach metadata to a fraction of the file versions in a single metadata commit
+	def add_metadata(self, repo):
+		sample = [entry for entry in self.versionsseen if self.random.random() < self.config.density]
+
+		entries = {}
+		for path, commitid in sample:
+			blobid = repo.create_blob(json.dumps({"path": path, "commit": commitid.__str__()}))
+			entries[repo.get_metadata_blob_path(path, MetadataPath.stream_default, commitid.__str__())] = blobid
+
+		if len(entries) > 0:
+			repo.commit_metadata_tree(repo.write_tree_entries(None, entries), "Synthetic metadata")
+
+		return len(entries)
+
+	def remove(self):
+		shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Benchmark:
+	operations = ["get", "set", "copy", "list", "log", "ls"]
+
+	def __init__(self, syntheticrepo, samples=10, repeat=3):
+		self.syntheticrepo = syntheticrepo
+		self.samples = samples
+		self.repeat = repeat
+		self.random = random.Random(syntheticrepo.config.seed + 1)
+
+	def open_repository(self):
+		return MetadataRepository(self.syntheticrepo.workdir)
+
+	def path_request(self, path, datarev="HEAD", search="s+"):
+		return "%s%s:%s" % (search, datarev, os.path.join(self.syntheticrepo.workdir, path))
+
+	def sample_paths(self):
+		return [self.random.choice(self.syntheticrepo.paths) for i in range(self.samples)]
+
+	# Each operation takes a repository and a path and returns True for a hit
+	def op_get(self, repo, path):
+		try:
+			repo.find_metadata_blob(self.path_request(path))
+			return True
+		except MetadataBlobNotFoundError:
+			return False
+
+	def op_set(self, repo, path):
+		repo.save_metadata_blob(self.path_request(path), json.dumps({"benchmark": path}))
+		return True
+
+	def op_copy(self, repo, path):
+		destpath = self.random.choice(self.syntheticrepo.paths)
+		try:
+			repo.copy_metadata(self.path_request(path), self.path_request(destpath, search="s-"), force=True)
+			return True
+		except MetadataBlobNotFoundError:
+			return False
+
+	def op_list(self, repo, path):
+		try:
+			repo.list_metadata_in_stream(self.path_request(path, search=""))
+			return True
+		except MetadataBlobNotFoundError:
+			return False
+
+	def op_log(self, repo, path):
+		repo.log(self.path_request(path, search=""))
+		return True
+
+	def op_ls(self, repo, path):
+		repo.list_metadata_objects()
+		return True
+
+	def time_operation(self, operation):
+		function = getattr(self, "op_" + operation)
+		paths = [None] if operation == "ls" else self.sample_paths()
+
+		timings = []
+		hits = 0
+		errors = {}
+		counts = {}
+
+		repo = self.open_repository()
+		for i in range(self.repeat):
+			for path in paths:
+				repo.stats.reset()
+				started = time.time()
+				try:
+					if function(repo, path):
+						hits += 1
+				except Exception, e:
+					errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+				timings.append(time.time() - started)
+
+				for counter, count in repo.stats.counts.items():
+					counts[counter] = counts.get(counter, 0) + count
+
+		timings.sort()
+		return {
+			"operation": operation,
+			"calls": len(timings),
+			"hits": hits,
+			"errors": errors,
+			"min": timings[0],
+			"median": timings[len(timings) // 2],
+			"mean": sum(timings) / len(timings),
+			"max": timings[-1],
+			"counts": dict((counter, float(count) / len(timings)) for counter, count in counts.items())}
+
+	def run(self, operations):
+		# The operations print their results so send them to /dev/null while timing
+		devnull = open(os.devnull, "w")
+		stdout, stderr = sys.stdout, sys.stderr
+		sys.stdout, sys.stderr = devnull, devnull
+		try:
+			return [self.time_operation(operation) for operation in operations]
+		finally:
+			sys.stdout, sys.stderr = stdout, stderr
+			devnull.close()
+
+
+def parse_int_list(value):
+	return [int(item) for item in value.split(",")]
+
+
+def parse_float_list(value):
+	return [float(item) for item in value.split(",")]
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Time metagit operations against synthetic repositories')
+
+	parser.add_argument('--commits', type=parse_int_list, default=[10, 100], help="Comma separated history lengths")
+	parser.add_argument('--files', type=parse_int_list, default=[10, 100], help="Comma separated file counts")
+	parser.add_argument('--branches', type=parse_int_list, default=[0], help="Comma separated side branch counts")
+	parser.add_argument('--shape', choices=SyntheticRepositoryConfig.shapes, default=SyntheticRepositoryConfig.shape_linear, help="How side branches relate to master")
+	parser.add_argument('--density', type=parse_float_list, default=[0.1], help="Comma separated fractions of file versions with metadata")
+	parser.add_argument('--changes', type=int, default=1, help="Files modified in each commit")
+	parser.add_argument('--operations', default=",".join(Benchmark.operations), help="Comma separated operations to time")
+	parser.add_argument('--samples', type=int, default=10, help="Paths sampled for each operation")
+	parser.add_argument('--repeat', type=int, default=3, help="Number of times each sample is repeated")
+	parser.add_argument('--seed', type=int, default=0, help="Random seed")
+	parser.add_argument('--tmpdir', default=None, help="Directory to create the synthetic repositories in")
+	parser.add_argument('--keep', action='store_true', default=False, help="Keep the synthetic repositories")
+	parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout, help="File to write the JSON results to")
+
+	args = parser.parse_args()
+
+	args.operations = args.operations.split(",")
+	for operation in args.operations:
+		if operation not in Benchmark.operations:
+			parser.error("Unknown operation '%s'" % operation)
+
+	return args
+
+
+if __name__ == "__main__":
+
+	args = parse_args()
+
+	results = []
+	for commits, files, branches, density in itertools.product(args.commits, args.files, args.branches, args.density):
+		config = SyntheticRepositoryConfig(commits, files, branches=branches, shape=args.shape, density=density, changes=args.changes, seed=args.seed)
+		MetadataRepository.errormsg("Generating %s" % json.dumps(config.as_dict(), sort_keys=True))
+
+		started = time.time()
+		syntheticrepo = SyntheticRepository(config, basedir=args.tmpdir)
+		try:
+			entries = syntheticrepo.add_metadata(MetadataRepository(syntheticrepo.workdir))
+			generated = time.time() - started
+
+			benchmark = Benchmark(syntheticrepo, samples=args.samples, repeat=args.repeat)
+			for result in benchmark.run(args.operations):
+				result.update(config.as_dict())
+				result["metadataentries"] = entries
+				result["generationtime"] = generated
+				results.append(result)
+				MetadataRepository.errormsg("  {:<6} median {:>10.2f} ms".format(result["operation"], result["median"] * 1000))
+		finally:
+			if args.keep:
+				MetadataRepository.errormsg("Kept %s" % syntheticrepo.workdir)
+			else:
+				syntheticrepo.remove()
+
+	json.dump({"results": results}, args.output, indent=1, sort_keys=True)
+	args.output.write("\n")
@@ -17,7 +17,9 @@ import os
 import sys
 import json
 import argparse
+import subprocess
 from metagit import *
+from metagitserver import MetadataHTTPServer
 import traceback
 import re  # Regular expressions
 
@@ -38,17 +40,28 @@ import re  # Regular expressions
 
 class ParseMetadataRef(argparse.Action):
 
-	def __call__(self, parser, namespace, values, option_string=None):
-
+	@staticmethod
+	def normalise(values):
 		# Check if we have an absolute reference path passed
 		if values.startswith("refs/"):
 			# Yes we have one so don't mess with it
-			metadataref = values
+			return values
 		else:
 			# We don't have one so generate it
-			metadataref = "refs/heads/%s" % values
+			return "refs/heads/%s" % values
+
+	def __call__(self, parser, namespace, values, option_string=None):
 
-		setattr(namespace, self.dest, metadataref)
+		setattr(namespace, self.dest, ParseMetadataRef.normalise(values))
+
+
+class AppendMetadataRef(argparse.Action):
+
+	def __call__(self, parser, namespace, values, option_string=None):
+
+		# Build a new list so we don't modify the default
+		metadatarefs = (getattr(namespace, self.dest) or []) + [ParseMetadataRef.normalise(values)]
+		setattr(namespace, self.dest, metadatarefs)
 
 
 # class ParseDataRevisionMetadataSearchMethod(argparse.Action):
@@ -83,6 +96,38 @@ def parse_args():
 		default=MetadataRepository.metadataref_default,
 		help="A git reference to the metadata, e.g. 'metadata' or 'refs/heads/metadata'")
 
+	parser.add_argument(
+		'-r', '--read-ref',
+		dest='fallbackrefs',
+		action=AppendMetadataRef,
+		default=[],
+		help="A further git reference to read metadata from when it isn't found in --metadataref. Can be repeated, in priority order.")
+
+	parser.add_argument(
+		'--as-of',
+		dest='asof',
+		default=None,
+		help="Read the metadata as it was at this metadata commit or time, e.g. '2016-03-01' or '2016-03-01 14:30'")
+
+	parser.add_argument(
+		'--replica',
+		action='store_true',
+		default=False,
+		help="Answer reads from a SQLite replica of the metadata branch, updating it first if needed")
+
+	parser.add_argument(
+		'--follow-renames',
+		dest='followrenames',
+		action='store_true',
+		default=False,
+		help="Use metadata recorded under a file's earlier paths if it has been moved without being changed")
+
+	parser.add_argument(
+		'--profile',
+		action='store_true',
+		default=False,
+		help="Print a breakdown of where the time was spent")
+
 	# Add sub-parsers
 	subparsers = parser.add_subparsers()
 
@@ -114,6 +159,50 @@ def parse_args():
 	parser_ls = subparsers.add_parser('ls')
 	parser_ls.set_defaults(command=ls) 
 
+	parser_status = subparsers.add_parser('status')
+	parser_status.set_defaults(command=status)
+
+	parser_bloom = subparsers.add_parser('bloom')
+	parser_bloom.set_defaults(command=bloom)
+
+	parser_gc = subparsers.add_parser('gc')
+	parser_gc.set_defaults(command=gc)
+
+	parser_fsck = subparsers.add_parser('fsck')
+	parser_fsck.set_defaults(command=fsck)
+
+	parser_merge = subparsers.add_parser('merge')
+	parser_merge.set_defaults(command=merge)
+
+	parser_changes = subparsers.add_parser('changes')
+	parser_changes.set_defaults(command=changes)
+
+	parser_backfill = subparsers.add_parser('backfill')
+	parser_backfill.set_defaults(command=backfill, path=os.getcwd())
+
+	parser_replica = subparsers.add_parser('replica')
+	replicasubparsers = parser_replica.add_subparsers()
+	parser_replica_sync = replicasubparsers.add_parser('sync')
+	parser_replica_sync.set_defaults(command=replica_sync)
+	parser_replica_find = replicasubparsers.add_parser('find')
+	parser_replica_find.set_defaults(command=replica_find)
+
+	parser_snapshot = subparsers.add_parser('snapshot')
+	parser_snapshot.set_defaults(command=snapshot)
+
+	parser_serve = subparsers.add_parser('serve')
+	parser_serve.set_defaults(command=serve)
+
+	parser_export = subparsers.add_parser('export')
+	parser_export.set_defaults(command=export)
+
+	parser_bundle = subparsers.add_parser('bundle')
+	bundlesubparsers = parser_bundle.add_subparsers()
+	parser_bundle_create = bundlesubparsers.add_parser('create')
+	parser_bundle_create.set_defaults(command=bundle_create)
+	parser_bundle_apply = bundlesubparsers.add_parser('apply')
+	parser_bundle_apply.set_defaults(command=bundle_apply)
+
 	# Set up 'get' subparser
 	parser_get.add_argument(
 		'path',
@@ -143,6 +232,19 @@ def parse_args():
 		default=os.getcwd(),
 		help="%s The path to the metadata object. The default branch and stream will be used if not specified." % MetadataPath.path_syntax)
 
+	parser_list.add_argument(
+		'--limit',
+		type=int,
+		default=None,
+		help="Only list this many versions of the metadata")
+
+	parser_list.add_argument(
+		'--json',
+		dest='jsonoutput',
+		action='store_true',
+		default=False,
+		help="Print each version as a line of JSON")
+
 
 	# Set up the 'copy' subparser
 	parser_copy.add_argument(
@@ -179,6 +281,374 @@ def parse_args():
 		default=os.getcwd(),
 		help="%s The path to the metadata object. The default branch and stream will be used if not specified." % MetadataPath.path_syntax)
 
+	parser_ls.add_argument(
+		'--subdir',
+		default="",
+		help="Only list the metadata under this directory of the repository")
+
+	parser_ls.add_argument(
+		'--depth',
+		type=int,
+		default=None,
+		help="Maximum depth of directories to list below the starting directory")
+
+	parser_ls.add_argument(
+		'--stream',
+		default=None,
+		help="Only list paths with metadata in this stream")
+
+	parser_ls.add_argument(
+		'--json',
+		action='store_true',
+		default=False,
+		help="Output one JSON object per line")
+
+
+	# Set up the 'status' subparser
+	parser_status.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="%s The directory to report on. The default stream will be used if not specified." % MetadataPath.path_syntax)
+
+	parser_status.add_argument(
+		'--state',
+		dest='states',
+		action='append',
+		choices=[MetadataStatus.applies, MetadataStatus.inherited, MetadataStatus.stale, MetadataStatus.absent],
+		help="Only show files in this state (can be repeated)")
+
+
+	# Set up the 'bloom' subparser
+	parser_bloom.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_bloom.add_argument(
+		'--commits',
+		action='store_true',
+		default=False,
+		help="Include data commit IDs in the filters")
+
+	parser_bloom.add_argument(
+		'--rebuild',
+		action='store_true',
+		default=False,
+		help="Rebuild the filters from scratch")
+
+
+	# Set up the 'gc' subparser
+	parser_gc.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_gc.add_argument(
+		'--before',
+		default=None,
+		help="Squash history up to this metadata commit or time (YYYY-MM-DD[THH:MM[:SS]] or seconds since the epoch). Defaults to all history.")
+
+	parser_gc.add_argument(
+		'--prune-missing',
+		dest='prunemissing',
+		action='store_true',
+		default=False,
+		help="Remove metadata for data commits which no longer exist")
+
+	parser_gc.add_argument(
+		'--dry-run',
+		dest='dryrun',
+		action='store_true',
+		default=False,
+		help="Report what would be done without updating the metadata branch")
+
+
+	# Set up the 'fsck' subparser
+	parser_fsck.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_fsck.add_argument(
+		'-j', '--jobs',
+		type=int,
+		default=None,
+		help="Number of worker processes (defaults to the number of CPUs)")
+
+	parser_fsck.add_argument(
+		'--json-stream',
+		dest='jsonstreams',
+		action='append',
+		default=None,
+		help="Check the metadata in this stream is valid JSON (can be repeated, defaults to '%s')" % MetadataPath.stream_default)
+
+	parser_fsck.add_argument(
+		'--no-path-check',
+		dest='checkpaths',
+		action='store_false',
+		default=True,
+		help="Don't check that each path exists in its data commit")
+
+	parser_fsck.add_argument(
+		'--report',
+		type=argparse.FileType('w'),
+		default=None,
+		help="Write a JSON report of the problems found to this file")
+
+
+	# Set up the 'merge' subparser
+	parser_merge.add_argument(
+		'ref',
+		help="The metadata reference or commit to merge into --metadataref, e.g. 'origin/metadata'")
+
+	parser_merge.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_merge.add_argument(
+		'--strategy',
+		choices=['ours', 'theirs'],
+		default=None,
+		help="Resolve conflicting entries by taking our or their metadata")
+
+	parser_merge.add_argument(
+		'--no-ff',
+		dest='fastforward',
+		action='store_false',
+		default=True,
+		help="Create a merge commit even if a fast-forward is possible")
+
+	parser_merge.add_argument(
+		'--dry-run',
+		dest='dryrun',
+		action='store_true',
+		default=False,
+		help="Report what would happen without updating the metadata branch")
+
+
+	# Set up the 'changes' subparser
+	parser_changes.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_changes.add_argument(
+		'--since',
+		dest='cursor',
+		default=None,
+		help="The cursor printed by a previous run; without it every entry in the history is reported")
+
+	parser_changes.add_argument(
+		'--json',
+		dest='jsonoutput',
+		action='store_true',
+		default=False,
+		help="Print each change as a line of JSON")
+
+
+	# Set up the 'backfill' subparser
+	parser_backfill.add_argument(
+		'paths',
+		nargs="*",
+		help="The files and directories to attach metadata to. Everything in the repository is used if none are given.")
+
+	parser_backfill.add_argument(
+		'--command',
+		dest='metadatacommand',
+		required=True,
+		help="Shell command run with each version of a file on stdin, whose output is saved as its metadata. METAGIT_PATH and METAGIT_BLOB are set to the file's path and blob ID.")
+
+	parser_backfill.add_argument(
+		'--rev',
+		default="HEAD",
+		help="The data revision whose history is backfilled")
+
+	parser_backfill.add_argument(
+		'--stream',
+		dest='streamname',
+		default=MetadataPath.stream_default,
+		help="The stream to save the metadata in")
+
+	parser_backfill.add_argument(
+		'--batch-size',
+		dest='batchsize',
+		type=int,
+		default=1000,
+		help="Number of metadata entries in each commit")
+
+	parser_backfill.add_argument(
+		'-f', '--force',
+		action='store_true',
+		default=False,
+		help="Replace metadata that already exists")
+
+
+	# Set up the 'replica sync' subparser
+	parser_replica_sync.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+
+	# Set up the 'replica find' subparser
+	parser_replica_find.add_argument(
+		'keyvaluepair',
+		help="The key to look for, optionally with the value it must have, e.g. author or author=\"Charles Darwin\"")
+
+	parser_replica_find.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_replica_find.add_argument(
+		'--stream',
+		dest='streamname',
+		default=None,
+		help="Only look in this stream")
+
+
+	# Set up the 'snapshot' subparser
+	parser_snapshot.add_argument(
+		'file',
+		type=argparse.FileType('wb'),
+		help="The snapshot file to write")
+
+	parser_snapshot.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_snapshot.add_argument(
+		'--rev',
+		default=MetadataPath.datarev_default_get,
+		help="The data revision to resolve the metadata for")
+
+	parser_snapshot.add_argument(
+		'--stream',
+		dest='streamnames',
+		action='append',
+		default=None,
+		help="Only include this stream. Can be repeated; every stream is included if not given.")
+
+
+	# Set up the 'serve' subparser
+	parser_serve.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_serve.add_argument(
+		'--host',
+		default="127.0.0.1",
+		help="The address to listen on")
+
+	parser_serve.add_argument(
+		'--port',
+		type=int,
+		default=8080,
+		help="The port to listen on")
+
+	parser_serve.add_argument(
+		'--threads',
+		type=int,
+		default=MetadataHTTPServer.threads_default,
+		help="The number of worker threads, each with its own repository handle")
+
+
+	# Set up the 'export' subparser
+	parser_export.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	# The output is opened by export() once it knows the export can be written
+	parser_export.add_argument(
+		'-o', '--output',
+		default=None,
+		help="The file to write to. JSON lines are written to stdout if not given.")
+
+	parser_export.add_argument(
+		'--stream',
+		dest='streamname',
+		default=None,
+		help="Only export this stream")
+
+	parser_export.add_argument(
+		'--columnar',
+		action='store_true',
+		default=False,
+		help="Write a column for each JSON key rather than a JSON object for each metadata blob")
+
+	parser_export.add_argument(
+		'--format',
+		dest='fileformat',
+		choices=sorted(columnar_writers),
+		default="npz",
+		help="The columnar format: a NumPy .npz archive or an Arrow IPC file")
+
+	parser_export.add_argument(
+		'--row-group-size',
+		dest='rowgroupsize',
+		type=int,
+		default=10000,
+		help="The number of rows held in memory and written together")
+
+
+	# Set up the 'bundle create' subparser
+	parser_bundle_create.add_argument(
+		'file',
+		type=argparse.FileType('wb'),
+		help="The bundle file to write")
+
+	parser_bundle_create.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_bundle_create.add_argument(
+		'--since',
+		default=None,
+		help="Only include metadata commits after this one, e.g. the tip of the last bundle applied at the other site")
+
+
+	# Set up the 'bundle apply' subparser
+	parser_bundle_apply.add_argument(
+		'file',
+		type=argparse.FileType('rb'),
+		help="The bundle file to apply")
+
+	parser_bundle_apply.add_argument(
+		'path',
+		nargs="?",
+		default=os.getcwd(),
+		help="A path within the repository")
+
+	parser_bundle_apply.add_argument(
+		'--strategy',
+		choices=['ours', 'theirs'],
+		default=None,
+		help="Resolve conflicting entries by taking our or their metadata")
+
+	parser_bundle_apply.add_argument(
+		'--dry-run',
+		dest='dryrun',
+		action='store_true',
+		default=False,
+		help="Add the objects but don't update the metadata branch")
+
 
 	# Set up the 'setvalue' subparser
 	parser_setvalue.add_argument(
@@ -188,8 +658,10 @@ def parse_args():
 		help="%s The path to the metadata object. The default branch and stream will be used if not specified." % MetadataPath.path_syntax)
 
 	parser_setvalue.add_argument(
-		'keyvaluepair',
-		help='Key value pair to add to metadata')
+		'keyvaluepairs',
+		metavar='keyvaluepair',
+		nargs='+',
+		help='Key value pairs to add to metadata, e.g. author="Charles Darwin" year=1859')
 
 
 	# Set up the 'getvalue' subparser
@@ -229,8 +701,7 @@ def get(args, repo):
 
 def getvalue(args, repo):
 	
-	metadatablob = repo.find_metadata_blob(args.path)
-	data = json.loads(metadatablob.data)
+	data = repo.get_metadata_document(args.path)
 	for key, value in data.iteritems():
 		if (args.keyfilter is None or args.keyfilter == key.__str__()):
 			print '{:<20} {:<20}'.format(key, value)
@@ -242,34 +713,26 @@ def set(args, repo):
 
 
 def setvalue(args, repo):
-	# Separate the key and value
-	k, sep, v = args.keyvaluepair.partition("=")
-
-	# Check keyvaluepair argument is correct format
-	if sep != "=":
-		raise KeyValuePairArgumentError(KeyValuePairArgumentError.__doc__)
-
-	try:
-		# Get the metadata
-		metadatablob = repo.find_metadata_blob(args.path)
-		jsondict = json.loads(metadatablob.data)
-	except (MetadataBlobNotFoundError, NoMetadataBranchError):
-		jsondict = json.loads("{}")
+	patch = {}
+	for keyvaluepair in args.keyvaluepairs:
+		# Separate the key and value
+		k, sep, v = keyvaluepair.partition("=")
 
-	# Update dictionary
-	jsondict[k] = v
+		# Check keyvaluepair argument is correct format
+		if sep != "=":
+			raise KeyValuePairArgumentError(KeyValuePairArgumentError.__doc__)
 
-	# Create an object to save in the repository
-	newfile = json.dumps(jsondict)
+		patch[k] = v
 
-	commitid = repo.save_metadata_blob(args.path, newfile)
+	# Update all of the keys in a single commit
+	repo.update_metadata_documents([(args.path, patch)])
 
 def setdata(args, repo):
 	repo.save_metadata_blob(args.path, args.data)
 
 def list(args, repo):
 
-	repo.list_metadata_in_stream(args.path)
+	repo.list_metadata_in_stream(args.path, limit=args.limit, jsonoutput=args.jsonoutput)
 
 
 def log(args, repo):
@@ -279,7 +742,194 @@ def log(args, repo):
 
 def ls(args, repo):
 
-	repo.list_metadata_objects()
+	repo.list_metadata_objects(subdir=args.subdir, maxdepth=args.depth, streamname=args.stream, jsonoutput=args.json)
+
+
+def status(args, repo):
+
+	repo.print_metadata_status(args.path, states=args.states)
+
+
+def bloom(args, repo):
+
+	bloomindex = repo.update_bloom_index(withcommitids=args.commits, rebuild=args.rebuild)
+	print "Bloom filters for '%s' at %s are up to date in '%s'" % (repo.metadataref, bloomindex.source, repo.get_bloom_ref())
+
+
+def gc(args, repo):
+
+	result = repo.compact_metadata(before=args.before, prunemissing=args.prunemissing, dryrun=args.dryrun)
+
+	for prunedpath in result["pruned"]:
+		print "Removed %s" % prunedpath
+
+	print "Squashed %d commits and replayed %d commits on top" % (result["squashed"], result["replayed"])
+	if len(result["replayedmerges"]) > 0:
+		print "Kept the merged parents of %d replayed merge commits" % len(result["replayedmerges"])
+	if len(result["squashedmerges"]) > 0:
+		MetadataRepository.errormsg("WARNING: %d merge commits were squashed, so their merged parents are no longer in the history. Later merges of those references may report conflicts." % len(result["squashedmerges"]))
+	print "Objects:  %d -> %d (%d saved)" % (result["objectsbefore"], result["objectsafter"], result["objectsbefore"] - result["objectsafter"])
+	print "Bytes:    %d -> %d (%d saved, uncompressed)" % (result["sizebefore"], result["sizeafter"], result["sizebefore"] - result["sizeafter"])
+
+	if args.dryrun:
+		print "Dry run: '%s' was not updated" % repo.metadataref
+	else:
+		print "'%s' moved from %s to %s" % (repo.metadataref, result["oldtip"], result["newtip"])
+		print "Run 'git gc' once the old commits have expired from the reflog to reclaim the space"
+
+
+def fsck(args, repo):
+
+	def progress(jobsdone, jobstotal, entries, problems):
+		sys.stderr.write("\rChecked %d/%d subtrees, %d entries, %d problems" % (jobsdone, jobstotal, entries, problems))
+		if jobsdone == jobstotal:
+			sys.stderr.write("\n")
+
+	report = repo.check_metadata(jobs=args.jobs, jsonstreams=args.jsonstreams, checkpaths=args.checkpaths, progress=progress)
+
+	for problem in report["problems"]:
+		print "{:<8} {:<24} {}:{}:{} {}".format(problem["severity"], problem["check"], problem["datacommit"] or "", problem["path"], problem["stream"] or "", problem["message"])
+
+	print "Checked %d trees and %d entries in %s: %d errors, %d warnings" % (report["trees"], report["entries"], report["metadatacommit"], report["errors"], report["warnings"])
+
+	if args.report is not None:
+		json.dump(report, args.report, indent=1, sort_keys=True)
+		args.report.write("\n")
+
+	if report["errors"] > 0:
+		raise MetadataInvalidError("%d errors found in '%s'" % (report["errors"], repo.metadataref))
+
+
+def merge(args, repo):
+
+	result = repo.merge_metadata(args.ref, strategy=args.strategy, fastforward=args.fastforward, dryrun=args.dryrun)
+	print_merge_result(args, repo, result)
+
+
+def print_merge_result(args, repo, result):
+
+	for conflict in result["conflicts"]:
+		print "CONFLICT ({}): {}:{}:{}".format(conflict["reason"], conflict["datacommit"] or "", conflict["path"], conflict["stream"] or "")
+
+	if result["type"] == "up-to-date":
+		print "Already up to date"
+	elif result["commit"] is None:
+		if len(result["conflicts"]) > 0 and args.strategy is None and not args.dryrun:
+			raise MetadataWriteError("%d conflicting entries, use --strategy to resolve them" % len(result["conflicts"]))
+		print "Dry run: '%s' was not updated" % repo.metadataref
+	elif result["type"] == "fast-forward":
+		print "Fast-forwarded '%s' to %s" % (repo.metadataref, result["commit"])
+	else:
+		print "Merged '%s' into '%s' with commit %s (%d conflicts resolved using %s)" % (result["theirs"], repo.metadataref, result["commit"], len(result["conflicts"]), args.strategy or "none")
+
+
+def changes(args, repo):
+
+	# Take the cursor first so anything committed while we read is reported next time
+	cursor = repo.get_change_cursor()
+	actioncodes = {"added": "A", "modified": "M", "removed": "D"}
+
+	if cursor is not None:
+		for change in repo.iter_metadata_changes(args.cursor, cursor):
+			if args.jsonoutput:
+				print json.dumps(change, sort_keys=True)
+			else:
+				print "{} {} {}:{}:{}".format(actioncodes[change["action"]], change["blobid"], change["datacommit"], change["path"], change["stream"])
+
+	if args.jsonoutput:
+		print json.dumps({"cursor": cursor})
+	else:
+		print "Cursor: %s" % cursor
+
+
+def backfill(args, repo):
+
+	def run_command(path, blob):
+		environment = dict(os.environ, METAGIT_PATH=path, METAGIT_BLOB=blob.id.__str__())
+		process = subprocess.Popen(args.metadatacommand, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
+		output = process.communicate(blob.data)[0]
+		if process.returncode != 0:
+			raise MetadataWriteError("'%s' failed for %s with exit status %d" % (args.metadatacommand, path, process.returncode))
+		return output if len(output) > 0 else None
+
+	paths = [os.path.relpath(os.path.abspath(path), repo.workdir) for path in args.paths]
+	summary = repo.backfill_metadata(paths, run_command, datarev=args.rev, streamname=args.streamname, batchsize=args.batchsize, force=args.force)
+
+	print "%d versions found: %d computed, %d reused, %d already had metadata" % (summary["versions"], summary["computed"], summary["reused"], summary["skipped"])
+	print "%d metadata entries written in %d commits" % (summary["written"], len(summary["commits"]))
+
+
+def replica_sync(args, repo):
+
+	count = repo.sync_replica()
+	print "Replica of '%s' synced to %s (%d entries updated)" % (repo.metadataref, repo.get_metadata_commit(repo.metadataref).id, count)
+
+
+def replica_find(args, repo):
+
+	k, sep, v = args.keyvaluepair.partition("=")
+	repo.usereplica = True
+	for path, streamname, datacommitid, value in repo.find_metadata_by_key(k, value=v if sep == "=" else None, streamname=args.streamname):
+		print "{}:{}:{} {}={}".format(datacommitid, path, streamname, k, value)
+
+
+def snapshot(args, repo):
+
+	count = repo.write_metadata_snapshot(args.file, datarev=args.rev, streamnames=args.streamnames)
+	print "Snapshot of %d metadata entries for %s written to '%s'" % (count, args.rev, args.file.name)
+
+
+def serve(args, repo):
+
+	if args.threads < 1:
+		raise ParameterError("--threads must be at least 1")
+
+	pool = MetadataRepositoryPool(repo.path, metadataref=repo.metadataref, debug=args.verbose, fallbackrefs=args.fallbackrefs, asof=args.asof, replica=args.replica, followrenames=args.followrenames)
+	server = MetadataHTTPServer((args.host, args.port), pool, threads=args.threads)
+	MetadataRepository.errormsg("Serving metadata from '%s' on http://%s:%d/" % (repo.metadataref, args.host, server.server_port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		pool.close()
+
+
+def export(args, repo):
+
+	if not args.columnar:
+		if args.output is None or args.output == "-":
+			repo.export_metadata(sys.stdout, streamname=args.streamname)
+		else:
+			with open(args.output, "w") as outfile:
+				repo.export_metadata(outfile, streamname=args.streamname)
+		return
+
+	if args.output is None:
+		raise ParameterError("--columnar needs an output file")
+	if args.rowgroupsize < 1:
+		raise ParameterError("--row-group-size must be at least 1")
+
+	# Check the format can be written before an existing file is overwritten
+	columnar_writers[args.fileformat].check_dependencies()
+
+	with open(args.output, "wb") as outfile:
+		result = repo.export_metadata_columnar(outfile, args.fileformat, streamname=args.streamname, rowgroupsize=args.rowgroupsize)
+	print "Exported %d rows with %d columns in %d row groups to '%s'" % (result["rows"], result["columns"], result["rowgroups"], args.output)
+
+
+def bundle_create(args, repo):
+
+	header = repo.create_metadata_bundle(args.file, since=args.since)
+	print "Bundled %d commits (%d objects) from '%s' up to %s" % (header["commits"], header["objects"], header["ref"], header["tip"])
+
+
+def bundle_apply(args, repo):
+
+	result = repo.apply_metadata_bundle(args.file, strategy=args.strategy, dryrun=args.dryrun)
+	print "Applied bundle of %d commits from '%s' up to %s" % (result["bundle"]["commits"], result["bundle"]["ref"], result["bundle"]["tip"])
+	print_merge_result(args, repo, result)
 
 
 def copy(args, repo):
@@ -308,11 +958,16 @@ if __name__ == "__main__":
 	if args.verbose:
 		MetadataRepository.errormsg("Unparsed path : '%s'" % args.path)
 
+	stats = MetadataRepositoryStats()
+
 	# Execute the requested function
 	try:
-		repopath = MetadataRepository.discover_repository(args.path, args.metadataref)
-		repo = MetadataRepository(repopath, debug=args.verbose)
-		args.command(args, repo)
+		with stats.phase("discovery"):
+			repopath = MetadataRepository.discover_repository(args.path, args.metadataref)
+			repo = MetadataRepository(repopath, metadataref=args.metadataref, debug=args.verbose, stats=stats, fallbackrefs=args.fallbackrefs, asof=args.asof, replica=args.replica, followrenames=args.followrenames)
+		# Every read in the command sees the same metadata commit
+		with repo.pin_metadata():
+			args.command(args, repo)
 	except Exception, e:
 		if args.verbose:
 			traceback.print_exc()
@@ -320,3 +975,7 @@ if __name__ == "__main__":
 			exc_type, exc_obj, exc_tb = sys.exc_info()
 			MetadataRepository.errormsg("%s: %s" % (exc_type.__name__, exc_obj))
 		sys.exit(1)
+	finally:
+		if args.profile:
+			MetadataRepository.errormsg("")
+			MetadataRepository.errormsg(stats.report())
@@ -14,10 +14,26 @@
 
 import os
 import sys
+import json
 import uuid
 import datetime
 import re
+import time
+import atexit
+import contextlib
+import itertools
+import collections
+import sqlite3
+import struct
+import math
+import hashlib
+import multiprocessing
+import threading
+import Queue
+import zlib
 import pygit2
+from metagitsnapshot import MetadataSnapshotFile
+from metagitexport import MetadataColumnSchema, MetadataExportError, columnar_writers
 
 class NoRepositoryError(Exception):
 	"""Could not find a Git repository"""
@@ -79,6 +95,725 @@ class MetadataInvalidError(Exception):
 	pass
 
 
+class MetadataPointNotFoundError(ParameterError):
+	"""Metadata reference has no commit at the as-of point"""
+	pass
+
+
+class KeyValuePairArgumentError(Exception):
+	"""Key value pairs must be in the form key=value"""
+	pass
+
+
+class MetadataWriteBuffer:
+	count_default = 1000
+	bytes_default = 16 * 1024 * 1024
+	age_default = 30.0
+
+	# Collects metadata blobs waiting to be committed. Entries are keyed by their path
+	# in the metadata tree so a later write to the same path replaces an earlier one.
+	def __init__(self, maxcount=count_default, maxbytes=bytes_default, maxage=age_default):
+		self.maxcount = maxcount
+		self.maxbytes = maxbytes
+		self.maxage = maxage
+		self.clear()
+
+	def clear(self):
+		self.entries = {}
+		self.datapaths = []
+		self.nbytes = 0
+		self.force = False
+		self.started = None
+
+	# Every entry in the buffer has the same force, see MetadataRepository.queue_write()
+	def add(self, metadatablobpath, blobid, size, datapath, force=False):
+		if self.started is None:
+			self.started = time.time()
+
+		self.entries[metadatablobpath] = blobid
+		self.datapaths.append(datapath)
+		self.nbytes += size
+		self.force = force
+
+	def is_full(self):
+		if len(self.entries) == 0:
+			return False
+
+		return (self.maxcount is not None and len(self.entries) >= self.maxcount) \
+			or (self.maxbytes is not None and self.nbytes >= self.maxbytes) \
+			or (self.maxage is not None and time.time() - self.started >= self.maxage)
+
+	def __len__(self):
+		return len(self.entries)
+
+
+class MetadataDocumentCache:
+	maxentries_default = 1000
+
+	# Parsed JSON metadata documents keyed by blob ID. Blobs never change so entries never
+	# go stale; the least recently used are dropped once maxentries is reached. The cached
+	# documents are shared so callers must not modify them. The cache may be shared between
+	# threads by MetadataRepositoryPool.
+	def __init__(self, maxentries=maxentries_default):
+		self.maxentries = maxentries
+		self.documents = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, blob):
+		with self.lock:
+			document = self.documents.pop(blob.id, None)
+		if document is None:
+			try:
+				document = json.loads(blob.data)
+			except ValueError:
+				raise MetadataFileFormatError("Metadata blob %s is not JSON" % blob.id)
+		self.add(blob.id, document)
+		return document
+
+	def add(self, blobid, document):
+		with self.lock:
+			self.documents[blobid] = document
+			while len(self.documents) > self.maxentries:
+				self.documents.popitem(last=False)
+
+	# Applies a JSON merge patch (RFC 7386) and returns the result, leaving document unchanged.
+	# Keys set to None in the patch are removed and nested objects are merged.
+	@staticmethod
+	def apply_merge_patch(document, patch):
+		if not isinstance(patch, dict):
+			return patch
+
+		merged = dict(document) if isinstance(document, dict) else {}
+		for key, value in patch.iteritems():
+			if value is None:
+				merged.pop(key, None)
+			else:
+				merged[key] = MetadataDocumentCache.apply_merge_patch(merged.get(key), value)
+		return merged
+
+
+class MetadataStreamRecord:
+
+	# One version of the metadata in a stream, as listed by iter_metadata_stream_records. The
+	# metadata itself is only read from the repository when the data property is used.
+	def __init__(self, repo, datacommitid, metadatablobid):
+		self.repo = repo
+		self.datacommitid = datacommitid        # Data commit the metadata was attached to
+		self.metadatablobid = metadatablobid.__str__()
+		self.dataid = None                      # Data at the path in that commit, if it exists
+		self.datatype = None                    # "blob" or "tree"
+		self.matches = False                    # The data is the same as the data requested
+		self.inheritable = False                # ...and the commit is an ancestor of the datarev
+		self.timestamp = None                   # Commit time of the data commit
+
+	@property
+	def data(self):
+		return self.repo[self.metadatablobid].data
+
+	def as_dict(self):
+		return {
+			"datacommit": self.datacommitid,
+			"metadatablob": self.metadatablobid,
+			"data": self.dataid,
+			"datatype": self.datatype,
+			"matches": self.matches,
+			"inheritable": self.inheritable,
+			"timestamp": self.timestamp}
+
+
+class MetadataRepositoryStats:
+	counters = [
+		("revparse", "revparse_single calls"),
+		("treediffs", "Tree diffs"),
+		("commitswalked", "Commits walked"),
+		("blobscreated", "Blobs created"),
+		("treeswritten", "Trees written"),
+		("commitscreated", "Commits created")]
+
+	# Counts and times the expensive repository operations, attributing them to the
+	# innermost phase that is running. Phase times exclude any nested phases.
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.counts = dict((counter, 0) for counter, description in MetadataRepositoryStats.counters)
+		self.times = dict((counter, 0.0) for counter, description in MetadataRepositoryStats.counters)
+		self.phasenames = []
+		self.phasetimes = {}
+		self.phasecounts = {}
+		self.phasestack = []
+
+	def record(self, counter, elapsed=0.0, count=1):
+		self.counts[counter] += count
+		self.times[counter] += elapsed
+
+		if len(self.phasestack) > 0:
+			phasecounts = self.phasecounts[self.phasestack[-1][0]]
+			phasecounts[counter] = phasecounts.get(counter, 0) + count
+
+	@contextlib.contextmanager
+	def timed(self, counter):
+		started = time.time()
+		try:
+			yield
+		finally:
+			self.record(counter, time.time() - started)
+
+	@contextlib.contextmanager
+	def phase(self, phasename):
+		now = time.time()
+
+		# Pause the enclosing phase
+		if len(self.phasestack) > 0:
+			self.add_phase_time(self.phasestack[-1][0], now - self.phasestack[-1][1])
+
+		if phasename not in self.phasetimes:
+			self.phasenames.append(phasename)
+			self.phasetimes[phasename] = 0.0
+			self.phasecounts[phasename] = {}
+
+		self.phasestack.append([phasename, now])
+		try:
+			yield
+		finally:
+			now = time.time()
+			phasename, started = self.phasestack.pop()
+			self.add_phase_time(phasename, now - started)
+
+			# Resume the enclosing phase
+			if len(self.phasestack) > 0:
+				self.phasestack[-1][1] = now
+
+	def add_phase_time(self, phasename, elapsed):
+		self.phasetimes[phasename] += elapsed
+
+	def as_dict(self):
+		return {
+			"counts": dict(self.counts),
+			"times": dict(self.times),
+			"phases": [{"name": phasename, "time": self.phasetimes[phasename], "counts": dict(self.phasecounts[phasename])} for phasename in self.phasenames]}
+
+	def report(self):
+		lines = []
+		lines.append("{:<24} {:>10}  {}".format("Phase", "Time (ms)", "Operations"))
+		lines.append("{:<24} {:>10}  {}".format("-" * 24, "-" * 10, "-" * 40))
+		for phasename in self.phasenames:
+			phasecounts = self.phasecounts[phasename]
+			countsstr = ", ".join("%s=%d" % (counter, phasecounts[counter]) for counter, description in MetadataRepositoryStats.counters if counter in phasecounts)
+			lines.append("{:<24} {:>10.2f}  {}".format(phasename, self.phasetimes[phasename] * 1000, countsstr))
+		lines.append("")
+		lines.append("{:<24} {:>10}  {:>10}".format("Operation", "Count", "Time (ms)"))
+		lines.append("{:<24} {:>10}  {:>10}".format("-" * 24, "-" * 10, "-" * 10))
+		for counter, description in MetadataRepositoryStats.counters:
+			lines.append("{:<24} {:>10d}  {:>10.2f}".format(description, self.counts[counter], self.times[counter] * 1000))
+		return "\n".join(lines)
+
+
+class MetadataStatCache:
+	racy_window = 2.0
+	save_batch = 100
+
+	# Persistent cache of working directory blob IDs keyed by path, inode, size and mtime, like
+	# the stat information in git's index. A file whose stat information has not changed is not
+	# read again. Files modified within racy_window seconds of being hashed are not cached because
+	# a further change within the same mtime tick would not be noticed. Changes are committed
+	# every save_batch files and when save() is called.
+	def __init__(self, dbpath):
+		self.db = sqlite3.connect(dbpath)
+		self.db.execute("CREATE TABLE IF NOT EXISTS statcache (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime REAL, blobid TEXT)")
+		self.pending = 0
+
+	def hashfile(self, path):
+		filestat = os.stat(path)
+
+		row = self.db.execute("SELECT inode, size, mtime, blobid FROM statcache WHERE path = ?", (path,)).fetchone()
+		if row is not None and row[0:3] == (filestat.st_ino, filestat.st_size, filestat.st_mtime):
+			return pygit2.Oid(hex=row[3].encode("ascii"))
+
+		blobid = pygit2.hashfile(path)
+
+		# Forget any old entry, only remembering the new one if the file is not racily clean
+		if time.time() - filestat.st_mtime > MetadataStatCache.racy_window:
+			self.db.execute("INSERT OR REPLACE INTO statcache VALUES (?, ?, ?, ?, ?)", (path, filestat.st_ino, filestat.st_size, filestat.st_mtime, blobid.__str__()))
+		elif row is not None:
+			self.db.execute("DELETE FROM statcache WHERE path = ?", (path,))
+		self.pending += 1
+
+		if self.pending >= MetadataStatCache.save_batch:
+			self.save()
+		return blobid
+
+	def save(self):
+		if self.pending > 0:
+			self.db.commit()
+			self.pending = 0
+
+	def clear(self):
+		self.db.execute("DELETE FROM statcache")
+		self.db.commit()
+		self.pending = 0
+
+
+class MetadataTimeIndex:
+
+	# The first-parent history of each metadata reference with a running maximum of the commit
+	# times, so the state as of a time can be found by bisecting the index rather than walking
+	# the history. The index is extended when the reference moves forward and rebuilt from the
+	# point where the history diverges if it has been rewritten.
+	def __init__(self, dbpath):
+		self.db = sqlite3.connect(dbpath)
+		self.db.execute("CREATE TABLE IF NOT EXISTS timeindex (ref TEXT, position INTEGER, commitid TEXT, maxtime INTEGER, PRIMARY KEY (ref, position))")
+		self.db.execute("CREATE INDEX IF NOT EXISTS timeindex_commit ON timeindex (ref, commitid)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS timeindex_maxtime ON timeindex (ref, maxtime)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS tips (ref TEXT PRIMARY KEY, commitid TEXT)")
+
+	def update(self, repo, ref, tipcommit):
+		row = self.db.execute("SELECT commitid FROM tips WHERE ref = ?", (ref,)).fetchone()
+		if row is not None and row[0] == tipcommit.id.__str__():
+			return
+
+		# Walk back to the newest commit that is already indexed
+		newcommits = []
+		position, maxtime = -1, None
+		commit = tipcommit
+		while commit is not None:
+			row = self.db.execute("SELECT position, maxtime FROM timeindex WHERE ref = ? AND commitid = ?", (ref, commit.id.__str__())).fetchone()
+			if row is not None:
+				position, maxtime = row
+				break
+			repo.stats.record("commitswalked")
+			newcommits.append(commit)
+			commit = commit.parents[0] if len(commit.parents) > 0 else None
+
+		self.db.execute("DELETE FROM timeindex WHERE ref = ? AND position > ?", (ref, position))
+		for commit in reversed(newcommits):
+			position += 1
+			maxtime = max(maxtime, commit.commit_time) if maxtime is not None else commit.commit_time
+			self.db.execute("INSERT INTO timeindex VALUES (?, ?, ?, ?)", (ref, position, commit.id.__str__(), maxtime))
+		self.db.execute("INSERT OR REPLACE INTO tips VALUES (?, ?)", (ref, tipcommit.id.__str__()))
+		self.db.commit()
+
+	# Returns the ID of the last commit in ref's history made at or before timestamp, or None
+	def find_time(self, ref, timestamp):
+		row = self.db.execute("SELECT commitid FROM timeindex WHERE ref = ? AND maxtime <= ? ORDER BY position DESC LIMIT 1", (ref, timestamp)).fetchone()
+		return row[0] if row is not None else None
+
+	def contains(self, ref, commitid):
+		return self.db.execute("SELECT 1 FROM timeindex WHERE ref = ? AND commitid = ?", (ref, commitid.__str__())).fetchone() is not None
+
+
+class MetadataReplica:
+
+	# A SQLite mirror of a metadata reference with a row for each metadata entry and for each top
+	# level key of the JSON documents, so entries and keys can be queried without reading trees.
+	# It is brought up to date by replaying the metadata commits made since the commit it was
+	# last synced with.
+	def __init__(self, dbpath):
+		self.db = sqlite3.connect(dbpath)
+		self.db.execute("CREATE TABLE IF NOT EXISTS synced (ref TEXT PRIMARY KEY, commitid TEXT)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS entries (ref TEXT, path TEXT, stream TEXT, datacommit TEXT, blobid TEXT, PRIMARY KEY (ref, path, stream, datacommit))")
+		self.db.execute("CREATE TABLE IF NOT EXISTS keyvalues (ref TEXT, path TEXT, stream TEXT, datacommit TEXT, key TEXT, value TEXT)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS keyvalues_entry ON keyvalues (ref, path, stream, datacommit)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS keyvalues_key ON keyvalues (ref, key, value)")
+
+	def get_synced_commit(self, ref):
+		row = self.db.execute("SELECT commitid FROM synced WHERE ref = ?", (ref,)).fetchone()
+		return row[0] if row is not None else None
+
+	# Brings ref's rows up to tipcommit, replaying the changes since the last synced commit or
+	# reloading everything if that commit no longer exists. Returns the number of entries changed.
+	def sync(self, repo, ref, tipcommit):
+		syncedcommitid = self.get_synced_commit(ref)
+		if syncedcommitid == tipcommit.id.__str__():
+			return 0
+
+		if syncedcommitid is not None and isinstance(repo.get(syncedcommitid), pygit2.Commit):
+			changes = ((change["path"], change["stream"], change["datacommit"], None if change["action"] == "removed" else change["blobid"])
+				for change in repo.iter_metadata_changes(syncedcommitid, tipcommit.id.__str__()))
+		else:
+			self.db.execute("DELETE FROM entries WHERE ref = ?", (ref,))
+			self.db.execute("DELETE FROM keyvalues WHERE ref = ?", (ref,))
+			changes = repo.iter_metadata_entries(tipcommit.tree)
+
+		count = 0
+		for path, streamname, datacommitid, blobid in changes:
+			key = (ref, path, streamname, datacommitid)
+			self.db.execute("DELETE FROM keyvalues WHERE ref = ? AND path = ? AND stream = ? AND datacommit = ?", key)
+			if blobid is None:
+				self.db.execute("DELETE FROM entries WHERE ref = ? AND path = ? AND stream = ? AND datacommit = ?", key)
+			else:
+				self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", key + (blobid.__str__(),))
+				for k, v in MetadataReplica.get_key_values(repo[blobid]):
+					self.db.execute("INSERT INTO keyvalues VALUES (?, ?, ?, ?, ?, ?)", key + (k, v))
+			count += 1
+
+		self.db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (ref, tipcommit.id.__str__()))
+		self.db.commit()
+		return count
+
+	# The top level keys of a JSON object, with values other than strings stored as JSON
+	@staticmethod
+	def get_key_values(blob):
+		try:
+			document = json.loads(blob.data)
+		except ValueError:
+			return []
+		if not isinstance(document, dict):
+			return []
+		return [(k, v if isinstance(v, basestring) else json.dumps(v, sort_keys=True)) for k, v in document.iteritems()]
+
+	def lookup(self, ref, path, streamname, datacommitid):
+		row = self.db.execute("SELECT blobid FROM entries WHERE ref = ? AND path = ? AND stream = ? AND datacommit = ?", (ref, path, streamname, datacommitid)).fetchone()
+		return row[0] if row is not None else None
+
+	# Returns (data commit, blob ID) for each version of the metadata for path in a stream,
+	# sorted by data commit like the entries of the stream's tree
+	def stream_entries(self, ref, path, streamname):
+		return self.db.execute("SELECT datacommit, blobid FROM entries WHERE ref = ? AND path = ? AND stream = ? ORDER BY datacommit", (ref, path, streamname)).fetchall()
+
+	# Returns the sorted paths with metadata in a stream, below subdir if it is given
+	def paths_with_stream(self, ref, streamname, subdir=""):
+		if subdir == "":
+			rows = self.db.execute("SELECT DISTINCT path FROM entries WHERE ref = ? AND stream = ? ORDER BY path", (ref, streamname))
+		else:
+			rows = self.db.execute("SELECT DISTINCT path FROM entries WHERE ref = ? AND stream = ? AND (path = ? OR substr(path, 1, ?) = ?) ORDER BY path", (ref, streamname, subdir, len(subdir) + 1, subdir + os.sep))
+		return [row[0] for row in rows]
+
+	# Returns (path, stream, data commit, value) for each entry with key, optionally only where
+	# it has the given value
+	def find_key(self, ref, key, value=None, streamname=None):
+		query = "SELECT path, stream, datacommit, value FROM keyvalues WHERE ref = ? AND key = ?"
+		parameters = [ref, key]
+		if value is not None:
+			query += " AND value = ?"
+			parameters.append(value)
+		if streamname is not None:
+			query += " AND stream = ?"
+			parameters.append(streamname)
+		return self.db.execute(query + " ORDER BY path, stream, datacommit", parameters).fetchall()
+
+
+class MetadataBlobPathIndex:
+
+	# Records each path where a blob has appeared in the data history, and the commit where it
+	# appeared there, so the earlier paths of a moved file can be found without diffing. Commits
+	# already indexed are remembered as tips and their history is not walked again.
+	def __init__(self, dbpath):
+		self.db = sqlite3.connect(dbpath)
+		self.db.execute("CREATE TABLE IF NOT EXISTS blobpaths (blobid TEXT, path TEXT, commitid TEXT, PRIMARY KEY (blobid, path, commitid))")
+		self.db.execute("CREATE TABLE IF NOT EXISTS tips (commitid TEXT PRIMARY KEY)")
+
+	def update(self, repo, datacommit):
+		tips = [row[0] for row in self.db.execute("SELECT commitid FROM tips")]
+		if datacommit.id.__str__() in tips:
+			return
+
+		# Tips which have been rewritten away can't be hidden from the walk
+		hidecommitids = [tip for tip in tips if isinstance(repo.get(tip), pygit2.Commit)]
+
+		for path, blobid, commit in repo.iter_data_versions(datacommit.id.__str__(), [], hidecommitids=hidecommitids):
+			self.db.execute("INSERT OR IGNORE INTO blobpaths VALUES (?, ?, ?)", (blobid.__str__(), path, commit.id.__str__()))
+
+		# Only keep the tips which aren't in the history of the new one
+		for tip in hidecommitids:
+			if repo.descendant_of(datacommit.id, pygit2.Oid(hex=tip.encode("ascii"))):
+				self.db.execute("DELETE FROM tips WHERE commitid = ?", (tip,))
+		self.db.execute("INSERT OR REPLACE INTO tips VALUES (?)", (datacommit.id.__str__(),))
+		self.db.commit()
+
+	def paths(self, blobid):
+		return [row[0] for row in self.db.execute("SELECT DISTINCT path FROM blobpaths WHERE blobid = ? ORDER BY path", (blobid.__str__(),))]
+
+
+class MetadataTreeOriginIndex:
+	version = 2
+
+	# Records, for each directory in the data history, the commits where it became a tree and
+	# where it stopped being one, with each commit's depth along its first-parent history and
+	# the latest merge along that history. Reads don't look past merges, so the commit where a
+	# directory appeared is the latest such event between the commit being looked at and its
+	# latest merge. Commits already indexed are not walked again.
+	def __init__(self, dbpath):
+		self.db = sqlite3.connect(dbpath)
+
+		# Rebuild indexes written by earlier versions, which didn't record merges
+		if self.db.execute("PRAGMA user_version").fetchone()[0] != MetadataTreeOriginIndex.version:
+			for table in ["commits", "treeevents", "tips"]:
+				self.db.execute("DROP TABLE IF EXISTS %s" % table)
+			self.db.execute("PRAGMA user_version = %d" % MetadataTreeOriginIndex.version)
+
+		self.db.execute("CREATE TABLE IF NOT EXISTS commits (commitid TEXT PRIMARY KEY, position INTEGER, lastmerge TEXT)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS treeevents (path TEXT, commitid TEXT, position INTEGER, added INTEGER)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS treeevents_path ON treeevents (path, position)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS tips (commitid TEXT PRIMARY KEY)")
+		self.db.commit()
+
+	# Returns (position, latest merge commit ID or None) for an indexed commit, or None
+	def get_commit(self, commitid):
+		return self.db.execute("SELECT position, lastmerge FROM commits WHERE commitid = ?", (commitid.__str__(),)).fetchone()
+
+	def get_position(self, commitid):
+		row = self.get_commit(commitid)
+		return row[0] if row is not None else None
+
+	def update(self, repo, datacommit):
+		if self.get_position(datacommit.id) is not None:
+			return
+
+		try:
+			self.update_unchecked(repo, datacommit)
+			self.db.commit()
+		except:
+			self.db.rollback()
+			raise
+
+	def update_unchecked(self, repo, datacommit):
+		# Tips which have been rewritten away can't be hidden from the walk
+		tips = [row[0] for row in self.db.execute("SELECT commitid FROM tips")]
+		hidecommitids = [tip for tip in tips if isinstance(repo.get(tip), pygit2.Commit)]
+
+		walker = repo.walk(datacommit.id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+		for hidecommitid in hidecommitids:
+			walker.hide(hidecommitid)
+
+		for commit in walker:
+			repo.stats.record("commitswalked")
+
+			# Commits reached again after a tip was pruned are already indexed
+			if self.get_position(commit.id) is not None:
+				continue
+
+			if len(commit.parents) > 0:
+				parentcommit = commit.parents[0]
+				position, lastmerge = self.get_commit(parentcommit.id)
+				position += 1
+				parenttree = parentcommit.tree
+			else:
+				position, lastmerge = 0, None
+				parenttree = None
+
+			if len(commit.parents) > 1:
+				lastmerge = commit.id.__str__()
+
+			self.db.execute("INSERT INTO commits VALUES (?, ?, ?)", (commit.id.__str__(), position, lastmerge))
+			for path, added in repo.iter_tree_directory_changes(parenttree, commit.tree):
+				self.db.execute("INSERT INTO treeevents VALUES (?, ?, ?, ?)", (path, commit.id.__str__(), position, 1 if added else 0))
+
+		# Only keep the tips which still exist and aren't in the history of the new one
+		for tip in tips:
+			if tip not in hidecommitids or repo.descendant_of(datacommit.id, pygit2.Oid(hex=tip.encode("ascii"))):
+				self.db.execute("DELETE FROM tips WHERE commitid = ?", (tip,))
+		self.db.execute("INSERT OR REPLACE INTO tips VALUES (?)", (datacommit.id.__str__(),))
+
+	# Looks for the commit where treepath became a tree in the first-parent history of
+	# currentcommit after its latest merge. Returns (commit ID, None) if it was found, or
+	# (None, merge commit ID) if the tree is older than the merge. Returns None if the index
+	# doesn't agree that treepath is a tree at currentcommit.
+	def find_origin(self, repo, treepath, currentcommit):
+		position, lastmerge = self.get_commit(currentcommit.id)
+		if lastmerge is not None:
+			lastmergeid = pygit2.Oid(hex=lastmerge.encode("ascii"))
+			lastmergeposition = self.get_position(lastmerge)
+		else:
+			lastmergeid, lastmergeposition = None, -1
+
+		# Positions are only comparable along one first-parent history, so only events on
+		# commits between the merge and currentcommit count
+		rows = self.db.execute("SELECT commitid, added FROM treeevents WHERE path = ? AND position > ? AND position <= ? ORDER BY position DESC", (treepath, lastmergeposition, position))
+		for commitid, added in rows:
+			eventcommitid = pygit2.Oid(hex=commitid.encode("ascii"))
+			if eventcommitid != currentcommit.id and not repo.descendant_of(currentcommit.id, eventcommitid):
+				continue
+			if lastmergeid is not None and not repo.descendant_of(eventcommitid, lastmergeid):
+				continue
+
+			# The latest event should be the one that made it a tree
+			return (eventcommitid, None) if added else None
+
+		if lastmergeid is None:
+			return None
+		return None, lastmergeid
+
+
+class MetadataBloomFilter:
+	magic = "MGBF"
+	header = struct.Struct(">4sIIII")
+	false_positive_rate = 0.01
+	capacity_minimum = 16
+
+	# A Bloom filter sized for capacity keys. Keys can be added but never removed, so
+	# a key that is not in the filter is definitely not in the set it was built from.
+	def __init__(self, capacity, nbits=None, nhashes=None, count=0, bits=None):
+		self.capacity = max(capacity, MetadataBloomFilter.capacity_minimum)
+
+		if nbits is None:
+			nbits = int(math.ceil(-self.capacity * math.log(MetadataBloomFilter.false_positive_rate) / (math.log(2) ** 2)))
+		if nhashes is None:
+			nhashes = max(1, int(round(float(nbits) / self.capacity * math.log(2))))
+
+		self.nbits = nbits
+		self.nhashes = nhashes
+		self.count = count
+		self.bits = bits if bits is not None else bytearray((nbits + 7) // 8)
+
+	@staticmethod
+	def key(*parts):
+		key = "\0".join(parts)
+		if isinstance(key, unicode):
+			key = key.encode("utf-8")
+		return key
+
+	def positions(self, key):
+		# Double hashing using two halves of one digest
+		h1, h2 = struct.unpack(">QQ", hashlib.sha1(key).digest()[0:16])
+		h2 |= 1
+		return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+	def add(self, key):
+		for position in self.positions(key):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, key):
+		for position in self.positions(key):
+			if not self.bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+	def is_full(self):
+		return self.count > self.capacity
+
+	def serialise(self):
+		return MetadataBloomFilter.header.pack(MetadataBloomFilter.magic, self.nbits, self.nhashes, self.count, self.capacity) + bytes(self.bits)
+
+	@staticmethod
+	def deserialise(data):
+		magic, nbits, nhashes, count, capacity = MetadataBloomFilter.header.unpack_from(data)
+		if magic != MetadataBloomFilter.magic:
+			raise MetadataFileFormatError("Bloom filter has an unexpected format")
+		return MetadataBloomFilter(capacity, nbits, nhashes, count, bytearray(data[MetadataBloomFilter.header.size:]))
+
+
+# The Bloom filters for one metadata commit. They are stored as a commit on their own
+# reference containing the ID of the metadata commit they describe ('source'), whether
+# data commit IDs were included ('commitids') and one filter blob for each data directory,
+# holding the (path, stream) and optionally (path, stream, data commit) pairs for the paths in it.
+class MetadataBloomIndex:
+	filters_dir = "filters"
+
+	# Filters are deserialised when first used and kept in filters, which can be passed in to
+	# share them between indexes for the same commit
+	def __init__(self, repo, commit, filters=None):
+		self.repo = repo
+		self.commit = commit
+		self.source = repo[commit.tree["source"].id].data.strip()
+		self.withcommitids = repo[commit.tree["commitids"].id].data.strip() == "1"
+		self.filters = filters if filters is not None else {}
+
+	@staticmethod
+	def filter_path(path):
+		directory = os.path.dirname(path)
+		if isinstance(directory, unicode):
+			directory = directory.encode("utf-8")
+		digest = hashlib.sha1(directory).hexdigest()
+		return os.path.join(MetadataBloomIndex.filters_dir, digest[0:2], digest[2:])
+
+	def get_filter(self, filterpath):
+		if filterpath not in self.filters:
+			try:
+				self.filters[filterpath] = MetadataBloomFilter.deserialise(self.repo[self.commit.tree[filterpath].id].data)
+			except KeyError:
+				self.filters[filterpath] = None
+		return self.filters[filterpath]
+
+	# Returns False if there is definitely no metadata for the path and stream
+	# (and data commit if given and the index includes them)
+	def may_contain(self, path, streamname, datacommitid=None):
+		bloomfilter = self.get_filter(MetadataBloomIndex.filter_path(path))
+		if bloomfilter is None:
+			return False
+
+		if datacommitid is not None and self.withcommitids:
+			return MetadataBloomFilter.key(path, streamname, datacommitid) in bloomfilter
+		else:
+			return MetadataBloomFilter.key(path, streamname) in bloomfilter
+
+
+class MetadataBundle:
+	signature = "# metagit bundle v1\n"
+	record = struct.Struct(">B20sI")
+
+	# Writes the header and then each object as its type, raw ID and zlib compressed data
+	@staticmethod
+	def write(outfile, repo, header, objectids):
+		outfile.write(MetadataBundle.signature)
+		outfile.write(json.dumps(header, sort_keys=True) + "\n")
+		for objectid in objectids:
+			objecttype, objectdata = repo.read(objectid)
+			compressed = zlib.compress(objectdata)
+			outfile.write(MetadataBundle.record.pack(objecttype, objectid.raw, len(compressed)))
+			outfile.write(compressed)
+
+	@staticmethod
+	def read_header(infile):
+		if infile.readline() != MetadataBundle.signature:
+			raise MetadataFileFormatError("Not a metagit bundle")
+		try:
+			return json.loads(infile.readline())
+		except ValueError:
+			raise MetadataFileFormatError("Bundle header could not be read")
+
+	# Yields (type, id, data) for each object after the header
+	@staticmethod
+	def read_objects(infile, count):
+		for i in range(count):
+			recordheader = infile.read(MetadataBundle.record.size)
+			if len(recordheader) != MetadataBundle.record.size:
+				raise MetadataFileFormatError("Bundle is truncated")
+			objecttype, rawid, length = MetadataBundle.record.unpack(recordheader)
+			compressed = infile.read(length)
+			if len(compressed) != length:
+				raise MetadataFileFormatError("Bundle is truncated")
+			yield objecttype, pygit2.Oid(raw=rawid), zlib.decompress(compressed)
+
+
+class MetadataSnapshot:
+
+	# Pins the metadata commits that reads use, and the root tree made from them, while
+	# MetadataRepository.pin_metadata() is active. Each reference is resolved the first time it
+	# is read, so every read in the operation sees the same metadata, even if the references
+	# move, without resolving them again. A missing metadata branch is remembered as well. Reads
+	# see the metadata as of asof if it is given, otherwise as of the repository's as-of point.
+	def __init__(self, repo, asof=None):
+		self.repo = repo
+		self.asof = asof if asof is not None else repo.asof
+		self.clear()
+
+	# Forget the pinned commits, e.g. after a write, so the next read resolves them again
+	def clear(self):
+		self.commits = {}
+		self.tree = None
+		self.bloomindex = None
+		self.bloomindexloaded = False
+		self.replicasynced = False
+
+	def get_commit(self, readref):
+		if readref not in self.commits:
+			try:
+				self.commits[readref] = self.repo.resolve_metadata_read_commit(readref, asof=self.asof)
+			except NoMetadataBranchError:
+				self.commits[readref] = None
+
+		if self.commits[readref] is None:
+			raise NoMetadataBranchError("No metadata could be found")
+		return self.commits[readref]
+
+	def get_tree(self):
+		if self.tree is None:
+			self.tree = self.repo.build_metadata_read_tree()
+		return self.tree
+
+
 class TextColor:
 	Red = '\033[31m'
 	Reset = '\033[0m'
@@ -99,6 +834,13 @@ class DataRevisionMetadataSearchMethod:
 	SearchBackForEarlierMetadataAllowed = 1  # FindAndUpdateEarlierMetadata
 	UseRevisionSpecifiedOnly = 2             # CreateNewMetadata
 
+
+class MetadataStatus:
+	applies = "applies"      # Metadata was defined on the commit being checked
+	inherited = "inherited"  # Metadata propagated from an earlier commit
+	stale = "stale"          # Metadata exists but the file has been modified since
+	absent = "absent"        # No metadata applies to the file
+
 # Parses path strings with the format 's+[REV]:path[:stream]'.
 # Accepts arguments: the path, whether the search is required,
 # a default base path for a relative path (otherwise defaults to current dir)
@@ -193,11 +935,12 @@ class MetadataRepository(pygit2.Repository):
 	data_name = uuid.uuid5(uuid.NAMESPACE_X500, 'data').__str__()
 	metadata_name = uuid.uuid5(uuid.NAMESPACE_X500, 'metadata').__str__()
 	metadataref_default = "refs/heads/metadata"
+	bloomref_prefix = "refs/metagit/bloom/"
 
 	# We need two things to find the metadata:
 	# 1 - A path to the file
 	# 2 - A reference to a git commit for the metadata
-	def __init__(self, repo_path, metadataref=metadataref_default, debug=False):
+	def __init__(self, repo_path, metadataref=metadataref_default, debug=False, stats=None, statcache=True, fallbackrefs=None, asof=None, replica=False, followrenames=False, treeindex=True):
 
 		# Initialise repository base class
 		pygit2.Repository.__init__(self, repo_path)
@@ -209,12 +952,117 @@ class MetadataRepository(pygit2.Repository):
 		# Save metadataref
 		self.metadataref = metadataref
 
+		# Reads fall through to these references, in order, when metadataref doesn't have the metadata
+		self.fallbackrefs = list(fallbackrefs or [])
+		self.layercache = {}
+		self.layerdb = None
+
+		# Reads see the metadata as it was at this metadata commit or time if it is set
+		self.asof = asof
+		self.asofcommits = {}
+		self.timeindex = None
+
 		# Save miscellaneous arguments
 		self.debug = debug
 
+		# Count and time the repository operations we carry out
+		self.stats = stats or MetadataRepositoryStats()
+
+		# Working directory files are hashed through a persistent stat cache if enabled
+		self.usestatcache = statcache
+		self.statcache = None
+
+		# Bloom filters are loaded when first needed. The deserialised filters are kept by Bloom
+		# commit ID, which may be shared between handles (see MetadataRepositoryPool).
+		self.bloomindex = None
+		self.bloomfiltercache = {}
+
+		# Reads are answered from the SQLite replica of metadataref if enabled
+		self.usereplica = replica
+		self.replica = None
+
+		# Reads look for metadata recorded under a file's earlier paths if enabled
+		self.followrenames = followrenames
+		self.blobpathindex = None
+
+		# Where directories first appeared is looked up in an index rather than by walking history if enabled
+		self.usetreeindex = treeindex
+		self.treeoriginindex = None
+
+		# Parsed JSON documents for setvalue/getvalue
+		self.documentcache = MetadataDocumentCache()
+
+		# Metadata commits pinned by pin_metadata() for the reads in an operation
+		self.snapshot = None
+
+		# Writes are committed immediately unless enable_write_buffer() is called
+		self.writebuffer = None
+		self.flushregistered = False
+
 		# Print debug info
 		self.debugmsg("Repo=" + self.path)
 		self.debugmsg("Metadata ref=" + self.metadataref)
+		for fallbackref in self.fallbackrefs:
+			self.debugmsg("Fallback metadata ref=" + fallbackref)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		# Don't lose pending writes when leaving a with block
+		self.flush()
+
+	# Reads inside the with block all use the same metadata commits (see MetadataSnapshot), as
+	# of asof if it is given. Nested blocks share the outermost snapshot.
+	@contextlib.contextmanager
+	def pin_metadata(self, asof=None):
+		if self.snapshot is not None:
+			if asof is not None and asof != self.snapshot.asof:
+				raise ParameterError("The as-of point can't be changed inside a pinned operation")
+			yield self.snapshot
+			return
+
+		# Buffered writes which have waited too long are committed before the next operation
+		if self.writebuffer is not None and self.writebuffer.is_full():
+			self.flush()
+
+		self.snapshot = MetadataSnapshot(self, asof=asof)
+		try:
+			yield self.snapshot
+		finally:
+			self.snapshot = None
+			self.save_stat_cache()
+
+	# INSTRUMENTED REPOSITORY FUNCTIONS
+
+	def revparse_single(self, spec):
+		with self.stats.timed("revparse"):
+			return pygit2.Repository.revparse_single(self, spec)
+
+	def create_blob(self, data):
+		with self.stats.timed("blobscreated"):
+			return pygit2.Repository.create_blob(self, data)
+
+	def create_commit(self, *args):
+		with self.stats.timed("commitscreated"):
+			return pygit2.Repository.create_commit(self, *args)
+
+	def write_treebuilder(self, treebuilder):
+		with self.stats.timed("treeswritten"):
+			return treebuilder.write()
+
+	# Diff a commit against its parent, or against an empty tree if parentcommit is None
+	def diff_commit_to_parent(self, currentcommit, parentcommit):
+		with self.stats.timed("treediffs"):
+			if parentcommit is None:
+				return currentcommit.tree.diff_to_tree(swap=True)
+			else:
+				return currentcommit.tree.diff_to_tree(parentcommit.tree, swap=True)
+
+	def walk_commits(self, commitid, sortmode):
+		for commit in self.walk(commitid, sortmode):
+			self.stats.record("commitswalked")
+			yield commit
 
 	@staticmethod
 	def errormsg(msg):
@@ -224,6 +1072,51 @@ class MetadataRepository(pygit2.Repository):
 		if self.debug:
 			MetadataRepository.errormsg(msg)
 
+	# Returns the path of a file used to store metagit's caches inside the git directory
+	# The caches are only an optimisation, so if the git directory can't be written (e.g. it is
+	# read-only or shared) an in-memory database is used, which lasts as long as the process
+	def get_cache_path(self, name):
+		cachedir = os.path.join(self.path, "metagit")
+		try:
+			if not os.path.isdir(cachedir):
+				os.makedirs(cachedir)
+		except (OSError, IOError), e:
+			self.debugmsg("Cache directory unavailable: %s" % e)
+			return ":memory:"
+
+		if not os.access(cachedir, os.W_OK):
+			self.debugmsg("Cache directory '%s' is not writable" % cachedir)
+			return ":memory:"
+		return os.path.join(cachedir, name)
+
+	def get_stat_cache(self):
+		if self.statcache is None:
+			self.statcache = MetadataStatCache(self.get_cache_path("statcache.sqlite"))
+			atexit.register(self.save_stat_cache)
+		return self.statcache
+
+	# Commits pending stat cache entries, so a long-running process doesn't keep the cache locked
+	def save_stat_cache(self):
+		if self.statcache is None:
+			return
+		try:
+			self.statcache.save()
+		except sqlite3.Error, e:
+			self.debugmsg("Stat cache unavailable: %s" % e)
+
+	# Find the blob ID of a file in the working directory, avoiding reading it if possible
+	def hash_worktree_file(self, path):
+		if not self.usestatcache:
+			return pygit2.hashfile(path)
+
+		# The cache is only an optimisation so fall back to reading the file if it can't be used,
+		# e.g. when another process has it locked
+		try:
+			return self.get_stat_cache().hashfile(os.path.abspath(path))
+		except sqlite3.Error, e:
+			self.debugmsg("Stat cache unavailable: %s" % e)
+			return pygit2.hashfile(path)
+
 	@staticmethod
 	def discover_repository(req_path, metadataref):
 		parsedpath = MetadataPath(req_path, path_requires_search=False)
@@ -260,9 +1153,117 @@ class MetadataRepository(pygit2.Repository):
 			raise KeyError("Could not find a Git repository")
 
 
-	def save_metadata_blob(self, pathreq, newdata, force=False):
+	# Returns the parsed path, the data commit and the metadata tree path that a write to pathreq goes to
+	def get_metadata_save_path(self, pathreq):
 		path = self.parse_path_parameter(pathreq, fixdatarev=True)
 
+		# Writes start from the latest metadata, not a pinned commit, so other writes aren't lost
+		if self.snapshot is not None:
+			self.snapshot.clear()
+
+		# Find the data commit
+		datacommitwithmetadata = self.find_data_commit_with_metadata(path, returncommitwhennometadata=True)
+
+		# If we don't have a data commit then metadata must not be defined and first commit could not be found
+		if datacommitwithmetadata is None:
+			raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
+
+		parentspath = self.get_metadata_blob_path(path.metadatapath, path.streamname, datacommitwithmetadata.id.__str__())
+		return path, datacommitwithmetadata, parentspath
+
+	def save_metadata_blob(self, pathreq, newdata, force=False):
+		path, datacommitwithmetadata, parentspath = self.get_metadata_save_path(pathreq)
+
+		with self.stats.phase("write"):
+			# Save the object into the repository
+			newblobid = self.create_blob(newdata)
+
+			# Queue the write if we are buffering, committing once the buffer is full
+			if self.writebuffer is not None:
+				self.queue_write(parentspath, newblobid, self[newblobid].size, path.metadatapath, force=force)
+				print "Metadata for '%s:%s' queued for stream '%s' in '%s' branch" % (datacommitwithmetadata.id, path.metadatapath, path.streamname, self.metadataref)
+
+				if self.writebuffer.is_full():
+					return self.flush()
+				else:
+					return None
+
+			parentslist = parentspath.split(os.sep)
+			toptreeid = self.write_tree_hierarchy(parentslist, newblobid, force=force)
+
+			# Create a commit
+			commitid = self.commit_metadata_tree(toptreeid, "Updated metadata for " + path.metadatapath)
+
+		print "Metadata for '%s:%s' saved to stream '%s' in '%s' branch" % (datacommitwithmetadata.id, path.metadatapath, path.streamname, self.metadataref)
+
+		return commitid
+
+	# Returns the parsed JSON metadata for pathreq. The result is cached so must not be modified.
+	def get_metadata_document(self, pathreq):
+		return self.documentcache.get(self.find_metadata_blob(pathreq))
+
+	# Applies each (pathreq, patch) in patches to the JSON metadata at that path as a JSON merge
+	# patch, writing every updated document in a single commit
+	def update_metadata_documents(self, patches, force=False):
+		entries = {}
+		datapaths = []
+		documents = {}  # Documents waiting to be committed, so later patches to a path apply on top
+		for pathreq, patch in patches:
+			path, datacommitwithmetadata, parentspath = self.get_metadata_save_path(pathreq)
+			if parentspath in documents:
+				document = documents[parentspath]
+			else:
+				try:
+					document = self.get_metadata_document(pathreq)
+				except (MetadataBlobNotFoundError, NoMetadataBranchError):
+					document = {}
+			document = MetadataDocumentCache.apply_merge_patch(document, patch)
+
+			with self.stats.phase("write"):
+				newdata = json.dumps(document)
+				newblobid = self.create_blob(newdata)
+			self.documentcache.add(newblobid, document)
+
+			if self.writebuffer is not None:
+				self.queue_write(parentspath, newblobid, len(newdata), path.metadatapath, force=force)
+				print "Metadata for '%s:%s' queued for stream '%s' in '%s' branch" % (datacommitwithmetadata.id, path.metadatapath, path.streamname, self.metadataref)
+			else:
+				entries[parentspath] = newblobid
+				documents[parentspath] = document
+				datapaths.append(path.metadatapath)
+				print "Metadata for '%s:%s' saved to stream '%s' in '%s' branch" % (datacommitwithmetadata.id, path.metadatapath, path.streamname, self.metadataref)
+
+		if self.writebuffer is not None:
+			return self.flush() if self.writebuffer.is_full() else None
+
+		if len(entries) == 0:
+			return None
+
+		with self.stats.phase("write"):
+			try:
+				basetree = self.get_metadata_commit(self.metadataref).tree
+			except NoMetadataBranchError:
+				basetree = None
+
+			toptreeid = self.write_tree_entries(basetree, entries, force=force)
+
+			return self.commit_metadata_tree(toptreeid, MetadataRepository.get_update_message(datapaths))
+
+	# The commit message for writes to datapaths
+	@staticmethod
+	def get_update_message(datapaths):
+		datapaths = sorted(set(datapaths))
+		if len(datapaths) == 1:
+			return "Updated metadata for " + datapaths[0]
+		else:
+			return "Updated metadata for %d paths\n\n%s" % (len(datapaths), "\n".join(datapaths))
+
+	# Commits a new metadata tree on top of metadataref, creating the reference if
+	# it does not exist yet. Any extra parents are added after the current commit.
+	def commit_metadata_tree(self, treeid, message, extraparentids=None):
+		if self.get_read_asof() is not None:
+			raise MetadataWriteError("Metadata can't be written while reading as of '%s'" % self.get_read_asof())
+
 		# Branch might not exist yet, so try to find the metadata branch,
 		# otherwise create a new one
 		try:
@@ -277,29 +1278,14 @@ class MetadataRepository(pygit2.Repository):
 			metadatareftoupdate = None
 			commitparentids = []
 
-		# Find the data commit
-		datacommitwithmetadata = self.find_data_commit_with_metadata(path, returncommitwhennometadata=True)
-
-		# If we don't have a data commit then metadata must not be defined and first commit could not be found
-		if datacommitwithmetadata is None:
-			raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
-
-		# Save the object into the repository
-		newblobid = self.create_blob(newdata)
-
-		# Save metadata tree
-		parentspath = self.get_metadata_blob_path(path.metadatapath, path.streamname, datacommitwithmetadata.id.__str__())
-		parentslist = parentspath.split(os.sep)
-		toptreeid = self.write_tree_hierarchy(parentslist, newblobid, force=force)
-
 		# Create a commit
 		commitid = self.create_commit(
 			metadatareftoupdate,
 			pygit2.Signature('Mark', 'cms4@soton.ac.uk'),
 			pygit2.Signature('Mark', 'cms4@soton.ac.uk'),
-			"Updated metadata for " + path.metadatapath,
-			toptreeid,
-			commitparentids)
+			message,
+			treeid,
+			commitparentids + list(extraparentids or []))
 		self.debugmsg("Commit %s created." % (commitid))
 
 		# Create a reference if one doesn't exit
@@ -307,44 +1293,228 @@ class MetadataRepository(pygit2.Repository):
 			head_ref = self.create_reference(self.metadataref, commitid)
 			self.debugmsg("Reference '%s' created" % self.metadataref)
 
-		print "Metadata for '%s:%s' saved to stream '%s' in '%s' branch" % (datacommitwithmetadata.id, path.metadatapath, path.streamname, self.metadataref)
+		# Keep the Bloom filters up to date if they are in use
+		if self.load_bloom_index() is not None:
+			self.update_bloom_index()
+
+		# Later reads in a pinned operation should see this write
+		if self.snapshot is not None:
+			self.snapshot.clear()
 
 		return commitid
 
+	# WRITE BUFFER FUNCTIONS
+
+	# Start collecting writes in memory. They are committed together as a single
+	# commit when any of the limits is reached, when flush() is called, when leaving a
+	# with block or when the interpreter exits cleanly. Pass None to disable a limit. The
+	# limits are checked on each write and when each read or write operation starts (see
+	# pin_metadata()), so maxage is the longest writes wait while the repository is in use.
+	def enable_write_buffer(self, maxcount=MetadataWriteBuffer.count_default, maxbytes=MetadataWriteBuffer.bytes_default, maxage=MetadataWriteBuffer.age_default):
+		if self.writebuffer is None:
+			self.writebuffer = MetadataWriteBuffer(maxcount, maxbytes, maxage)
+		else:
+			self.writebuffer.maxcount = maxcount
+			self.writebuffer.maxbytes = maxbytes
+			self.writebuffer.maxage = maxage
+
+		if not self.flushregistered:
+			atexit.register(self.flush)
+			self.flushregistered = True
+
+	def disable_write_buffer(self):
+		commitid = self.flush()
+		self.writebuffer = None
+		return commitid
+
+	# Adds a write to the buffer, checking it can be committed so a bad write fails here rather
+	# than when the whole buffer is flushed. Forcing applies to a whole commit, so the buffer is
+	# flushed first if this write's force is different from the writes already queued.
+	def queue_write(self, metadatablobpath, blobid, size, datapath, force=False):
+		if self.get_read_asof() is not None:
+			raise MetadataWriteError("Metadata can't be written while reading as of '%s'" % self.get_read_asof())
+
+		if len(self.writebuffer) > 0 and self.writebuffer.force != force:
+			self.flush()
+
+		if not force:
+			try:
+				tree = self.get_metadata_commit(self.metadataref).tree
+			except NoMetadataBranchError:
+				tree = None
+
+			for entryname in metadatablobpath.split(os.sep)[:-1]:
+				if tree is None or entryname not in tree:
+					break
+				existingentry = tree[entryname]
+				if existingentry.type != "tree":
+					raise MetadataWriteError("Expected Tree at '%s', got %s" % (entryname, existingentry.type))
+				tree = self[existingentry.id]
+
+		self.writebuffer.add(metadatablobpath, blobid, size, datapath, force=force)
+
+	# Commit any pending writes, returning the new commit ID or None if nothing was pending
+	def flush(self):
+		if self.writebuffer is None or len(self.writebuffer) == 0:
+			return None
+
+		with self.stats.phase("write"):
+			try:
+				basetree = self.get_metadata_commit(self.metadataref).tree
+			except NoMetadataBranchError:
+				basetree = None
+
+			# A batch which can't be committed is dropped, otherwise every later write would fail too
+			try:
+				toptreeid = self.write_tree_entries(basetree, self.writebuffer.entries, force=self.writebuffer.force)
+				commitid = self.commit_metadata_tree(toptreeid, MetadataRepository.get_update_message(self.writebuffer.datapaths))
+			except MetadataWriteError, e:
+				count = len(self.writebuffer)
+				self.writebuffer.clear()
+				raise MetadataWriteError("%s (%d queued metadata entries were dropped)" % (e, count))
+		print "%d metadata entries committed to '%s' branch" % (len(self.writebuffer), self.metadataref)
+
+		self.writebuffer.clear()
+		return commitid
+
+	# Writes all of the entries (a dictionary of path to blob ID) into basetree, which can
+	# be None for a new tree, and returns the ID of the new top level tree. Each tree on
+	# the way is only rewritten once regardless of how many entries it contains. An entry
+	# with an ID of None is removed, along with any trees that are left empty.
+	def write_tree_entries(self, basetree, entries, force=False):
+		treeid = self.write_subtree_entries(basetree, entries, force=force)
+		if treeid is None:
+			# Everything was removed
+			treeid = self.write_treebuilder(self.TreeBuilder())
+		return treeid
+
+	def write_subtree_entries(self, basetree, entries, force=False):
+		if basetree is None:
+			treebuilder = self.TreeBuilder()
+		else:
+			treebuilder = self.TreeBuilder(basetree)
+
+		# Group the entries by the first component of their path
+		subtreeentries = {}
+		for entrypath, entryid in entries.items():
+			entryname, sep, remainder = entrypath.partition(os.sep)
+			if sep:
+				subtreeentries.setdefault(entryname, {})[remainder] = entryid
+			elif entryid is not None:
+				treebuilder.insert(entryname, entryid, pygit2.GIT_FILEMODE_BLOB)
+			elif treebuilder.get(entryname) is not None:
+				treebuilder.remove(entryname)
+
+		for entryname, childentries in subtreeentries.items():
+			subtree = None
+			if basetree is not None and entryname in basetree:
+				existingentry = basetree[entryname]
+				if existingentry.type == "tree":
+					subtree = self[existingentry.id]
+				elif not force:
+					raise MetadataWriteError("Expected Tree at '%s', got %s" % (entryname, existingentry.type))
+
+			subtreeid = self.write_subtree_entries(subtree, childentries, force=force)
+			if subtreeid is not None:
+				treebuilder.insert(entryname, subtreeid, pygit2.GIT_FILEMODE_TREE)
+			elif treebuilder.get(entryname) is not None:
+				treebuilder.remove(entryname)
+
+		if len(treebuilder) == 0:
+			return None
+		else:
+			return self.write_treebuilder(treebuilder)
+
 	def find_metadata_blob(self, pathreq):
+		datacommitid, blobid = self.resolve_metadata_blob_id(pathreq)
+		return self[blobid]
 
-		# Parse path parameter
-		path = self.parse_path_parameter(pathreq, fixdatarev=True)
+	# Returns the ID of the data commit whose metadata applies to pathreq and the ID of the
+	# metadata blob, without reading the blob
+	def resolve_metadata_blob_id(self, pathreq):
 
-		# Find metadata branch
-		metadatacommit = self.get_metadata_commit(self.metadataref)
+		with self.pin_metadata():
+			# Parse path parameter
+			path = self.parse_path_parameter(pathreq, fixdatarev=True)
 
-		# Find the data commit with the metadata
-		datacommitwithmetadata = self.find_data_commit_with_metadata(path, returncommitwhennometadata=False)
+			# Find metadata branch (it may not exist yet if writes are still pending in the buffer)
+			if self.writebuffer is None or len(self.writebuffer) == 0:
+				metadatatree = self.get_metadata_read_tree()
 
-		if datacommitwithmetadata is None:
-			raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
+			# Answer misses without walking back through history if the Bloom filters rule the path out
+			if not self.followrenames and self.metadata_definitely_absent(path.metadatapath, path.streamname):
+				raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
 
-		# Get the blob
-		return self.get_metadata_blob(path.metadatapath, path.streamname, datacommitwithmetadata.id.__str__())
+			# Find the data commit with the metadata
+			datacommitwithmetadata = self.find_data_commit_with_metadata(path, returncommitwhennometadata=False)
 
-	def get_metadata_blob(self, metadatapath, streamname, datacommitwithmetadata):
-		# Find metadata branch
-		metadatacommit = self.get_metadata_commit(self.metadataref)
+			# Get the blob
+			try:
+				if datacommitwithmetadata is None:
+					raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
+				return datacommitwithmetadata.id.__str__(), self.get_metadata_blob_id(path.metadatapath, path.streamname, datacommitwithmetadata.id.__str__())
+			except MetadataBlobNotFoundError:
+				# The file may have metadata from before it was moved
+				renamedmetadata = self.find_renamed_metadata_blob_id(path) if self.followrenames else None
+				if renamedmetadata is None:
+					raise
+				return renamedmetadata
+
+	def get_metadata_blob_id(self, metadatapath, streamname, datacommitwithmetadata):
+		metadatablobpath = self.get_metadata_blob_path(metadatapath, streamname, datacommitwithmetadata)
+
+		with self.stats.phase("metadata lookup"):
+			metadatablobid = self.lookup_metadata_blob_id(metadatablobpath)
+		if metadatablobid is None:
+			raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
+		else:
+			return metadatablobid
 
+	def get_metadata_blob(self, metadatapath, streamname, datacommitwithmetadata):
 		# Generate the path from the object requested, stream name and revision
 		metadatablobpath = self.get_metadata_blob_path(metadatapath, streamname, datacommitwithmetadata)
 
 		# Try to get the blob
-		try:
-			# Get the blob
-			metadatablob = self.revparse_single("%s:%s" % (metadatacommit.id, metadatablobpath))
-			if not isinstance(metadatablob, pygit2.Blob):
-				raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
-			else:
-				return metadatablob
-		except KeyError:
+		metadatablob = self.lookup_metadata_blob(metadatablobpath)
+		if metadatablob is None:
 			raise MetadataBlobNotFoundError("Could not find metadata blob in the tree")
+		else:
+			return metadatablob
+
+	# Returns the blob at metadatablobpath, looking at any pending buffered writes before the
+	# metadata branch, or None if there is no blob at that path
+	def lookup_metadata_blob(self, metadatablobpath):
+		with self.stats.phase("metadata lookup"):
+			return self.lookup_metadata_blob_unphased(metadatablobpath)
+
+	def lookup_metadata_blob_unphased(self, metadatablobpath):
+		metadatablobid = self.lookup_metadata_blob_id(metadatablobpath)
+		return self[metadatablobid] if metadatablobid is not None else None
+
+	# Returns the ID of the blob at metadatablobpath without reading it, or None if there isn't one
+	def lookup_metadata_blob_id(self, metadatablobpath):
+		if self.writebuffer is not None and metadatablobpath in self.writebuffer.entries:
+			return self.writebuffer.entries[metadatablobpath]
+
+		replica = self.get_replica()
+		if replica is not None:
+			parsedpath = self.parse_metadata_blob_path(metadatablobpath)
+			blobid = replica.lookup(self.metadataref, *parsedpath) if parsedpath is not None else None
+			return pygit2.Oid(hex=blobid.encode("ascii")) if blobid is not None else None
+
+		# Find metadata branch
+		try:
+			metadatatree = self.get_metadata_read_tree()
+		except NoMetadataBranchError:
+			return None
+
+		metadataentry = self.get_tree_entry(metadatatree, metadatablobpath)
+		if metadataentry is None:
+			return None
+		elif metadataentry[1] != "blob":
+			raise MetadataBlobNotFoundError("Something wrong with the metadata at " + metadatablobpath)
+		else:
+			return metadataentry[0]
 
 	def copy_metadata(self, sourcepathreq, destpathreq, force=False):
 
@@ -382,70 +1552,98 @@ class MetadataRepository(pygit2.Repository):
 		return newcommitid
 
 	# LIST FUNCTIONS
-	def list_metadata_in_stream(self, pathreq):
+	# Yields a MetadataStreamRecord for each version of the metadata in the path's stream. The data
+	# commits are looked up by ID rather than parsed as revisions, and the path is only resolved
+	# once for each distinct data tree, so the cost grows with the number of distinct versions.
+	def iter_metadata_stream_records(self, pathreq):
 		# Get the path or generate it if not specified
-		path = self.parse_path_parameter(pathreq, fixdatarev=False, path_requires_search=False)
-
-		normpath = os.path.normpath(path.metadatapath)
-
-		print "\n* Listing metadata for file path: '{}'\n* Data branch specified: '{}'\n* Stream specified: {}".format(normpath, path.datarev, path.streamname)
+		if isinstance(pathreq, MetadataPath):
+			path = pathreq
+		else:
+			path = self.parse_path_parameter(pathreq, fixdatarev=False, path_requires_search=False)
 
 		# Find the parents of the specified datarev
+		dataitemcommitparents = set()
 		if path.datarev is not None:
 			dataitemcommit = self.revparse_single("%s" % path.datarev)
-			dataitemcommitparents = [commit.id.__str__() for commit in self.walk(dataitemcommit.id, pygit2.GIT_SORT_REVERSE)]
-			self.debugmsg("parent commits %s " % dataitemcommitparents)
-
-		outputformatstr = "{:40} {:40} {:15} {:11} {!s:19}"
+			dataitemcommitparents = set(commit.id.__str__() for commit in self.walk_commits(dataitemcommit.id, pygit2.GIT_SORT_NONE))
 
 		# Retrieve the data item requested if we can find it
 		dataitemrequested = self.find_path_in_repository(path.datarev, path.metadatapath)
 
-		# Retrieve metadata node for the given path
-		metadatanode = self.get_metadata_stream(path.metadatapath, path.streamname)
-
-		matchingstrings = []
-		notmatchingstrings = []
+		# Retrieve the versions in the metadata stream for the given path
+		streamentries = self.get_metadata_stream_entries(path.metadatapath, path.streamname)
 
-		# Iterate around each metadata item defined for the given path
-		listofmetadataentryids = [metadataentry.name for metadataentry in metadatanode]
-		for datacommitwithmetadataid in listofmetadataentryids:
+		normpath = os.path.normpath(path.metadatapath)
+		dataitemsbytree = {}
+		for datacommitid, metadatablobid in streamentries:
+			record = MetadataStreamRecord(self, datacommitid, metadatablobid)
 
 			# If we couldn't find the data item in the repository then we can't look up its metadata
-			if dataitemrequested is None:
-				datacommitwithmetadatastr = "Matching data could not be found"
-				dataitemmatchesrequest = False
-				matchingdataidstr = "Matching data could not be found"
-			else:
+			if dataitemrequested is not None:
+				# Attempt to find data commit that metadata pertains to
+				datacommitwithmetadata = None
 				try:
-					# Attempt to find data commit that metadata pertains to
-					datacommitwithmetadata = self.get_data_commit(datacommitwithmetadataid)
-					datacommitwithmetadatastr = datetime.datetime.fromtimestamp(datacommitwithmetadata.commit_time)
+					datacommitwithmetadata = self.get(datacommitid)
+				except ValueError:
+					pass
+
+				if isinstance(datacommitwithmetadata, pygit2.Commit):
+					record.timestamp = datacommitwithmetadata.commit_time
 
 					# Attempt to find data item matching path
-					matchingdataitem = self.revparse_single("%s:%s" % (datacommitwithmetadataid, path.metadatapath))
+					treeid = datacommitwithmetadata.tree_id
+					if treeid not in dataitemsbytree:
+						try:
+							dataitemsbytree[treeid] = datacommitwithmetadata.tree[normpath]
+						except KeyError:
+							dataitemsbytree[treeid] = None
+					matchingdataentry = dataitemsbytree[treeid]
+
+					if matchingdataentry is not None:
+						record.dataid = matchingdataentry.id.__str__()
+						record.datatype = matchingdataentry.type
+						if isinstance(dataitemrequested, pygit2.Tree):
+							record.matches = matchingdataentry.type == "tree"
+						else:
+							record.matches = matchingdataentry.id == dataitemrequested.id
+
+			# The item can match, but not be from a parent commit
+			record.inheritable = record.matches and (path.datarev is not None) and (datacommitid in dataitemcommitparents)
+
+			yield record
+
+	def list_metadata_in_stream(self, pathreq, limit=None, jsonoutput=False):
+		path = self.parse_path_parameter(pathreq, fixdatarev=False, path_requires_search=False)
+		normpath = os.path.normpath(path.metadatapath)
 
-					if isinstance(dataitemrequested, pygit2.Tree):
-						dataitemmatchesrequest = isinstance(matchingdataitem, pygit2.Tree)
-						matchingdataidstr = "Path '%s'" % normpath
-					else:
-						dataitemmatchesrequest = (matchingdataitem.id == dataitemrequested.id)
-						matchingdataidstr = matchingdataitem.id
+		if not jsonoutput:
+			print "\n* Listing metadata for file path: '{}'\n* Data branch specified: '{}'\n* Stream specified: {}".format(normpath, path.datarev, path.streamname)
 
-				except (NoDataError, KeyError):
-					# Data could not be found
-					datacommitwithmetadatastr = "Matching data could not be found"
-					matchingdataidstr = "Matching data could not be found"
-					dataitemmatchesrequest = False
+		records = self.iter_metadata_stream_records(path)
+		if limit is not None:
+			records = itertools.islice(records, limit)
+
+		if jsonoutput:
+			for record in records:
+				print json.dumps(record.as_dict(), sort_keys=True)
+			return
 
-			# The item can match, but not be from a parent commit. These bools handle both scenarios
-			metadatainheritable = (dataitemrequested is not None) and (path.datarev is not None) and (datacommitwithmetadataid in dataitemcommitparents) and (dataitemmatchesrequest)
-			metadatainheritablestr = ("YES" if metadatainheritable else "NO")
-			matchingdatastr = ("YES" if dataitemmatchesrequest else "NO")
+		outputformatstr = "{:40} {:40} {:15} {:11} {!s:19}"
 
-			# if datarev is None or (dataitemmatchesrequest and metadatainheritable):
-			outputstring = outputformatstr.format(datacommitwithmetadataid, matchingdataidstr, matchingdatastr, metadatainheritablestr, datacommitwithmetadatastr)
-			if ((dataitemrequested is not None) or (path.datarev is None)) and dataitemmatchesrequest:
+		matchingstrings = []
+		notmatchingstrings = []
+
+		for record in records:
+			if record.dataid is None:
+				committedstr = "Matching data could not be found"
+				matchingdataidstr = "Matching data could not be found"
+			else:
+				committedstr = datetime.datetime.fromtimestamp(record.timestamp)
+				matchingdataidstr = "Path '%s'" % normpath if record.datatype == "tree" else record.dataid
+
+			outputstring = outputformatstr.format(record.datacommitid, matchingdataidstr, "YES" if record.matches else "NO", "YES" if record.inheritable else "NO", committedstr)
+			if record.matches:
 				matchingstrings.append(outputstring)
 			else:
 				notmatchingstrings.append(outputstring)
@@ -485,7 +1683,7 @@ class MetadataRepository(pygit2.Repository):
 
 		# Find the parents of the specified datarev
 		dataitemcommit = self.revparse_single("%s" % path.datarev)
-		dataitemcommitparents = [commit for commit in self.walk(dataitemcommit.id, pygit2.GIT_SORT_TIME)]
+		dataitemcommitparents = [commit for commit in self.walk_commits(dataitemcommit.id, pygit2.GIT_SORT_TIME)]
 
 		# Retrieve the data item requested if we can find it
 		dataitemrequested = self.find_path_in_repository(path.datarev, path.metadatapath)
@@ -550,37 +1748,1251 @@ class MetadataRepository(pygit2.Repository):
 		if not isinstance(tree, pygit2.Tree):
 			raise ParameterError("Tree expected")
 
-		# If we are at the top level, check if there is any metadata
-		if indent == 0:
-			metadataexists = self.metadata_name in tree
-			print ("%s /") % (metadataexists and "M" or "-")
+		for treepath, depth, streams in self.iter_metadata_objects(tree):
+			if depth == 0:
+				# If we are at the top level, show whether there is any metadata
+				if indent == 0:
+					print ("%s /") % (len(streams) > 0 and "M" or "-")
+			else:
+				print ("%s " + " " * (indent + depth - 1) + os.path.basename(treepath)) % (len(streams) > 0 and "M" or "-")
+
+	# Walks the metadata tree depth first without recursion, yielding (path, depth, streams) for
+	# each tree as it is reached. Each tree is loaded once, when it is visited, and trees deeper
+	# than maxdepth are never loaded. If streamname is given, streams only ever contains that stream.
+	def iter_metadata_objects(self, tree, subdir="", maxdepth=None, streamname=None):
+		stack = [(subdir, 0, tree)]
+		while len(stack) > 0:
+			treepath, depth, tree = stack.pop()
+			if not isinstance(tree, pygit2.Tree):
+				tree = self[tree]
+
+			# Find the streams in the metadata node if this tree has one
+			streams = []
+			if self.metadata_name in tree:
+				metadatanodeentry = tree[self.metadata_name]
+				if metadatanodeentry.type == "tree":
+					streams = [streamentry.name for streamentry in self[metadatanodeentry.id] if streamentry.type == "tree" and (streamname is None or streamentry.name == streamname)]
+
+			yield treepath, depth, streams
+
+			if maxdepth is not None and depth >= maxdepth:
+				continue
+
+			children = []
+			for entry in tree:
+				if entry.type == "tree":
+					# Ignore the metadata entry
+					if entry.name != self.metadata_name:
+						children.append((os.path.join(treepath, entry.name), depth + 1, entry.id))
+
+				# We shouldn't have any blobs so we'll ignore them
+				# (blobs should only exist in metadata nodes)
+				elif entry.type == "blob":
+					MetadataRepository.errormsg("Ignoring blob '%s'" % os.path.join(treepath, entry.name))
+
+				# We shouldn't have any other type of object so we'll ignore it
+				else:
+					MetadataRepository.errormsg("Ignoring entry '%s' of type '%s'" % (os.path.join(treepath, entry.name), entry.type))
+
+			# Push in reverse so the children come off the stack in tree order
+			stack.extend(reversed(children))
+
+	def list_metadata_objects(self, subdir="", maxdepth=None, streamname=None, jsonoutput=False):
+		# Find metadata branch
+		metadatatree = self.get_metadata_read_tree()
+
+		# Only load the trees leading to the subdirectory
+		subdir = os.path.normpath(subdir).strip(os.sep)
+		if subdir in ["", "."]:
+			subdir = ""
+
+		# Listing one stream only needs the paths, which the replica can give us without reading any trees
+		replica = self.get_replica() if streamname is not None else None
+		if replica is not None:
+			for treepath in replica.paths_with_stream(self.metadataref, streamname, subdir=subdir):
+				depth = len(os.path.relpath(treepath, subdir or ".").split(os.sep)) if treepath != subdir else 0
+				if maxdepth is not None and depth > maxdepth:
+					continue
+				if jsonoutput:
+					print json.dumps({"path": treepath, "depth": depth, "streams": [streamname]})
+				else:
+					print "M %s" % (treepath or os.sep)
+			return
+
+		if subdir == "":
+			tree = metadatatree
+		else:
+			try:
+				tree = self[metadatatree[subdir].id]
+			except KeyError:
+				raise MetadataBlobNotFoundError("Could not find '%s' in the metadata tree" % subdir)
+			if not isinstance(tree, pygit2.Tree):
+				raise MetadataBlobNotFoundError("Could not find '%s' in the metadata tree" % subdir)
+
+		for treepath, depth, streams in self.iter_metadata_objects(tree, subdir=subdir, maxdepth=maxdepth, streamname=streamname):
+			# When filtering by stream, only show the paths which have it
+			if streamname is not None and len(streams) == 0:
+				continue
+
+			if jsonoutput:
+				print json.dumps({"path": treepath, "depth": depth, "streams": streams})
+			elif streamname is not None:
+				print "M %s" % (treepath or os.sep)
+			elif depth == 0:
+				print "%s %s" % (len(streams) > 0 and "M" or "-", treepath or os.sep)
+			else:
+				print ("%s " + " " * (depth - 1) + os.path.basename(treepath)) % (len(streams) > 0 and "M" or "-")
+
+	# Walks a metadata tree yielding (path, streamname, datacommitid, blobid) for every metadata
+	# blob, optionally only for one stream
+	def iter_metadata_entries(self, tree, streamname=None, prefix=""):
+		stack = [(prefix, tree)]
+		while len(stack) > 0:
+			treepath, tree = stack.pop()
+			for entry in tree:
+				if entry.type != "tree":
+					continue
 
-		indentstr = " "*indent
-		for entry in tree:
-			if entry.type == "tree":
 				if entry.name != self.metadata_name:
-					metadataexists = self.metadata_name in self[entry.id]
-					print ("%s " + indentstr + entry.name) % (metadataexists and "M" or "-")
-					self.print_tree(self[entry.id], indent=indent+1)
+					stack.append((os.path.join(treepath, entry.name), self[entry.id]))
+				else:
+					for metadataentry in self.iter_metadata_node_entries(self[entry.id], treepath, streamname=streamname):
+						yield metadataentry
+
+	# Yields (path, streamname, datacommitid, blobid) for each blob in a metadata node
+	def iter_metadata_node_entries(self, metadatanode, path, streamname=None):
+		for streamentry in metadatanode:
+			if streamentry.type != "tree" or (streamname is not None and streamentry.name != streamname):
+				continue
+
+			for blobentry in self[streamentry.id]:
+				if blobentry.type == "blob":
+					yield path, streamentry.name, blobentry.name, blobentry.id
+
+	# Yields the metadata entries for the paths directly inside dirpath
+	def iter_directory_metadata_entries(self, tree, dirpath):
+		try:
+			dirtree = tree if dirpath == "" else self[tree[dirpath].id]
+		except KeyError:
+			return
+		if not isinstance(dirtree, pygit2.Tree):
+			return
+
+		# The root directory's own metadata lives with the paths inside it
+		if dirpath == "" and self.metadata_name in dirtree:
+			for metadataentry in self.iter_metadata_node_entries(self[dirtree[self.metadata_name].id], ""):
+				yield metadataentry
+
+		for entry in dirtree:
+			if entry.type == "tree" and entry.name != self.metadata_name:
+				childtree = self[entry.id]
+				if self.metadata_name in childtree and childtree[self.metadata_name].type == "tree":
+					for metadataentry in self.iter_metadata_node_entries(self[childtree[self.metadata_name].id], os.path.join(dirpath, entry.name)):
+						yield metadataentry
+
+	# Splits a path in the metadata tree into (path, streamname, datacommitid), returning None
+	# if it is not the path of a metadata blob
+	def parse_metadata_blob_path(self, metadatablobpath):
+		components = metadatablobpath.split(os.sep)
+		if len(components) < 3 or components[-3] != self.metadata_name:
+			return None
+		return os.sep.join(components[0:-3]), components[-2], components[-1]
+
+	# Yields (path, oldid, newid) for each blob which differs between two trees, where oldid or
+	# newid is None if the blob is missing from that side. Subtrees with the same ID on both
+	# sides are skipped without being loaded, so the cost is proportional to the size of the change.
+	def iter_tree_changes(self, oldtree, newtree, prefix=""):
+		oldentries = dict((entry.name, entry) for entry in oldtree) if oldtree is not None else {}
+		newentries = dict((entry.name, entry) for entry in newtree) if newtree is not None else {}
+
+		for name in sorted(set(oldentries) | set(newentries)):
+			oldentry = oldentries.get(name)
+			newentry = newentries.get(name)
+			if oldentry is not None and newentry is not None and oldentry.id == newentry.id:
+				continue
+
+			entrypath = os.path.join(prefix, name)
+
+			oldsubtree = self[oldentry.id] if oldentry is not None and oldentry.type == "tree" else None
+			newsubtree = self[newentry.id] if newentry is not None and newentry.type == "tree" else None
+			if oldsubtree is not None or newsubtree is not None:
+				for change in self.iter_tree_changes(oldsubtree, newsubtree, entrypath):
+					yield change
+
+			oldblobid = oldentry.id if oldentry is not None and oldentry.type == "blob" else None
+			newblobid = newentry.id if newentry is not None and newentry.type == "blob" else None
+			if oldblobid is not None or newblobid is not None:
+				yield entrypath, oldblobid, newblobid
+
+	# BLOOM FILTER FUNCTIONS
+
+	def get_bloom_ref(self):
+		if self.metadataref.startswith("refs/"):
+			return MetadataRepository.bloomref_prefix + self.metadataref[len("refs/"):]
+		else:
+			return MetadataRepository.bloomref_prefix + self.metadataref
 
-				# Ignore the metadata entry
+	# Load the Bloom filters for metadataref, returning None if they have not been built
+	def load_bloom_index(self):
+		try:
+			bloomcommit = self.revparse_single(self.get_bloom_ref())
+		except KeyError:
+			return None
+
+		if self.bloomindex is None or self.bloomindex.commit.id != bloomcommit.id:
+			# Only the filters for the latest Bloom commit are kept
+			filters = self.bloomfiltercache.get(bloomcommit.id.__str__())
+			if filters is None:
+				filters = {}
+				self.bloomfiltercache.clear()
+				self.bloomfiltercache[bloomcommit.id.__str__()] = filters
+			self.bloomindex = MetadataBloomIndex(self, bloomcommit, filters=filters)
+		return self.bloomindex
+
+	# Returns the Bloom filters if they describe the current metadata commit, bringing
+	# them up to date first if they have fallen behind, or None if they aren't in use
+	def get_bloom_index(self):
+		if self.snapshot is not None and self.snapshot.bloomindexloaded:
+			return self.snapshot.bloomindex
+
+		bloomindex = self.load_bloom_index()
+		if bloomindex is not None:
+			try:
+				metadatacommit = self.get_metadata_read_commit(self.metadataref)
+				if bloomindex.source != metadatacommit.id.__str__():
+					bloomindex = self.update_bloom_index()
+
+				# The filters are built for the tip, which may have moved on from a pinned commit
+				if bloomindex.source != metadatacommit.id.__str__():
+					bloomindex = None
+			except NoMetadataBranchError:
+				bloomindex = None
+
+		if self.snapshot is not None:
+			self.snapshot.bloomindex = bloomindex
+			self.snapshot.bloomindexloaded = True
+		return bloomindex
+
+	# True if the Bloom filters show there is no metadata for the path, stream and data commit
+	def metadata_definitely_absent(self, path, streamname, datacommitid=None):
+		# Pending writes are not in the filters and the filters only cover the tip of metadataref
+		if (self.writebuffer is not None and len(self.writebuffer) > 0) or len(self.fallbackrefs) > 0 or self.get_read_asof() is not None:
+			return False
+
+		bloomindex = self.get_bloom_index()
+		if bloomindex is None:
+			return False
+
+		return not bloomindex.may_contain(path, streamname, datacommitid)
+
+	# Build or incrementally update the Bloom filters for the current metadata commit. Only the
+	# filters for directories with new metadata are rewritten. The filters are rebuilt from
+	# scratch if metadata has been removed, as Bloom filters can't forget keys.
+	def update_bloom_index(self, withcommitids=None, rebuild=False):
+		metadatacommit = self.get_metadata_commit(self.metadataref)
+		bloomindex = self.load_bloom_index()
+
+		if withcommitids is None:
+			withcommitids = bloomindex is not None and bloomindex.withcommitids
+
+		# Work out which metadata entries have been added since the filters were built
+		addedentries = None
+		if bloomindex is not None and not rebuild and bloomindex.withcommitids == withcommitids:
+			if bloomindex.source == metadatacommit.id.__str__():
+				return bloomindex
+
+			try:
+				addedentries = []
+				for changepath, oldid, newid in self.iter_tree_changes(self[bloomindex.source].tree, metadatacommit.tree):
+					parsedpath = self.parse_metadata_blob_path(changepath)
+					if parsedpath is None:
+						continue
+					if newid is None:
+						addedentries = None
+						break
+					addedentries.append(parsedpath)
+			except (KeyError, ValueError):
+				# The commit the filters were built from no longer exists
+				addedentries = None
+
+		def add_entry(bloomfilter, path, streamname, datacommitid):
+			bloomfilter.add(MetadataBloomFilter.key(path, streamname))
+			if withcommitids:
+				bloomfilter.add(MetadataBloomFilter.key(path, streamname, datacommitid))
+
+		def build_filter(entries):
+			bloomfilter = MetadataBloomFilter(len(entries) * (4 if withcommitids else 2))
+			for path, streamname, datacommitid in entries:
+				add_entry(bloomfilter, path, streamname, datacommitid)
+			return bloomfilter
+
+		filters = {}
+		if addedentries is None:
+			basetree = None
+			entriesbyfilter = {}
+			for path, streamname, datacommitid, blobid in self.iter_metadata_entries(metadatacommit.tree):
+				entriesbyfilter.setdefault(MetadataBloomIndex.filter_path(path), []).append((path, streamname, datacommitid))
+			for filterpath, entries in entriesbyfilter.items():
+				filters[filterpath] = build_filter(entries)
+		else:
+			basetree = bloomindex.commit.tree
+			for path, streamname, datacommitid in addedentries:
+				filterpath = MetadataBloomIndex.filter_path(path)
+				if filterpath not in filters:
+					filters[filterpath] = bloomindex.get_filter(filterpath) or MetadataBloomFilter(0)
+				add_entry(filters[filterpath], path, streamname, datacommitid)
+
+				# Resize a filter which has too many keys by rebuilding it from its directory
+				if filters[filterpath].is_full():
+					directoryentries = [entry[0:3] for entry in self.iter_directory_metadata_entries(metadatacommit.tree, os.path.dirname(path))]
+					filters[filterpath] = build_filter(directoryentries)
+
+		treeentries = dict((filterpath, self.create_blob(bloomfilter.serialise())) for filterpath, bloomfilter in filters.items())
+		treeentries["source"] = self.create_blob(metadatacommit.id.__str__() + "\n")
+		treeentries["commitids"] = self.create_blob(withcommitids and "1\n" or "0\n")
+		treeid = self.write_tree_entries(basetree, treeentries)
+
+		# The filters are derived data so they don't need any history
+		bloomcommitid = self.create_commit(
+			None,
+			pygit2.Signature('Mark', 'cms4@soton.ac.uk'),
+			pygit2.Signature('Mark', 'cms4@soton.ac.uk'),
+			"Bloom filters for %s" % metadatacommit.id,
+			treeid,
+			[])
+		self.create_reference(self.get_bloom_ref(), bloomcommitid, force=True)
+		self.debugmsg("Bloom filters %s written for %s (%d filters updated)" % (bloomcommitid, metadatacommit.id, len(filters)))
+
+		return self.load_bloom_index()
+
+	# GARBAGE COLLECTION FUNCTIONS
+
+	# Parses a timestamp given as seconds since the epoch or as an ISO 8601 date and time
+	# (YYYY-MM-DD, YYYY-MM-DDTHH:MM or YYYY-MM-DDTHH:MM:SS, in UTC)
+	@staticmethod
+	def parse_timestamp(value):
+		if re.match(r'^\d+$', value):
+			return int(value)
+
+		for timeformat in ["%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"]:
+			try:
+				parsedtime = datetime.datetime.strptime(value, timeformat)
+			except ValueError:
+				continue
+			return int((parsedtime - datetime.datetime(1970, 1, 1)).total_seconds())
+
+		raise ParameterError("Could not parse '%s' as a metadata commit or a time" % value)
+
+	# Returns the metadata commits from the tip back to the first commit, following first parents
+	def get_metadata_history(self, metadatacommit):
+		history = []
+		while metadatacommit is not None:
+			self.stats.record("commitswalked")
+			history.append(metadatacommit)
+			metadatacommit = metadatacommit.parents[0] if len(metadatacommit.parents) > 0 else None
+		return history
+
+	# Finds the commit in the metadata history named by point, which can be a revision or a
+	# time, in which case the last commit made at or before it is used. Commits are matched
+	# against the first-parent history through the time index so no history walk is needed.
+	def resolve_metadata_point(self, point, metadatacommit, metadataref=None):
+		metadataref = metadataref or self.metadataref
+		timeindex = self.get_time_index(metadataref, metadatacommit)
+
+		try:
+			pointcommit = self.revparse_single(point)
+		except (KeyError, ValueError):
+			pointcommit = None
+
+		if pointcommit is not None:
+			if timeindex.contains(metadataref, pointcommit.id):
+				return pointcommit
+			raise MetadataPointNotFoundError("'%s' is not in the history of '%s'" % (point, metadataref))
+
+		timestamp = MetadataRepository.parse_timestamp(point)
+		historycommitid = timeindex.find_time(metadataref, timestamp)
+		if historycommitid is None:
+			raise MetadataPointNotFoundError("There is no metadata in '%s' as early as '%s'" % (metadataref, point))
+		return self[historycommitid]
+
+	# Returns a time index covering the first-parent history of metadatacommit, the tip of
+	# metadataref. The index is extended, rather than rebuilt, as the reference moves forward.
+	def get_time_index(self, metadataref, metadatacommit):
+		if self.timeindex is None:
+			try:
+				self.timeindex = MetadataTimeIndex(self.get_cache_path("timeindex.sqlite"))
+			except sqlite3.Error, e:
+				self.debugmsg("Time index unavailable: %s" % e)
+				self.timeindex = MetadataTimeIndex(":memory:")
+
+		self.timeindex.update(self, metadataref, metadatacommit)
+		return self.timeindex
+
+	# Returns (object count, size in bytes) of all of the objects reachable from a commit
+	def count_reachable_objects(self, commit):
+		seen = set()
+		size = 0
+		stack = []
+
+		for historycommit in self.walk_commits(commit.id, pygit2.GIT_SORT_NONE):
+			seen.add(historycommit.id)
+			size += len(historycommit.read_raw())
+			if historycommit.tree_id not in seen:
+				stack.append(historycommit.tree_id)
+
+		while len(stack) > 0:
+			treeid = stack.pop()
+			if treeid in seen:
+				continue
+			seen.add(treeid)
+			tree = self[treeid]
+			size += len(tree.read_raw())
+
+			for entry in tree:
+				if entry.id in seen:
+					continue
+				if entry.type == "tree":
+					stack.append(entry.id)
 				else:
-					pass
+					seen.add(entry.id)
+					size += self[entry.id].size
+
+		return len(seen), size
+
+	# Squash the metadata history up to and including 'before' (all of it if None) into a single
+	# snapshot commit and replay later commits on top of it with their original trees, so the
+	# current tree is unchanged. Replayed merge commits keep their other parents, so later merges
+	# of the same references still find their merge base, but the other parents of merges which
+	# are squashed are lost. If prunemissing is set, entries for data commits which no longer
+	# exist are then removed in a further commit. Returns a dictionary describing what was done.
+	def compact_metadata(self, before=None, prunemissing=False, dryrun=False):
+		metadatacommit = self.get_metadata_commit(self.metadataref)
 
-			# We shouldn't have any blobs so we'll ignore them
-			# (blobs should only exist in metadata nodes)
-			elif entry.type == "blob":
-				MetadataRepository.errormsg("Ignoring blob '%s'" % entry.name)
+		if before is None:
+			squashcommit = metadatacommit
+		else:
+			squashcommit = self.resolve_metadata_point(before, metadatacommit)
+
+		history = self.get_metadata_history(metadatacommit)
+		replaycommits = history[0:[historycommit.id for historycommit in history].index(squashcommit.id)]
+		replaycommits.reverse()
+
+		signature = pygit2.Signature('Mark', 'cms4@soton.ac.uk')
+
+		# Create the snapshot and replay later commits on top of it
+		newtipid = self.create_commit(
+			None,
+			signature,
+			signature,
+			"Metadata snapshot of %s\n\nSquashed %d commits" % (squashcommit.id, len(history) - len(replaycommits)),
+			squashcommit.tree_id,
+			[])
+		for replaycommit in replaycommits:
+			newtipid = self.create_commit(None, replaycommit.author, replaycommit.committer, replaycommit.message, replaycommit.tree_id,
+				[newtipid] + [parent.id for parent in replaycommit.parents[1:]])
+		squashedmerges = [historycommit.id.__str__() for historycommit in history[len(replaycommits):] if len(historycommit.parents) > 1]
+		replayedmerges = [replaycommit.id.__str__() for replaycommit in replaycommits if len(replaycommit.parents) > 1]
+
+		if self[newtipid].tree_id != metadatacommit.tree_id:
+			raise MetadataWriteError("Compacted metadata does not match the original")
+
+		# Remove entries for data commits which no longer exist
+		prunedentries = {}
+		if prunemissing:
+			for path, streamname, datacommitid, blobid in self.iter_metadata_entries(metadatacommit.tree):
+				try:
+					datacommit = self.get(datacommitid)
+				except ValueError:
+					datacommit = None
+				if datacommit is None or not isinstance(datacommit, pygit2.Commit):
+					prunedentries[self.get_metadata_blob_path(path, streamname, datacommitid)] = None
+
+			if len(prunedentries) > 0:
+				newtipid = self.create_commit(
+					None,
+					signature,
+					signature,
+					"Removed metadata for %d entries with missing data commits" % len(prunedentries),
+					self.write_tree_entries(metadatacommit.tree, prunedentries),
+					[newtipid])
+
+		objectsbefore, sizebefore = self.count_reachable_objects(metadatacommit)
+		objectsafter, sizeafter = self.count_reachable_objects(self[newtipid])
+
+		result = {
+			"oldtip": metadatacommit.id.__str__(),
+			"newtip": newtipid.__str__(),
+			"squashed": len(history) - len(replaycommits),
+			"replayed": len(replaycommits),
+			"replayedmerges": replayedmerges,
+			"squashedmerges": squashedmerges,
+			"pruned": sorted(prunedentries),
+			"objectsbefore": objectsbefore,
+			"objectsafter": objectsafter,
+			"sizebefore": sizebefore,
+			"sizeafter": sizeafter}
+
+		if dryrun:
+			return result
+
+		# Make sure nobody else has written to the branch while we were working
+		metadataref = self.lookup_reference(self.metadataref)
+		if metadataref.target != metadatacommit.id:
+			raise MetadataWriteError("'%s' was updated during garbage collection" % self.metadataref)
+		metadataref.set_target(newtipid, "metagit gc: compacted from %s" % metadatacommit.id)
+
+		# The Bloom filters are rebuilt if entries were removed
+		if self.load_bloom_index() is not None:
+			self.update_bloom_index()
+
+		return result
+
+	# MERGE FUNCTIONS
+
+	# Three-way merge of metadata trees, returning the ID of the merged tree (None if it is
+	# empty). Entries with the same ID on both sides, or unchanged on one side since the base,
+	# are resolved without loading them, so identical subtrees are skipped. Blobs changed on
+	# both sides are added to conflicts as (path, baseid, ourid, theirid) and resolved using
+	# strategy ('ours', 'theirs' or None to keep ours until the conflict is dealt with).
+	def merge_metadata_trees(self, basetree, ourtree, theirtree, conflicts, strategy=None, prefix=""):
+		def entry_id(entry):
+			return entry.id if entry is not None else None
+
+		def entry_tree(entry):
+			return self[entry.id] if entry is not None and entry.type == "tree" else None
+
+		baseentries = dict((entry.name, entry) for entry in basetree) if basetree is not None else {}
+		ourentries = dict((entry.name, entry) for entry in ourtree) if ourtree is not None else {}
+		theirentries = dict((entry.name, entry) for entry in theirtree) if theirtree is not None else {}
+
+		treebuilder = self.TreeBuilder()
+		for name in sorted(set(baseentries) | set(ourentries) | set(theirentries)):
+			baseentry = baseentries.get(name)
+			ourentry = ourentries.get(name)
+			theirentry = theirentries.get(name)
+
+			if entry_id(ourentry) == entry_id(theirentry) or entry_id(baseentry) == entry_id(theirentry):
+				mergedentry = ourentry
+			elif entry_id(baseentry) == entry_id(ourentry):
+				mergedentry = theirentry
+
+			# Both sides changed a directory so merge inside it
+			elif (ourentry is None or ourentry.type == "tree") and (theirentry is None or theirentry.type == "tree"):
+				subtreeid = self.merge_metadata_trees(entry_tree(baseentry), entry_tree(ourentry), entry_tree(theirentry), conflicts, strategy=strategy, prefix=os.path.join(prefix, name))
+				if subtreeid is not None:
+					treebuilder.insert(name, subtreeid, pygit2.GIT_FILEMODE_TREE)
+				continue
+
+			# Both sides changed the same blob
+			else:
+				conflicts.append((os.path.join(prefix, name), entry_id(baseentry), entry_id(ourentry), entry_id(theirentry)))
+				mergedentry = theirentry if strategy == "theirs" else ourentry
+
+			if mergedentry is not None:
+				treebuilder.insert(name, mergedentry.id, mergedentry.filemode)
+
+		if len(treebuilder) == 0:
+			return None
+		else:
+			return self.write_treebuilder(treebuilder)
+
+	# Merges another metadata commit into metadataref without a checkout, fast-forwarding when
+	# possible. Returns a dictionary describing the merge; if there are conflicts and no strategy
+	# is given then nothing is committed.
+	def merge_metadata(self, theirrev, strategy=None, fastforward=True, dryrun=False):
+		theircommit = self.get_metadata_commit(theirrev)
+
+		result = {
+			"theirs": theircommit.id.__str__(),
+			"conflicts": [],
+			"commit": None}
 
-			# We shouldn't have any other type of object so we'll ignore it
+		try:
+			ourcommit = self.get_metadata_commit(self.metadataref)
+		except NoMetadataBranchError:
+			ourcommit = None
+
+		if ourcommit is not None:
+			result["ours"] = ourcommit.id.__str__()
+
+		# Nothing to merge
+		if ourcommit is not None and (ourcommit.id == theircommit.id or self.descendant_of(ourcommit.id, theircommit.id)):
+			result["type"] = "up-to-date"
+			return result
+
+		# Just move our branch along
+		if ourcommit is None or (fastforward and self.descendant_of(theircommit.id, ourcommit.id)):
+			result["type"] = "fast-forward"
+			result["commit"] = theircommit.id.__str__()
+			if not dryrun:
+				if ourcommit is None:
+					self.create_reference(self.metadataref, theircommit.id)
+				else:
+					self.lookup_reference(self.metadataref).set_target(theircommit.id, "metagit merge: fast-forward to %s" % theirrev)
+				if self.load_bloom_index() is not None:
+					self.update_bloom_index()
+			return result
+
+		# Histories with no common commit (e.g. after gc) are merged against an empty tree
+		baseid = self.merge_base(ourcommit.id, theircommit.id)
+		basetree = self[baseid].tree if baseid is not None else None
+		result["type"] = "merge"
+		result["base"] = baseid.__str__() if baseid is not None else None
+
+		conflicts = []
+		mergedtreeid = self.merge_metadata_trees(basetree, ourcommit.tree, theircommit.tree, conflicts, strategy=strategy)
+		if mergedtreeid is None:
+			mergedtreeid = self.write_treebuilder(self.TreeBuilder())
+
+		for conflictpath, baseid, ourid, theirid in conflicts:
+			parsedpath = self.parse_metadata_blob_path(conflictpath)
+			path, streamname, datacommitid = parsedpath if parsedpath is not None else (conflictpath, None, None)
+
+			if ourid is None:
+				reason = "deleted by us"
+			elif theirid is None:
+				reason = "deleted by them"
+			elif baseid is None:
+				reason = "added by both"
 			else:
-				MetadataRepository.errormsg("Ignoring entry '%s' of type '%s'" % (entry.name, entry.type))
+				reason = "modified by both"
 
-	def list_metadata_objects(self):
-		# Find metadata branch
+			result["conflicts"].append({
+				"path": path,
+				"stream": streamname,
+				"datacommit": datacommitid,
+				"reason": reason,
+				"base": baseid.__str__() if baseid is not None else None,
+				"ours": ourid.__str__() if ourid is not None else None,
+				"theirs": theirid.__str__() if theirid is not None else None})
+
+		if dryrun or (len(conflicts) > 0 and strategy is None):
+			return result
+
+		result["commit"] = self.commit_metadata_tree(mergedtreeid, "Merged metadata from %s" % theirrev, extraparentids=[theircommit.id]).__str__()
+		return result
+
+	# BACKFILL FUNCTIONS
+
+	# Returns (ID, type) of the entry at path in tree, where type is "tree" or "blob", or None
+	# if there isn't one. The object itself is not loaded.
+	@staticmethod
+	def get_tree_entry(tree, path):
+		if tree is None:
+			return None
+		elif path == "":
+			return tree.id, "tree"
+		try:
+			entry = tree[path]
+		except KeyError:
+			return None
+		return entry.id, entry.type
+
+	# Yields (path, blob ID, data commit) for each commit in the history of datarev, oldest first,
+	# where a blob appears at one of the tracked paths (files or directories, "" for everything).
+	# The history is walked once and only the tracked subtrees which changed are compared.
+	# History reachable from hidecommitids is skipped.
+	def iter_data_versions(self, datarev, paths, hidecommitids=None):
+		datacommit = self.get_data_commit(datarev)
+		prefixes = [os.path.normpath(path).strip(os.sep) for path in paths] or [""]
+		prefixes = ["" if prefix == "." else prefix for prefix in prefixes]
+
+		walker = self.walk(datacommit.id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+		for hidecommitid in hidecommitids or []:
+			walker.hide(hidecommitid)
+
+		for commit in walker:
+			self.stats.record("commitswalked")
+			parenttree = commit.parents[0].tree if len(commit.parents) > 0 else None
+
+			newblobs = {}
+			for prefix in prefixes:
+				oldentry = self.get_tree_entry(parenttree, prefix)
+				newentry = self.get_tree_entry(commit.tree, prefix)
+				if newentry is None or newentry == oldentry:
+					continue
+
+				self.stats.record("treediffs")
+				if newentry[1] == "tree":
+					oldsubtree = self[oldentry[0]] if oldentry is not None and oldentry[1] == "tree" else None
+					for path, oldid, newid in self.iter_tree_changes(oldsubtree, self[newentry[0]], prefix):
+						if newid is not None:
+							newblobs[path] = newid
+				elif newentry[1] == "blob":
+					newblobs[prefix] = newentry[0]
+
+			for path, blobid in sorted(newblobs.items()):
+				# A blob brought in from another parent of a merge was introduced there, not here
+				if (blobid, "blob") in [self.get_tree_entry(parentcommit.tree, path) for parentcommit in commit.parents[1:]]:
+					continue
+				yield path, blobid, commit
+
+	# Attaches metadata to every version of the tracked paths in the history of datarev. function
+	# is called with the path and the data blob and returns the metadata (a string, or anything
+	# else JSON can encode, or None to skip that version). It is only called once for each distinct
+	# blob, and versions which already have metadata in the stream are left alone unless force
+	# is set. The metadata is written in commits of up to batchsize entries. Returns a summary.
+	def backfill_metadata(self, paths, function, datarev="HEAD", streamname=MetadataPath.stream_default, batchsize=1000, force=False):
+		summary = {"versions": 0, "computed": 0, "reused": 0, "skipped": 0, "written": 0, "commits": []}
+
+		try:
+			basetree = self.get_metadata_commit(self.metadataref).tree
+		except NoMetadataBranchError:
+			basetree = None
+
+		results = {}
+		entries = {}
+		for path, blobid, datacommit in self.iter_data_versions(datarev, paths):
+			summary["versions"] += 1
+
+			metadatablobpath = self.get_metadata_blob_path(path, streamname, datacommit.id.__str__())
+			if not force and self.get_tree_entry(basetree, metadatablobpath) is not None:
+				summary["skipped"] += 1
+				continue
+
+			if blobid in results:
+				summary["reused"] += 1
+			else:
+				summary["computed"] += 1
+				metadata = function(path, self[blobid])
+				if metadata is None:
+					results[blobid] = None
+				else:
+					if not isinstance(metadata, basestring):
+						metadata = json.dumps(metadata)
+					with self.stats.phase("write"):
+						results[blobid] = self.create_blob(metadata)
+
+			if results[blobid] is not None:
+				entries[metadatablobpath] = results[blobid]
+
+			if len(entries) >= batchsize:
+				basetree = self.commit_backfill_entries(basetree, entries, summary)
+				entries = {}
+
+		if len(entries) > 0:
+			self.commit_backfill_entries(basetree, entries, summary)
+
+		return summary
+
+	def commit_backfill_entries(self, basetree, entries, summary):
+		with self.stats.phase("write"):
+			toptreeid = self.write_tree_entries(basetree, entries, force=True)
+			commitid = self.commit_metadata_tree(toptreeid, "Backfilled metadata for %d versions" % len(entries))
+
+		summary["written"] += len(entries)
+		summary["commits"].append(commitid.__str__())
+		MetadataRepository.errormsg("%d metadata entries committed to '%s' branch" % (summary["written"], self.metadataref))
+		return self[toptreeid]
+
+	# SNAPSHOT FUNCTIONS
+
+	# Writes a MetadataSnapshotFile of the metadata which applies to every file and directory at
+	# datarev, for each of streamnames or every stream if None. Returns the number of entries.
+	def write_metadata_snapshot(self, outfile, datarev=MetadataPath.datarev_default_get, streamnames=None):
+		# Everything in the snapshot comes from the same metadata commit
+		with self.pin_metadata():
+			headcommit = self.get_data_commit(datarev)
+			metadatatree = self.get_metadata_read_tree()
+
+			# Streams and the paths with metadata in them
+			streampaths = {}
+			for treepath, depth, streams in self.iter_metadata_objects(metadatatree):
+				for streamname in streams:
+					if streamnames is None or streamname in streamnames:
+						streampaths.setdefault(streamname, []).append(treepath)
+
+			filepaths = [path for path, oldid, newid in self.iter_tree_changes(None, headcommit.tree)]
+
+			entries = []
+			for streamname, paths in sorted(streampaths.items()):
+				with self.stats.phase("snapshot resolution"):
+					resolved = self.resolve_file_metadata(headcommit, filepaths, streamname).items()
+
+					# Directories are resolved from where they appeared using the directory origin index,
+					# or by walking back through the history if it isn't available
+					treeoriginindex = self.get_tree_origin_index(headcommit)
+					for path in paths:
+						treeentry = self.get_tree_entry(headcommit.tree, path)
+						if treeentry is not None and treeentry[1] == "tree":
+							# Like files, directories don't inherit metadata from before a merge
+							try:
+								if treeoriginindex is not None:
+									datacommit = self.find_data_commit_with_directory_metadata(path, streamname, headcommit)
+								else:
+									pathreq = "s+%s:%s:%s" % (headcommit.id, os.path.join(self.workdir, path), streamname)
+									datacommit = self.find_data_commit_with_metadata(self.parse_path_parameter(pathreq, path_requires_search=False), returncommitwhennometadata=False)
+							except MetadataReadError:
+								datacommit = None
+							if datacommit is not None:
+								resolved.append((path, (MetadataStatus.applies if datacommit.id == headcommit.id else MetadataStatus.inherited, datacommit.id.__str__())))
+
+				for path, (state, datacommitid) in resolved:
+					blobid = metadatatree[self.get_metadata_blob_path(path, streamname, datacommitid)].id
+					entries.append((path, streamname, state, datacommitid, blobid.__str__()))
+
+			MetadataSnapshotFile.write(outfile, headcommit.id.__str__(), metadatatree.id.__str__(), entries, lambda blobid: self[blobid].data)
+			return len(entries)
+
+	# EXPORT FUNCTIONS
+
+	# Returns the parsed JSON in a metadata blob, or None if it isn't JSON. Documents are read
+	# through the document cache, so they must not be modified.
+	def read_metadata_document(self, blobid):
+		try:
+			return self.documentcache.get(self[blobid])
+		except MetadataFileFormatError:
+			return None
+
+	# Writes a JSON object for each metadata blob in the metadata branch, one per line
+	def export_metadata(self, outfile, streamname=None):
+		count = 0
+		for path, entrystreamname, datacommitid, blobid in self.iter_metadata_entries(self.get_metadata_read_tree(), streamname=streamname):
+			entry = {"path": path, "stream": entrystreamname, "datacommit": datacommitid, "blobid": blobid.__str__(), "metadata": self.read_metadata_document(blobid)}
+			outfile.write("%s\n" % json.dumps(entry, sort_keys=True))
+			count += 1
+		return count
+
+	# Writes the metadata in the metadata branch in a columnar format (see metagitexport),
+	# rowgroupsize rows at a time
+	def export_metadata_columnar(self, outfile, fileformat, streamname=None, rowgroupsize=10000):
+		if fileformat not in columnar_writers:
+			raise ParameterError("Unknown columnar format '%s'" % fileformat)
+		columnar_writers[fileformat].check_dependencies()
+
+		# Both passes read the same tree even if metadataref moves in between
+		with self.pin_metadata():
+			metadatatree = self.get_metadata_read_tree()
+
+			# The first pass finds the type of each key so every row group has the same columns. Each
+			# blob only needs to be looked at once, and the documents are kept in the document cache
+			# so the second pass doesn't parse the most recently used ones again.
+			schema = MetadataColumnSchema()
+			with self.stats.phase("export schema"):
+				seenblobids = set()
+				for path, entrystreamname, datacommitid, blobid in self.iter_metadata_entries(metadatatree, streamname=streamname):
+					if blobid not in seenblobids:
+						seenblobids.add(blobid)
+						schema.add_document(self.read_metadata_document(blobid))
+				seenblobids = None
+
+			writer = columnar_writers[fileformat](outfile, schema)
+			count = 0
+			with self.stats.phase("export rows"):
+				rows = []
+				for path, entrystreamname, datacommitid, blobid in self.iter_metadata_entries(metadatatree, streamname=streamname):
+					rows.append((path, entrystreamname, datacommitid, self.read_metadata_document(blobid)))
+					if len(rows) >= rowgroupsize:
+						writer.write_row_group(rows)
+						count += len(rows)
+						rows = []
+
+				# An empty export still gets one row group so the columns can be read
+				if len(rows) > 0 or writer.rowgroups == 0:
+					writer.write_row_group(rows)
+					count += len(rows)
+				writer.close()
+
+		return {"rows": count, "rowgroups": writer.rowgroups, "columns": len(MetadataColumnSchema.fixed_columns) + len(schema.key_columns())}
+
+	# BUNDLE FUNCTIONS
+
+	# Adds the IDs of the objects in tree which aren't in oldtree to objectids, skipping
+	# subtrees which are the same in both or have already been added
+	def collect_new_objects(self, tree, oldtree, objectids):
+		if tree.id in objectids or (oldtree is not None and tree.id == oldtree.id):
+			return
+		objectids.add(tree.id)
+
+		oldentries = dict((entry.name, entry) for entry in oldtree) if oldtree is not None else {}
+		for entry in tree:
+			oldentry = oldentries.get(entry.name)
+			if (oldentry is not None and oldentry.id == entry.id) or entry.id in objectids:
+				continue
+
+			if entry.type == "tree":
+				oldsubtree = self[oldentry.id] if oldentry is not None and oldentry.type == "tree" else None
+				self.collect_new_objects(self[entry.id], oldsubtree, objectids)
+			else:
+				objectids.add(entry.id)
+
+	# Writes the metadata commits added since 'since' (all of them if None), with the trees and
+	# blobs they introduced, to outfile. Returns the header that was written.
+	def create_metadata_bundle(self, outfile, since=None):
+		tipcommit = self.get_metadata_commit(self.metadataref)
+
+		walker = self.walk(tipcommit.id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+		if since is not None:
+			sincecommit = self.get_metadata_commit(since)
+			if not (sincecommit.id == tipcommit.id or self.descendant_of(tipcommit.id, sincecommit.id)):
+				raise ParameterError("'%s' is not in the history of '%s'" % (since, self.metadataref))
+			walker.hide(sincecommit.id)
+		else:
+			sincecommit = None
+
+		# Only the objects each commit changed relative to its parents need sending
+		objectids = set()
+		commitids = []
+		for commit in walker:
+			self.stats.record("commitswalked")
+			commitids.append(commit.id)
+			if len(commit.parents) == 0:
+				self.collect_new_objects(commit.tree, None, objectids)
+			for parentcommit in commit.parents:
+				self.collect_new_objects(commit.tree, parentcommit.tree, objectids)
+
+		header = {
+			"ref": self.metadataref,
+			"since": sincecommit.id.__str__() if sincecommit is not None else None,
+			"tip": tipcommit.id.__str__(),
+			"commits": len(commitids),
+			"objects": len(objectids) + len(commitids)}
+
+		MetadataBundle.write(outfile, self, header, sorted(objectids) + commitids)
+		return header
+
+	# Adds the objects in a bundle to the repository and then brings metadataref up to date
+	# with the bundle's tip, fast-forwarding if possible and otherwise merging
+	def apply_metadata_bundle(self, infile, strategy=None, dryrun=False):
+		header = MetadataBundle.read_header(infile)
+
+		if header["since"] is not None and self.get(header["since"]) is None:
+			raise MetadataReadError("Bundle needs metadata commit %s which is not in the repository" % header["since"])
+
+		for objecttype, objectid, objectdata in MetadataBundle.read_objects(infile, header["objects"]):
+			if objectid not in self:
+				writtenid = self.write(objecttype, objectdata)
+				if writtenid != objectid:
+					raise MetadataFileFormatError("Bundle object %s is corrupt" % objectid)
+
+		result = self.merge_metadata(header["tip"], strategy=strategy, dryrun=dryrun)
+		result["bundle"] = header
+		return result
+
+	# CHANGE FEED FUNCTIONS
+
+	# Returns the (oldtree, commit) steps needed to go from the cursor to the tip of metadataref,
+	# one for each first-parent commit after the cursor
+	def get_change_feed_steps(self, cursor, tipcommit):
+		if cursor is None:
+			history = self.get_metadata_history(tipcommit)
+			history.reverse()
+			return [(parentcommit.tree if parentcommit is not None else None, commit) for parentcommit, commit in zip([None] + history[:-1], history)]
+
+		try:
+			cursorcommit = self.get(cursor)
+		except ValueError:
+			cursorcommit = None
+		if not isinstance(cursorcommit, pygit2.Commit):
+			raise ParameterError("Cursor '%s' is not a metadata commit in this repository" % cursor)
+
+		if cursorcommit.id == tipcommit.id:
+			return []
+
+		# The history has been rewritten since the cursor was issued (e.g. by gc), so just
+		# compare the two trees
+		if not self.descendant_of(tipcommit.id, cursorcommit.id):
+			return [(cursorcommit.tree, tipcommit)]
+
+		# Follow first parents back until we reach the cursor or a commit it already includes,
+		# whose changes the consumer has seen, in a single walk with the cursor's history hidden
+		walker = self.walk(tipcommit.id, pygit2.GIT_SORT_NONE)
+		walker.simplify_first_parent()
+		walker.hide(cursorcommit.id)
+		steps = []
+		for commit in walker:
+			self.stats.record("commitswalked")
+			steps.append(commit)
+		steps.reverse()
+
+		return [(oldcommit.tree, commit) for oldcommit, commit in zip([cursorcommit] + steps[:-1], steps)]
+
+	# Yields a dictionary for each metadata entry added, modified or removed after the cursor
+	# (a metadata commit ID, or None for the whole history) up to the until cursor, which
+	# defaults to the tip of metadataref. Only the subtrees which changed are read. Each change
+	# carries the cursor to resume from once it has been processed: this only moves on to a
+	# metadata commit with the last change in that commit, so resuming part way through a
+	# commit repeats its changes rather than skipping them.
+	def iter_metadata_changes(self, cursor=None, until=None):
+		if until is None:
+			until = self.get_change_cursor()
+			if until is None:
+				return
+		tipcommit = self.get_metadata_commit(until)
+
+		resumecursor = cursor
+		for oldtree, commit in self.get_change_feed_steps(cursor, tipcommit):
+			self.stats.record("treediffs")
+
+			# Hold each change back until the next one is known, so the last can carry the new cursor
+			pending = None
+			for blobpath, oldid, newid in self.iter_tree_changes(oldtree, commit.tree):
+				parsedpath = self.parse_metadata_blob_path(blobpath)
+				if parsedpath is None:
+					continue
+
+				if pending is not None:
+					yield pending
+
+				path, streamname, datacommitid = parsedpath
+				if oldid is None:
+					action = "added"
+				elif newid is None:
+					action = "removed"
+				else:
+					action = "modified"
+
+				pending = {
+					"cursor": resumecursor,
+					"action": action,
+					"path": path,
+					"stream": streamname,
+					"datacommit": datacommitid,
+					"blobid": (newid or oldid).__str__()}
+
+			resumecursor = commit.id.__str__()
+			if pending is not None:
+				pending["cursor"] = resumecursor
+				yield pending
+
+	# Returns the cursor for the current tip of metadataref, or None if there is no metadata
+	def get_change_cursor(self):
+		try:
+			return self.get_metadata_commit(self.metadataref).id.__str__()
+		except NoMetadataBranchError:
+			return None
+
+	# INTEGRITY CHECK FUNCTIONS
+
+	# Splits the metadata tree into jobs of (path, treeid, recursive) for checking in parallel.
+	# The top levels are expanded breadth first into non-recursive jobs until there are at
+	# least jobcount recursive jobs for the subtrees below them.
+	def partition_metadata_tree(self, tree, jobcount):
+		jobs = []
+		pending = [("", tree.id)]
+		while len(pending) > 0 and len(pending) < jobcount:
+			expanding = pending
+			pending = []
+			for treepath, treeid in expanding:
+				jobs.append((treepath, treeid.__str__(), False))
+				for entry in self[treeid]:
+					if entry.type == "tree" and entry.name != self.metadata_name:
+						pending.append((os.path.join(treepath, entry.name), entry.id))
+
+		jobs.extend((treepath, treeid.__str__(), True) for treepath, treeid in pending)
+		return jobs
+
+	# Checks the directory tree at path, and below it if recursive, returning (counts, problems)
+	def check_metadata_subtree(self, path, treeid, recursive=True, jsonstreams=None, checkpaths=True):
+		counts = {"trees": 0, "entries": 0}
+		problems = []
+		datacommits = {}
+
+		def problem(severity, check, message, problempath, streamname=None, datacommitid=None):
+			problems.append({
+				"severity": severity,
+				"check": check,
+				"message": message,
+				"path": problempath,
+				"stream": streamname,
+				"datacommit": datacommitid})
+
+		def get_datacommit(datacommitid):
+			if datacommitid not in datacommits:
+				datacommit = self.get(datacommitid)
+				datacommits[datacommitid] = datacommit if isinstance(datacommit, pygit2.Commit) else None
+			return datacommits[datacommitid]
+
+		stack = [(path, self[treeid])]
+		while len(stack) > 0:
+			treepath, tree = stack.pop()
+			counts["trees"] += 1
+
+			for entry in tree:
+				entrypath = os.path.join(treepath, entry.name)
+
+				if entry.name == self.metadata_name:
+					if entry.type != "tree":
+						problem("error", "node-not-tree", "Metadata node is a %s" % entry.type, treepath)
+						continue
+
+					for streamentry in self[entry.id]:
+						if streamentry.type != "tree":
+							problem("error", "stream-not-tree", "Stream is a %s" % streamentry.type, treepath, streamentry.name)
+							continue
+
+						for blobentry in self[streamentry.id]:
+							counts["entries"] += 1
+							datacommitid = blobentry.name
+
+							if blobentry.type != "blob":
+								problem("error", "entry-not-blob", "Metadata entry is a %s" % blobentry.type, treepath, streamentry.name, datacommitid)
+								continue
+
+							if not re.match(r'^[0-9a-f]{40}$', datacommitid):
+								problem("error", "bad-commit-id", "Metadata entry is not named after a commit ID", treepath, streamentry.name, datacommitid)
+								continue
+
+							datacommit = get_datacommit(datacommitid)
+							if datacommit is None:
+								problem("error", "missing-data-commit", "Data commit does not exist", treepath, streamentry.name, datacommitid)
+							elif checkpaths and treepath != "":
+								try:
+									datacommit.tree[treepath]
+								except KeyError:
+									problem("warning", "path-not-in-data-commit", "Path does not exist in the data commit", treepath, streamentry.name, datacommitid)
+
+							if jsonstreams is not None and streamentry.name in jsonstreams:
+								try:
+									json.loads(self[blobentry.id].data)
+								except ValueError, e:
+									problem("error", "invalid-json", "Metadata is not valid JSON: %s" % e, treepath, streamentry.name, datacommitid)
+
+				elif entry.type == "tree":
+					if recursive:
+						stack.append((entrypath, self[entry.id]))
+
+				# Blobs should only exist in metadata nodes
+				elif entry.type == "blob":
+					problem("warning", "stray-blob", "Blob outside a metadata node", entrypath)
+
+				else:
+					problem("error", "unexpected-entry", "Unexpected %s in the metadata tree" % entry.type, entrypath)
+
+		return counts, problems
+
+	# Checks the whole metadata branch using a pool of worker processes, returning a report
+	# dictionary. progress is called with (jobs done, total jobs, entries checked, problems found).
+	def check_metadata(self, jobs=None, jsonstreams=None, checkpaths=True, progress=None):
 		metadatacommit = self.get_metadata_commit(self.metadataref)
 
-		self.print_tree(metadatacommit.tree)
+		if jobs is None:
+			jobs = multiprocessing.cpu_count()
+		if jsonstreams is None:
+			jsonstreams = [MetadataPath.stream_default]
+
+		checkjobs = self.partition_metadata_tree(metadatacommit.tree, jobs * 8)
+		checkjobs = [(treepath, treeid, recursive, jsonstreams, checkpaths) for treepath, treeid, recursive in checkjobs]
+
+		report = {
+			"metadataref": self.metadataref,
+			"metadatacommit": metadatacommit.id.__str__(),
+			"trees": 0,
+			"entries": 0,
+			"errors": 0,
+			"warnings": 0,
+			"problems": []}
+
+		if jobs > 1:
+			pool = multiprocessing.Pool(jobs, fsck_worker_init, (self.path, self.metadataref))
+			results = pool.imap_unordered(fsck_worker_check, checkjobs)
+		else:
+			pool = None
+			results = (self.check_metadata_subtree(*checkjob) for checkjob in checkjobs)
+
+		try:
+			for jobsdone, (counts, problems) in enumerate(results, 1):
+				report["trees"] += counts["trees"]
+				report["entries"] += counts["entries"]
+				report["problems"].extend(problems)
+				if progress is not None:
+					progress(jobsdone, len(checkjobs), report["entries"], len(report["problems"]))
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+
+		report["problems"].sort(key=lambda problem: (problem["path"], problem["stream"], problem["datacommit"], problem["check"]))
+		report["errors"] = sum(1 for problem in report["problems"] if problem["severity"] == "error")
+		report["warnings"] = len(report["problems"]) - report["errors"]
+		return report
+
+	# STATUS FUNCTIONS
+
+	# Reports the metadata state of every tracked file under prefix, returning a sorted list of
+	# (path, state, datacommitid). Uses one status snapshot and one walk back through history
+	# which only continues while there are files whose metadata is still unresolved.
+	def metadata_status(self, prefix="", streamname=MetadataPath.stream_default, datarev=MetadataPath.datarev_default_get):
+		headcommit = self.get_data_commit(datarev)
+
+		# Take one snapshot of the working directory and index. Untracked and ignored files do not matter here.
+		modifiedflags = ~(pygit2.GIT_STATUS_WT_NEW | pygit2.GIT_STATUS_IGNORED)
+		modifiedpaths = set(statuspath for statuspath, flags in self.status().items() if flags & modifiedflags)
+
+		# Tracked files come from the index
+		prefix = prefix.strip(os.sep)
+		if prefix in ["", "."]:
+			trackedpaths = [entry.path for entry in self.index]
+		else:
+			trackedpaths = [entry.path for entry in self.index if entry.path == prefix or entry.path.startswith(prefix + os.sep)]
+
+		resolved = self.resolve_file_metadata(headcommit, trackedpaths, streamname)
+
+		results = []
+		for path in trackedpaths:
+			state, datacommitid = resolved.get(path, (MetadataStatus.absent, None))
+			if path in modifiedpaths and state != MetadataStatus.absent:
+				state = MetadataStatus.stale
+			results.append((path, state, datacommitid))
+
+		return sorted(results)
+
+	# Finds the metadata in a stream which applies to each of the files at headcommit in a single
+	# walk back through the history. Returns a dictionary of path to (state, data commit ID) for
+	# the files with metadata, where the state is applies or inherited.
+	def resolve_file_metadata(self, headcommit, trackedpaths, streamname):
+		# Find the data commits with metadata for each path, then invert it so we can look up by commit
+		commitswithmetadata = {}
+		try:
+			metadatatree = self.get_metadata_read_tree()
+			for metadatapath, metadatastreamname, datacommitid, blobid in self.iter_metadata_entries(metadatatree, streamname=streamname):
+				commitswithmetadata.setdefault(datacommitid, set()).add(metadatapath)
+		except NoMetadataBranchError:
+			pass
+
+		pathswithmetadata = set()
+		for paths in commitswithmetadata.values():
+			pathswithmetadata.update(paths)
+
+		# Only files that have metadata somewhere need resolving
+		unresolved = set(path for path in trackedpaths if path in pathswithmetadata)
+		resolved = {}
+
+		currentcommit = headcommit
+		while len(unresolved) > 0 and currentcommit is not None:
+			self.stats.record("commitswalked")
+
+			# Metadata defined at this commit applies to unresolved files as their blobs are unchanged since
+			currentcommitid = currentcommit.id.__str__()
+			for path in commitswithmetadata.get(currentcommitid, set()) & unresolved:
+				resolved[path] = (MetadataStatus.applies if currentcommit.id == headcommit.id else MetadataStatus.inherited, currentcommitid)
+				unresolved.discard(path)
+
+			# Merges stop metadata propagating
+			if len(currentcommit.parents) > 1:
+				break
+
+			parentcommit = currentcommit.parents[0] if len(currentcommit.parents) == 1 else None
+
+			# Files changed in this commit can't inherit metadata from earlier commits
+			for delta in self.diff_commit_to_parent(currentcommit, parentcommit).deltas:
+				unresolved.discard(delta.new_file.path)
+
+			currentcommit = parentcommit
+
+		return resolved
+
+	def print_metadata_status(self, pathreq, states=None):
+		path = self.parse_path_parameter(pathreq, fixdatarev=False, path_requires_search=False)
+
+		counts = {}
+		for statuspath, state, datacommitid in self.metadata_status(path.metadatapath, streamname=path.streamname):
+			counts[state] = counts.get(state, 0) + 1
+			if states is None or state in states:
+				print "{:<10} {:<40} {}".format(state, datacommitid or "", statuspath)
+
+		print
+		print ", ".join("%d %s" % (counts.get(state, 0), state) for state in [MetadataStatus.applies, MetadataStatus.inherited, MetadataStatus.stale, MetadataStatus.absent])
 
 
 
@@ -604,7 +3016,200 @@ class MetadataRepository(pygit2.Repository):
 		except KeyError:
 			raise NoMetadataBranchError("No metadata could be found")
 
+	# REPLICA FUNCTIONS
+
+	# Returns the SQLite replica, synced with the tip of metadataref, if reads should use it. It
+	# isn't used for layered or as-of reads, or while buffered writes are pending, and git is
+	# read instead if the replica can't be opened or updated.
+	def get_replica(self):
+		if not self.usereplica or len(self.fallbackrefs) > 0 or self.get_read_asof() is not None \
+			or (self.writebuffer is not None and len(self.writebuffer) > 0):
+			return None
+
+		# A pinned operation only needs the replica synced once
+		if self.snapshot is None or not self.snapshot.replicasynced:
+			try:
+				self.sync_replica()
+			except (sqlite3.Error, NoMetadataBranchError), e:
+				self.debugmsg("Replica unavailable: %s" % e)
+				return None
+			if self.snapshot is not None:
+				self.snapshot.replicasynced = True
+
+		# The replica is shared, and always describes the tip, so a pinned read can only use it
+		# while the tip is still the pinned commit
+		if self.snapshot is not None:
+			try:
+				pinnedcommit = self.get_metadata_read_commit(self.metadataref)
+				if self.replica.get_synced_commit(self.metadataref) != pinnedcommit.id.__str__():
+					return None
+			except (sqlite3.Error, NoMetadataBranchError), e:
+				self.debugmsg("Replica unavailable: %s" % e)
+				return None
+
+		return self.replica
+
+	# Replays the metadata commits made since the replica was last synced, returning the
+	# number of entries which changed
+	def sync_replica(self):
+		tipcommit = self.get_metadata_commit(self.metadataref)
+		if self.replica is None:
+			self.replica = MetadataReplica(self.get_cache_path("replica.sqlite"))
+
+		with self.stats.phase("replica sync"):
+			return self.replica.sync(self, self.metadataref, tipcommit)
+
+	# Returns (path, stream, data commit, value) for each metadata entry whose JSON has key,
+	# optionally only where it has the given value (values other than strings are compared as
+	# JSON). The replica is used if enabled, otherwise every metadata blob is read.
+	def find_metadata_by_key(self, key, value=None, streamname=None):
+		replica = self.get_replica()
+		if replica is not None:
+			return replica.find_key(self.metadataref, key, value=value, streamname=streamname)
+
+		results = []
+		for path, entrystream, datacommitid, blobid in self.iter_metadata_entries(self.get_metadata_read_tree(), streamname=streamname):
+			for k, v in MetadataReplica.get_key_values(self[blobid]):
+				if k == key and (value is None or v == value):
+					results.append((path, entrystream, datacommitid, v))
+		return sorted(results)
+
+	# LAYERED READ FUNCTIONS
+
+	def get_read_refs(self):
+		return [self.metadataref] + self.fallbackrefs
+
+	# Returns the commit of readref that reads should use, which is the pinned commit while
+	# pin_metadata() is active
+	def get_metadata_read_commit(self, readref):
+		if self.snapshot is not None:
+			return self.snapshot.get_commit(readref)
+		return self.resolve_metadata_read_commit(readref)
+
+	# Returns the as-of point reads use, from pin_metadata() or the repository, or None
+	def get_read_asof(self):
+		return self.snapshot.asof if self.snapshot is not None else self.asof
+
+	# Returns the tip of readref unless an as-of point is given or has been set for the
+	# repository. The commit resolved for an as-of point is remembered for as long as the tip
+	# is unchanged.
+	def resolve_metadata_read_commit(self, readref, asof=None):
+		asof = asof if asof is not None else self.asof
+		tipcommit = self.get_metadata_commit(readref)
+		if asof is None:
+			return tipcommit
+
+		asofkey = (readref, asof)
+		if asofkey not in self.asofcommits or self.asofcommits[asofkey][0] != tipcommit.id:
+			self.asofcommits[asofkey] = (tipcommit.id, self.resolve_metadata_point(asof, tipcommit, metadataref=readref))
+		return self.asofcommits[asofkey][1]
+
+	# Returns the root tree that reads should use, which is the pinned tree while pin_metadata()
+	# is active
+	def get_metadata_read_tree(self):
+		if self.snapshot is not None:
+			return self.snapshot.get_tree()
+		return self.build_metadata_read_tree()
+
+	# Returns the root tree of the read commits. With fallback references this is a tree
+	# combining all of the layers, where an entry in an earlier layer hides the same entry in
+	# later ones, so a layered lookup costs the same as a lookup in a single branch.
+	def build_metadata_read_tree(self):
+		if len(self.fallbackrefs) == 0:
+			return self.get_metadata_read_commit(self.metadataref).tree
+
+		# A layer without metadata at the as-of point (e.g. a commit from another layer's history,
+		# or a time before its first commit) is left out, like a layer which doesn't exist
+		layercommits = []
+		missingpoint = False
+		for readref in self.get_read_refs():
+			try:
+				layercommits.append(self.get_metadata_read_commit(readref))
+			except NoMetadataBranchError:
+				pass
+			except MetadataPointNotFoundError:
+				missingpoint = True
+
+		if len(layercommits) == 0 and missingpoint:
+			raise MetadataPointNotFoundError("No metadata reference has metadata as of '%s'" % self.get_read_asof())
+		elif len(layercommits) == 0:
+			raise NoMetadataBranchError("No metadata could be found")
+		elif len(layercommits) == 1:
+			return layercommits[0].tree
+		else:
+			return self[self.get_merged_metadata_tree_id(layercommits)]
+
+	# The combined tree for a set of layers only depends on their commits, so it is cached in
+	# memory and in the git directory keyed by the commit IDs. Note that this means reads write
+	# the combined trees to the object database and a row to layers.sqlite the first time.
+	def get_merged_metadata_tree_id(self, layercommits):
+		layerkey = ",".join(layercommit.id.__str__() for layercommit in layercommits)
+
+		if layerkey in self.layercache:
+			return self.layercache[layerkey]
+
+		try:
+			if self.layerdb is None:
+				self.layerdb = sqlite3.connect(self.get_cache_path("layers.sqlite"))
+				self.layerdb.execute("CREATE TABLE IF NOT EXISTS layers (layerkey TEXT PRIMARY KEY, treeid TEXT)")
+
+			row = self.layerdb.execute("SELECT treeid FROM layers WHERE layerkey = ?", (layerkey,)).fetchone()
+			# The tree isn't referenced by anything so check git hasn't pruned it
+			if row is not None and self.get(row[0]) is not None:
+				self.layercache[layerkey] = pygit2.Oid(hex=row[0].encode("ascii"))
+				return self.layercache[layerkey]
+		except sqlite3.Error, e:
+			self.debugmsg("Layer cache unavailable: %s" % e)
+
+		treeid = self.overlay_metadata_trees([layercommit.tree for layercommit in layercommits])
+		self.layercache[layerkey] = treeid
+		self.debugmsg("Combined metadata tree %s created for %s" % (treeid, layerkey))
+
+		try:
+			if self.layerdb is not None:
+				self.layerdb.execute("INSERT OR REPLACE INTO layers VALUES (?, ?)", (layerkey, treeid.__str__()))
+				self.layerdb.commit()
+		except sqlite3.Error, e:
+			self.debugmsg("Layer cache unavailable: %s" % e)
+
+		return treeid
+
+	# Combines trees in priority order, returning the ID of the combined tree. Subtrees are
+	# only combined where more than one layer has them, so the cost depends on the overlap.
+	def overlay_metadata_trees(self, trees):
+		if len(set(tree.id for tree in trees)) == 1:
+			return trees[0].id
+
+		names = []
+		seen = set()
+		for tree in trees:
+			for entry in tree:
+				if entry.name not in seen:
+					seen.add(entry.name)
+					names.append(entry.name)
+
+		treebuilder = self.TreeBuilder()
+		for name in names:
+			entries = [tree[name] for tree in trees if name in tree]
+
+			# A blob hides anything below it, otherwise combine the trees from every layer
+			if entries[0].type != "tree":
+				treebuilder.insert(name, entries[0].id, entries[0].filemode)
+				continue
+
+			subtreeentries = [entry for entry in entries if entry.type == "tree"]
+			if len(subtreeentries) == 1:
+				treebuilder.insert(name, subtreeentries[0].id, pygit2.GIT_FILEMODE_TREE)
+			else:
+				treebuilder.insert(name, self.overlay_metadata_trees([self[entry.id] for entry in subtreeentries]), pygit2.GIT_FILEMODE_TREE)
+
+		return self.write_treebuilder(treebuilder)
+
 	def parse_path_parameter(self, pathreq, fixdatarev=False, path_requires_search=True):
+		with self.stats.phase("path parsing"):
+			return self.parse_path_parameter_unphased(pathreq, fixdatarev=fixdatarev, path_requires_search=path_requires_search)
+
+	def parse_path_parameter_unphased(self, pathreq, fixdatarev=False, path_requires_search=True):
 		path = MetadataPath(pathreq, path_requires_search=path_requires_search, repo=self)
 
 		# Please note that if we set the datarev to the new default of HEAD, to know whether
@@ -652,10 +3257,14 @@ class MetadataRepository(pygit2.Repository):
 		datarev = MetadataPath.datarev_default_get
 		abspath = os.path.join(path.repo.workdir, path.metadatapath)
 		if os.path.isfile(abspath):
-			# Check what the status of the file is
-			status = self.status_file(path.metadatapath)
+			# Check the file matches the one in the revision, using the stat cache to avoid reading it
+			try:
+				expectedblob = self.revparse_single('%s:%s' % (datarev, path.metadatapath))
+				filematches = isinstance(expectedblob, pygit2.Blob) and self.hash_worktree_file(abspath) == expectedblob.id
+			except KeyError:
+				filematches = False
 
-			if status > pygit2.GIT_STATUS_CURRENT:
+			if not filematches:
 				raise MetadataInvalidError("File has been modified but not committed so this metadata is not valid. Use '{}:{}' syntax to see metadata.".format(datarev, path.metadatapath))
 		elif os.path.isdir(abspath):
 			# Try to find the directory in the revision specified
@@ -712,7 +3321,7 @@ class MetadataRepository(pygit2.Repository):
 		else:
 			raise Exception("Expected Blob or Tree, got " + str(type(newentry)))
 
-		treebuilderid = treebuilder.write()
+		treebuilderid = self.write_treebuilder(treebuilder)
 
 		self.debugmsg("Tree containing %s saved with ID %s" % (newentryname, treebuilderid.__str__()))
 
@@ -723,6 +3332,60 @@ class MetadataRepository(pygit2.Repository):
 		else:
 			return treebuilderid
 
+	# RENAME FUNCTIONS
+
+	def get_blob_path_index(self, datacommit):
+		if self.blobpathindex is None:
+			try:
+				self.blobpathindex = MetadataBlobPathIndex(self.get_cache_path("blobpaths.sqlite"))
+			except sqlite3.Error, e:
+				self.debugmsg("Blob path index unavailable: %s" % e)
+				self.blobpathindex = MetadataBlobPathIndex(":memory:")
+
+		with self.stats.phase("blob path index"):
+			self.blobpathindex.update(self, datacommit)
+		return self.blobpathindex
+
+	# Looks for metadata recorded under any other path where the blob at path has been, attached
+	# to a data commit in the history of the requested revision which had the same blob at that
+	# path. The most recent such commit is used. Returns the IDs of that commit and the metadata
+	# blob, or None.
+	def find_renamed_metadata_blob_id(self, path):
+		datacommit = self.get_data_commit(path.datarev)
+		try:
+			dataobject = datacommit.tree[os.path.normpath(path.metadatapath)]
+		except KeyError:
+			return None
+		if dataobject.type != "blob":
+			return None
+
+		candidates = []
+		for oldpath in self.get_blob_path_index(datacommit).paths(dataobject.id):
+			if oldpath == os.path.normpath(path.metadatapath):
+				continue
+
+			try:
+				metadatastream = self.get_metadata_stream(oldpath, path.streamname)
+			except (MetadataBlobNotFoundError, NoMetadataBranchError):
+				continue
+
+			for metadataentry in metadatastream:
+				oldcommit = self.get(metadataentry.name)
+				if not isinstance(oldcommit, pygit2.Commit):
+					continue
+				if oldcommit.id != datacommit.id and not self.descendant_of(datacommit.id, oldcommit.id):
+					continue
+				if self.get_tree_entry(oldcommit.tree, oldpath) != (dataobject.id, "blob"):
+					continue
+				candidates.append((oldcommit.commit_time, oldpath, oldcommit.id.__str__(), metadataentry.id))
+
+		if len(candidates) == 0:
+			return None
+
+		committime, oldpath, oldcommitid, metadatablobid = max(candidates)
+		MetadataRepository.errormsg("NOTE: Using metadata recorded for '%s', where this data was previously" % oldpath)
+		return oldcommitid, metadatablobid
+
 	# COPY FUNCTIONS
 
 	# Given a path and a data rev, find the blob and then try to find where that blob was added
@@ -752,19 +3415,115 @@ class MetadataRepository(pygit2.Repository):
 		if not isinstance(pathobj, MetadataPath):
 			raise ParameterError("Passed path was not an instance of MetadataPath")
 
-		# Find the data commit
-		datacommit = self.get_data_commit(pathobj.datarev)
-		dataobject = self.revparse_single("%s:%s" % (pathobj.datarev, pathobj.metadatapath))
-		datacommitwithmetadata = self.find_first_data_commit_with_metadata_for_blob(dataobject, datacommit, pathobj, returncommitwhennometadata=returncommitwhennometadata)
+		# Every step back through the history looks in the same metadata tree
+		with self.stats.phase("data-commit resolution"), self.pin_metadata():
+			# Find the data commit
+			datacommit = self.get_data_commit(pathobj.datarev)
+			dataobject = self.revparse_single("%s:%s" % (pathobj.datarev, pathobj.metadatapath))
+			datacommitwithmetadata = self.find_first_data_commit_with_metadata_for_blob(dataobject, datacommit, pathobj, returncommitwhennometadata=returncommitwhennometadata)
 
 		return datacommitwithmetadata
 
+	# DIRECTORY ORIGIN FUNCTIONS
+
+	# Yields (path, added) for each directory which is a tree in only one of oldtree and newtree,
+	# where added is True if it is in newtree. Subtrees with the same ID are skipped.
+	def iter_tree_directory_changes(self, oldtree, newtree, prefix=""):
+		oldentries = dict((entry.name, entry) for entry in oldtree if entry.type == "tree") if oldtree is not None else {}
+		newentries = dict((entry.name, entry) for entry in newtree if entry.type == "tree") if newtree is not None else {}
+
+		for name in sorted(set(oldentries) | set(newentries)):
+			oldentry = oldentries.get(name)
+			newentry = newentries.get(name)
+			if oldentry is not None and newentry is not None and oldentry.id == newentry.id:
+				continue
+
+			entrypath = os.path.join(prefix, name)
+			if oldentry is None:
+				yield entrypath, True
+			elif newentry is None:
+				yield entrypath, False
+
+			oldsubtree = self[oldentry.id] if oldentry is not None else None
+			newsubtree = self[newentry.id] if newentry is not None else None
+			for change in self.iter_tree_directory_changes(oldsubtree, newsubtree, entrypath):
+				yield change
+
+	# Returns the directory origin index, updated to include currentcommit, or None if it is disabled
+	def get_tree_origin_index(self, currentcommit):
+		if not self.usetreeindex:
+			return None
+
+		try:
+			if self.treeoriginindex is None:
+				self.treeoriginindex = MetadataTreeOriginIndex(self.get_cache_path("treeorigins.sqlite"))
+			with self.stats.phase("directory origin index"):
+				self.treeoriginindex.update(self, currentcommit)
+		except sqlite3.Error, e:
+			self.debugmsg("Directory origin index unavailable: %s" % e)
+			return None
+
+		return self.treeoriginindex
+
+	# Finds the commit where the tree at treepath in currentcommit was added, using the directory
+	# origin index if possible, otherwise walking back through the parents. Either way a merge
+	# reached first raises MetadataReadError.
+	def find_first_data_commit_with_tree(self, treepath, currentcommit):
+		treeoriginindex = self.get_tree_origin_index(currentcommit)
+		if treeoriginindex is not None:
+			origin = treeoriginindex.find_origin(self, os.path.normpath(treepath), currentcommit)
+			if origin is not None:
+				origincommitid, mergecommitid = origin
+				if origincommitid is None:
+					raise MetadataReadError("Merges not supported")
+				return self[origincommitid]
+
+		return self.find_first_data_commit_with_tree_unindexed(treepath, currentcommit)
+
+	# Returns the most recent commit between the one where the directory at treepath appeared and
+	# currentcommit which has metadata for it, or None. As when walking back through the history,
+	# metadata doesn't propagate across merges: if the walk would reach a merge without metadata
+	# first, MetadataReadError is raised.
+	def find_data_commit_with_directory_metadata(self, treepath, streamname, currentcommit):
+		origin = self.treeoriginindex.find_origin(self, os.path.normpath(treepath), currentcommit)
+		if origin is None:
+			stopcommit, stopatmerge = self.find_first_data_commit_with_tree_unindexed(treepath, currentcommit), False
+		else:
+			origincommitid, mergecommitid = origin
+			stopcommit, stopatmerge = self[origincommitid or mergecommitid], origincommitid is None
+
+		try:
+			metadatastream = self.get_metadata_stream(treepath, streamname)
+		except (MetadataBlobNotFoundError, NoMetadataBranchError):
+			metadatastream = []
+
+		# There are no merges after stopcommit, so its descendants in the history of currentcommit
+		# are on one first-parent history and their positions can be compared
+		bestposition, bestcommit = None, None
+		for metadataentry in metadatastream:
+			datacommit = self.get(metadataentry.name)
+			if not isinstance(datacommit, pygit2.Commit):
+				continue
+			if datacommit.id != currentcommit.id and not self.descendant_of(currentcommit.id, datacommit.id):
+				continue
+			if datacommit.id != stopcommit.id and not self.descendant_of(datacommit.id, stopcommit.id):
+				continue
+
+			position = self.treeoriginindex.get_position(datacommit.id)
+			if bestposition is None or position > bestposition:
+				bestposition, bestcommit = position, datacommit
+
+		if bestcommit is None and stopatmerge:
+			raise MetadataReadError("Merges not supported")
+		return bestcommit
+
 	# Given a path, we compare the parent commit to the current commit to see if this was
 	# the commit where the tree was added. If not added at this commit, we call ourselves with the parent
 	# commit to check if the tree was added in the parent, and so on until there are no more parents.
 	# It is assumed that the tree is in the current commit when first called, otherwise this would have to be
 	# checked with a revparse_single for each call which would slow down the routine
-	def find_first_data_commit_with_tree(self, treepath, currentcommit):
+	def find_first_data_commit_with_tree_unindexed(self, treepath, currentcommit):
+		self.stats.record("commitswalked")
 
 		if len(currentcommit.parents) > 1:
 			raise MetadataReadError("Merges not supported")
@@ -781,7 +3540,7 @@ class MetadataRepository(pygit2.Repository):
 					return currentcommit
 				else:
 					# Try next one
-					return self.find_first_data_commit_with_tree(treepath, parentcommit)
+					return self.find_first_data_commit_with_tree_unindexed(treepath, parentcommit)
 			except KeyError:
 				# Tree could not be found in the parent, so current commit is the first to contain this tree
 				return currentcommit
@@ -793,8 +3552,7 @@ class MetadataRepository(pygit2.Repository):
 	# when first called otherwise this would have to be checked with a revparse_single for each call
 	# which would slow down the routine.
 	def find_first_data_commit_with_blob(self, dataobject, currentcommit):
-		currenttree = currentcommit.tree
-
+		self.stats.record("commitswalked")
 		self.debugmsg("looking for %s in %s" % (dataobject.id, currentcommit.id))
 
 		if len(currentcommit.parents) > 1:
@@ -802,11 +3560,11 @@ class MetadataRepository(pygit2.Repository):
 		elif len(currentcommit.parents) == 1:
 			# Compare against the commit's parent
 			parentcommit = currentcommit.parents[0]
-			diff = currenttree.diff_to_tree(parentcommit.tree, swap=True)
 		else:
 			# No parent commit to compare against so we will see what has been added in the first commit
 			parentcommit = None
-			diff = currenttree.diff_to_tree(swap=True)
+
+		diff = self.diff_commit_to_parent(currentcommit, parentcommit)
 
 		# Check each change in the diff to see if we can find where our object was added
 		for patch in diff:
@@ -825,6 +3583,7 @@ class MetadataRepository(pygit2.Repository):
 	# It is assumed that the data object was is in the current commit when first called.
 	def find_first_data_commit_with_metadata_for_blob(self, dataobject, currentcommit, path, returncommitwhennometadata=True):
 		# check metadata exists in current commit. if metadata exists, return current commit, else recurse
+		self.stats.record("commitswalked")
 
 		if not isinstance(path, MetadataPath):
 			raise ParameterError("Passed path was not an instance of MetadataPath")
@@ -839,36 +3598,35 @@ class MetadataRepository(pygit2.Repository):
 			raise ParameterError("Data object does not exist at commit specified")
 
 		# We assume the object exists, check if it has metadata
-		try:
-			# Try to get the metadata
-			metadatablobpath = self.get_metadata_blob_path(path.metadatapath, path.streamname, currentcommit.id.__str__())
+		metadatablobpath = self.get_metadata_blob_path(path.metadatapath, path.streamname, currentcommit.id.__str__())
 
-			# Find metadata branch
-			metadatacommit = self.get_metadata_commit(self.metadataref)
-
-			# Find metadata blob
-			metadatablob = self.revparse_single("%s:%s" % (metadatacommit.id, metadatablobpath))
-			if not isinstance(metadatablob, pygit2.Blob):
-				raise MetadataBlobNotFoundError("Something wrong with the metadata at " + metadatablobpath)
-			else:
-				# Found it, return this commit
-				return currentcommit
+		# Find metadata blob, including any pending buffered writes
+		if not self.metadata_definitely_absent(path.metadatapath, path.streamname, currentcommit.id.__str__()) \
+			and self.lookup_metadata_blob(metadatablobpath) is not None:
+			# Found it, return this commit
+			return currentcommit
 
 		# Metadata was not added at this commit so look in parents...
-		except (KeyError, NoMetadataBranchError):
+		else:
 
 			if path.datarevsearchmethod == DataRevisionMetadataSearchMethod.UseRevisionSpecifiedOnly:
 				return currentcommit if returncommitwhennometadata else None
+
+			# A directory's metadata can only be on the commits since it appeared, so look those up
+			# in its metadata stream rather than walking back through the history
+			if isinstance(dataobject, pygit2.Tree) and (self.writebuffer is None or len(self.writebuffer) == 0) \
+				and self.get_tree_origin_index(currentcommit) is not None:
+				return self.find_data_commit_with_directory_metadata(path.metadatapath, path.streamname, currentcommit)
 			if len(currentcommit.parents) > 1:
 				raise MetadataReadError("Merges not supported")
 			elif len(currentcommit.parents) == 1:
 				# Compare against the commit's parent
 				parentcommit = currentcommit.parents[0]
-				diff = currentcommit.tree.diff_to_tree(parentcommit.tree, swap=True)
 			else:
 				# No parent commit to compare against so we will see what has been added in the first commit
 				parentcommit = None
-				diff = currentcommit.tree.diff_to_tree(swap=True)
+
+			diff = self.diff_commit_to_parent(currentcommit, parentcommit)
 
 			# Check each change in the diff to see if we can find where our object was added
 			for patch in diff:
@@ -906,12 +3664,12 @@ class MetadataRepository(pygit2.Repository):
 				# Without a data revision, we can only lookup a blob in the repository
 				fullpath = os.path.join(self.workdir, path)
 				dataitem = self.find_fs_blob_in_repository(fullpath)
-				print "* Blob specified has ID of %s" % dataitem.id
+				MetadataRepository.errormsg("* Blob specified has ID of %s" % dataitem.id)
 				return dataitem
 			except DataBlobNotFoundError:
 				if os.path.isdir(normpath):
 					# Path is a directory so can't return a repository item
-					print "* Looking for directory %s" % normpath
+					MetadataRepository.errormsg("* Looking for directory %s" % normpath)
 					return None
 				else:
 					# Path doesn't exist at all
@@ -923,10 +3681,10 @@ class MetadataRepository(pygit2.Repository):
 
 				# Check what the item is (file or directory)
 				if isinstance(dataitem, pygit2.Blob):
-					print "* Looking for metadata for blob %s" % dataitem.id
+					MetadataRepository.errormsg("* Looking for metadata for blob %s" % dataitem.id)
 					return dataitem
 				elif isinstance(dataitem, pygit2.Tree):
-					print "* Looking for metadata for directory '%s' " % normpath
+					MetadataRepository.errormsg("* Looking for metadata for directory '%s' " % normpath)
 					return dataitem
 				else:
 					MetadataRepository.errormsg("Data requested does not exist")
@@ -937,15 +3695,15 @@ class MetadataRepository(pygit2.Repository):
 				return None
 
 	def get_metadata_tree(self, metadatatreepath, metadataref=None):
-		# Find metadata branch
+		# Find metadata branch, combining the layers unless we have been asked for a particular one
 		if metadataref is None:
-			metadataref = self.metadataref
-
-		metaadatacommit = self.get_metadata_commit(metadataref)
+			metadataroottree = self.get_metadata_read_tree()
+		else:
+			metadataroottree = self.get_metadata_commit(metadataref).tree
 
 		# Retrieve metadata node
 		try:
-			metadatatree = self.revparse_single("%s:%s" % (metaadatacommit.id, metadatatreepath))
+			metadatatree = self.revparse_single("%s:%s" % (metadataroottree.id, metadatatreepath))
 			if not isinstance(metadatatree, pygit2.Tree):
 				raise MetadataBlobNotFoundError("Could not find metadata tree")
 			else:
@@ -967,9 +3725,23 @@ class MetadataRepository(pygit2.Repository):
 		metadatastream = self.get_metadata_tree(metadatastreampath, metadataref=metadataref)
 		return metadatastream
 
+	# Returns (data commit, blob ID) for each version of the metadata for path in a stream. The
+	# replica is used if enabled, otherwise the stream's tree is read.
+	def get_metadata_stream_entries(self, path, streamname):
+		replica = self.get_replica()
+		if replica is not None:
+			# Split the stream's path the same way as lookup_metadata_blob_id, so paths match the replica's
+			parsedpath = self.parse_metadata_blob_path(self.get_metadata_blob_path(path, streamname, ""))
+			entries = replica.stream_entries(self.metadataref, parsedpath[0], parsedpath[1])
+			if len(entries) == 0:
+				raise MetadataBlobNotFoundError("Could not find metadata tree")
+			return [(datacommitid.encode("ascii"), blobid.encode("ascii")) for datacommitid, blobid in entries]
+
+		return [(entry.name, entry.id.__str__()) for entry in self.get_metadata_stream(path, streamname)]
+
 	def find_fs_blob_in_repository(self, path):
 		if os.path.isfile(path):
-			requestedblobid = pygit2.hashfile(path)  # Find the ID of the file so we can check if it's in repository
+			requestedblobid = self.hash_worktree_file(path)  # Find the ID of the file so we can check if it's in repository
 			if requestedblobid in self:            # Check if the file is in the repository
 				dataitem = self[requestedblobid]     # We found the file so return it
 				return dataitem
@@ -977,3 +3749,114 @@ class MetadataRepository(pygit2.Repository):
 		# If we reach here, it is a directory or it was not found on the file system
 		raise DataBlobNotFoundError("Could not find data blob in repository")
 
+
+class MetadataRepositoryPool:
+
+	# Hands out MetadataRepository handles to threads. A MetadataRepository can't be shared between
+	# threads (its SQLite caches belong to the thread that opened them, and reads and writes share
+	# mutable state), so each thread reads through its own handle while the caches keyed by
+	# immutable IDs are shared between all of them. Writes are queued and carried out one at a
+	# time by a single writer thread with its own handle. The options are passed to each
+	# MetadataRepository; don't pass stats as MetadataRepositoryStats isn't thread-safe.
+	#
+	# The parsed documents, combined layer trees and deserialised Bloom filters are shared in
+	# memory. The SQLite indexes (tree origins, blob paths, times, the replica and the layers)
+	# are shared through their files in the git directory, with a connection for each handle,
+	# and commits one handle has indexed aren't indexed again by the others. Indexes which fall
+	# back to memory because the git directory isn't writable aren't shared. Git object lookups
+	# aren't shared either, as a pygit2 repository can't be used from more than one thread.
+	def __init__(self, repo_path, **options):
+		self.repo_path = repo_path
+		self.options = options
+		self.handles = threading.local()
+
+		# Caches shared by every handle
+		self.documentcache = MetadataDocumentCache()
+		self.layercache = {}
+		self.bloomfiltercache = {}
+
+		# The writer thread is started by the first write
+		self.writequeue = Queue.Queue()
+		self.writerthread = None
+		self.writerlock = threading.Lock()
+
+	def open_handle(self):
+		handle = MetadataRepository(self.repo_path, **self.options)
+		handle.documentcache = self.documentcache
+		handle.layercache = self.layercache
+		handle.bloomfiltercache = self.bloomfiltercache
+		return handle
+
+	def debugmsg(self, msg):
+		if self.options.get("debug"):
+			MetadataRepository.errormsg(msg)
+
+	# Returns the calling thread's handle, opening it on first use. The handle lasts as long as
+	# the thread, so use long-lived worker threads rather than a thread for each request.
+	def reader(self):
+		handle = getattr(self.handles, "repo", None)
+		if handle is None:
+			handle = self.open_handle()
+			self.handles.repo = handle
+		return handle
+
+	# Calls function(repo, *args, **kwargs) on the writer thread and returns its result,
+	# raising any exception in the calling thread
+	def write(self, function, *args, **kwargs):
+		with self.writerlock:
+			if self.writerthread is None:
+				self.writerthread = threading.Thread(target=self.run_writer, name="metagit-writer")
+				self.writerthread.daemon = True
+				self.writerthread.start()
+
+		done = threading.Event()
+		result = {}
+		self.writequeue.put((function, args, kwargs, done, result))
+		done.wait()
+
+		if "exc_info" in result:
+			exc_type, exc_value, tb = result["exc_info"]
+			raise exc_type, exc_value, tb
+		return result["value"]
+
+	def run_writer(self):
+		handle = self.open_handle()
+		while True:
+			request = self.writequeue.get()
+			if request is None:
+				break
+
+			function, args, kwargs, done, result = request
+			try:
+				result["value"] = function(handle, *args, **kwargs)
+				handle.flush()
+			except Exception:
+				result["exc_info"] = sys.exc_info()
+			done.set()
+
+	# Waits for queued writes to finish and stops the writer thread
+	def close(self):
+		with self.writerlock:
+			if self.writerthread is not None:
+				self.writequeue.put(None)
+				self.writerthread.join()
+				self.writerthread = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+
+# Each fsck worker process opens the repository once
+fsckrepo = None
+
+
+def fsck_worker_init(repopath, metadataref):
+	global fsckrepo
+	fsckrepo = MetadataRepository(repopath, metadataref=metadataref, statcache=False)
+
+
+def fsck_worker_check(checkjob):
+	return fsckrepo.check_metadata_subtree(*checkjob)
@@ -0,0 +1,205 @@
+# Copyright 2016 University of Southampton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import zipfile
+import StringIO
+
+# NumPy and pyarrow are only needed for the format that uses them
+try:
+	import numpy
+	import numpy.lib.format
+except ImportError:
+	numpy = None
+
+try:
+	import pyarrow
+except ImportError:
+	pyarrow = None
+
+
+# Column-oriented output of the metadata written by 'm export --columnar'. There is a row for
+# each metadata blob, with path, stream and datacommit columns and a column for each top level
+# key of the JSON documents. Rows are written in row groups so only one group is held in memory.
+#
+#   npz    A NumPy .npz archive with an array for each column of each row group, named
+#          "rowgroup<n>/<column>". Key columns also have a "rowgroup<n>/<column>.valid" array
+#          which is False for the rows which don't have the key. Column names are unique, see
+#          MetadataColumnSchema.key_columns().
+#   arrow  An Arrow IPC file with a record batch for each row group. Missing keys are nulls.
+
+class MetadataExportError(Exception):
+	"""Output format can't be written"""
+	pass
+
+
+class MetadataColumnSchema:
+	fixed_columns = ["path", "stream", "datacommit"]
+	int64_range = (-2 ** 63, 2 ** 63 - 1)
+
+	# Works out a single type for each key from every document, so every row group has the same
+	# columns. Keys with values of different types become string columns, except that integers
+	# and floats become float columns. Objects and arrays are stored as JSON strings.
+	def __init__(self):
+		self.types = {}
+
+	@staticmethod
+	def value_type(value):
+		if value is None:
+			return None
+		elif isinstance(value, bool):
+			return "bool"
+		elif isinstance(value, (int, long)):
+			if MetadataColumnSchema.int64_range[0] <= value <= MetadataColumnSchema.int64_range[1]:
+				return "int"
+			return "string"
+		elif isinstance(value, float):
+			return "float"
+		else:
+			return "string"
+
+	@staticmethod
+	def combine_types(type1, type2):
+		if type1 is None or type1 == type2:
+			return type2
+		elif type2 is None:
+			return type1
+		elif set([type1, type2]) == set(["int", "float"]):
+			return "float"
+		else:
+			return "string"
+
+	def add_document(self, document):
+		if not isinstance(document, dict):
+			return
+		for key, value in document.iteritems():
+			self.types[key] = MetadataColumnSchema.combine_types(self.types.get(key), MetadataColumnSchema.value_type(value))
+
+	# Returns (column name, key, type) for each key column. Keys with the same name as a fixed
+	# column are renamed to "metadata.<key>". Names are unique, including against the ".valid"
+	# arrays of the npz format, so a key which would clash with another column is given a "_<n>"
+	# suffix. Keys renamed for a fixed column are named last, so a key which is actually called
+	# "metadata.<key>" keeps its name.
+	def key_columns(self):
+		used = set(MetadataColumnSchema.fixed_columns)
+		validnames = set()
+		names = {}
+		renamed = [key for key in sorted(self.types) if key in MetadataColumnSchema.fixed_columns]
+		for key in [key for key in sorted(self.types) if key not in MetadataColumnSchema.fixed_columns] + renamed:
+			basename = "metadata.%s" % key if key in MetadataColumnSchema.fixed_columns else key
+			name = basename
+			suffix = 1
+			while name in used or name in validnames or "%s.valid" % name in used:
+				name = "%s_%d" % (basename, suffix)
+				suffix += 1
+			used.add(name)
+			validnames.add("%s.valid" % name)
+			names[key] = name
+
+		return [(names[key], key, self.types[key] or "string") for key in sorted(self.types)]
+
+	@staticmethod
+	def convert(value, columntype):
+		if columntype == "string":
+			return value if isinstance(value, basestring) else json.dumps(value, sort_keys=True)
+		elif columntype == "float":
+			return float(value)
+		return value
+
+	# Returns (column name, type, values) for every column of rows, which are
+	# (path, stream, data commit ID, document). Missing keys are None.
+	def columns(self, rows):
+		columns = [
+			("path", "string", [path.decode("utf-8") for path, streamname, datacommitid, document in rows]),
+			("stream", "string", [streamname.decode("utf-8") for path, streamname, datacommitid, document in rows]),
+			("datacommit", "string", [datacommitid.decode("ascii") for path, streamname, datacommitid, document in rows])]
+
+		for name, key, columntype in self.key_columns():
+			values = []
+			for path, streamname, datacommitid, document in rows:
+				value = document.get(key) if isinstance(document, dict) else None
+				values.append(None if value is None else MetadataColumnSchema.convert(value, columntype))
+			columns.append((name, columntype, values))
+
+		return columns
+
+
+class MetadataNpzWriter:
+	dtypes = {"bool": "bool", "int": "int64", "float": "float64"}
+	fill_values = {"bool": False, "int": 0, "float": float("nan"), "string": u""}
+
+	def __init__(self, outfile, schema):
+		MetadataNpzWriter.check_dependencies()
+		self.schema = schema
+		self.zipfile = zipfile.ZipFile(outfile, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+		self.rowgroups = 0
+
+	@staticmethod
+	def check_dependencies():
+		if numpy is None:
+			raise MetadataExportError("NumPy is needed to write npz files")
+
+	def write_array(self, name, array):
+		data = StringIO.StringIO()
+		numpy.lib.format.write_array(data, array, allow_pickle=False)
+		self.zipfile.writestr("%s.npy" % name, data.getvalue())
+
+	def write_row_group(self, rows):
+		prefix = "rowgroup%05d" % self.rowgroups
+		for name, columntype, values in self.schema.columns(rows):
+			if name in MetadataColumnSchema.fixed_columns:
+				self.write_array("%s/%s" % (prefix, name), numpy.array(values, dtype="unicode"))
+				continue
+
+			fillvalue = MetadataNpzWriter.fill_values[columntype]
+			filled = [fillvalue if value is None else value for value in values]
+			dtype = MetadataNpzWriter.dtypes.get(columntype, "unicode")
+			self.write_array("%s/%s" % (prefix, name), numpy.array(filled, dtype=dtype))
+			self.write_array("%s/%s.valid" % (prefix, name), numpy.array([value is not None for value in values], dtype="bool"))
+
+		self.rowgroups += 1
+
+	def close(self):
+		self.zipfile.close()
+
+
+class MetadataArrowWriter:
+
+	def __init__(self, outfile, schema):
+		MetadataArrowWriter.check_dependencies()
+		self.schema = schema
+
+		types = {"bool": pyarrow.bool_(), "int": pyarrow.int64(), "float": pyarrow.float64(), "string": pyarrow.string()}
+		fields = [pyarrow.field(name, pyarrow.string(), nullable=False) for name in MetadataColumnSchema.fixed_columns]
+		fields += [pyarrow.field(name, types[columntype]) for name, key, columntype in schema.key_columns()]
+		self.arrowschema = pyarrow.schema(fields)
+
+		self.writer = pyarrow.RecordBatchFileWriter(outfile, self.arrowschema)
+		self.rowgroups = 0
+
+	@staticmethod
+	def check_dependencies():
+		if pyarrow is None:
+			raise MetadataExportError("pyarrow is needed to write Arrow files")
+
+	def write_row_group(self, rows):
+		arrays = [pyarrow.array(values, type=field.type) for (name, columntype, values), field in zip(self.schema.columns(rows), self.arrowschema)]
+		self.writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=self.arrowschema))
+		self.rowgroups += 1
+
+	def close(self):
+		self.writer.close()
+
+
+columnar_writers = {"npz": MetadataNpzWriter, "arrow": MetadataArrowWriter}
@@ -0,0 +1,182 @@
+# Copyright 2016 University of Southampton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import urllib
+import urlparse
+import Queue
+import threading
+import traceback
+import BaseHTTPServer
+from metagit import *
+
+
+# Serves metadata over HTTP. Requests are handled by a fixed set of worker threads, each reading
+# through its own handle from a MetadataRepositoryPool, so the handles and their caches stay
+# open between requests.
+#
+#   GET /<datarev>/<path>?stream=<stream>
+#       The metadata which applies to path at datarev. The ETag is made from the metadata blob
+#       ID and the data commit the metadata was attached to, so a matching If-None-Match is
+#       answered with 304 Not Modified without reading the blob.
+#   GET /_ls/<subdir>?stream=<stream>&depth=<depth>
+#       A JSON list of the paths with metadata, as 'm ls --json' prints them. The ETag is the
+#       ID of the metadata tree.
+
+class MetadataHTTPServer(BaseHTTPServer.HTTPServer):
+	threads_default = 4
+
+	def __init__(self, address, pool, threads=threads_default):
+		BaseHTTPServer.HTTPServer.__init__(self, address, MetadataHTTPRequestHandler)
+		self.pool = pool
+
+		self.requests = Queue.Queue()
+		self.workers = []
+		for i in range(threads):
+			worker = threading.Thread(target=self.run_worker, name="metagit-http-%d" % i)
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	# Hands the request to the next free worker rather than handling it on the listening thread
+	def process_request(self, request, client_address):
+		self.requests.put((request, client_address))
+
+	def run_worker(self):
+		while True:
+			queued = self.requests.get()
+			if queued is None:
+				break
+
+			request, client_address = queued
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+	def server_close(self):
+		BaseHTTPServer.HTTPServer.server_close(self)
+		for worker in self.workers:
+			self.requests.put(None)
+		for worker in self.workers:
+			worker.join()
+
+
+class MetadataHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	listing_prefix = "_ls"
+
+	# Errors which mean the request can't be answered, rather than that something went wrong
+	not_found_errors = (MetadataBlobNotFoundError, NoMetadataBranchError, NoDataError, DataBlobNotFoundError)
+	bad_request_errors = (ParameterError, MetadataReadError)
+
+	def do_GET(self):
+		repo = self.server.pool.reader()
+		url = urlparse.urlparse(self.path)
+		query = urlparse.parse_qs(url.query)
+		components = [urllib.unquote(component) for component in url.path.split("/") if component != ""]
+
+		# The ETag and the body of a response come from the same metadata commit
+		try:
+			with repo.pin_metadata():
+				if len(components) > 0 and components[0] == MetadataHTTPRequestHandler.listing_prefix:
+					self.send_listing(repo, os.sep.join(components[1:]), query)
+				elif len(components) >= 2:
+					self.send_metadata(repo, components[0], os.sep.join(components[1:]), query)
+				else:
+					self.send_error(404, "Use /<datarev>/<path> or /%s/<subdir>" % MetadataHTTPRequestHandler.listing_prefix)
+		except MetadataHTTPRequestHandler.not_found_errors, e:
+			self.send_error(404, str(e))
+		except MetadataHTTPRequestHandler.bad_request_errors, e:
+			self.send_error(400, str(e))
+		except Exception:
+			# Anything else is a fault on our side, but the client still gets an answer
+			self.log_error("Error answering '%s':\n%s", self.path, traceback.format_exc())
+			self.send_error(500)
+
+	def send_metadata(self, repo, datarev, path, query):
+		streamname = query.get("stream", [MetadataPath.stream_default])[0]
+		pathreq = "s+%s:%s:%s" % (datarev, os.path.join(repo.workdir, path), streamname)
+
+		try:
+			datacommitid, blobid = repo.resolve_metadata_blob_id(pathreq)
+		except KeyError:
+			# The data path isn't in datarev
+			raise DataBlobNotFoundError("Could not find '%s' in '%s'" % (path, datarev))
+		etag = '"%s-%s"' % (blobid, datacommitid)
+		if self.etag_matches(etag):
+			self.send_not_modified(etag)
+			return
+
+		data = repo[blobid].data
+		try:
+			json.loads(data)
+			contenttype = "application/json"
+		except ValueError:
+			contenttype = "application/octet-stream"
+
+		self.send_body(data, contenttype, etag, {"X-Metagit-Data-Commit": datacommitid})
+
+	def send_listing(self, repo, subdir, query):
+		streamname = query.get("stream", [None])[0]
+		try:
+			maxdepth = int(query["depth"][0]) if "depth" in query else None
+		except ValueError:
+			raise ParameterError("depth must be a whole number")
+
+		metadatatree = repo.get_metadata_read_tree()
+		etag = '"%s"' % metadatatree.id
+		if self.etag_matches(etag):
+			self.send_not_modified(etag)
+			return
+
+		tree = metadatatree
+		if subdir != "":
+			try:
+				tree = repo[metadatatree[subdir].id]
+			except KeyError:
+				raise MetadataBlobNotFoundError("Could not find '%s' in the metadata tree" % subdir)
+
+		listing = []
+		for treepath, depth, streams in repo.iter_metadata_objects(tree, subdir=subdir, maxdepth=maxdepth, streamname=streamname):
+			if len(streams) > 0:
+				listing.append({"path": treepath, "depth": depth, "streams": streams})
+
+		self.send_body(json.dumps(listing), "application/json", etag)
+
+	def etag_matches(self, etag):
+		ifnonematch = self.headers.getheader("If-None-Match")
+		if ifnonematch is None:
+			return False
+		return ifnonematch.strip() == "*" or etag in [candidate.strip() for candidate in ifnonematch.split(",")]
+
+	def send_not_modified(self, etag):
+		self.send_response(304)
+		self.send_header("ETag", etag)
+		self.end_headers()
+
+	def send_body(self, body, contenttype, etag, headers=None):
+		self.send_response(200)
+		self.send_header("Content-Type", contenttype)
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("ETag", etag)
+		for header, value in (headers or {}).items():
+			self.send_header(header, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		self.server.pool.debugmsg("%s - %s" % (self.address_string(), format % args))
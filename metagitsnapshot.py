@@ -0,0 +1,169 @@
+# Copyright 2016 University of Southampton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import struct
+import binascii
+
+
+# Read-only snapshots of the metadata resolved for every path at one data commit, written by
+# 'm snapshot'. Viewers can open a snapshot with MetadataSnapshotFile and look up any path in
+# O(log n) without libgit2 or pygit2, which is why this module only uses the standard library.
+#
+# File layout (all integers big-endian):
+#   header   magic "MGSN", version, entry count, data commit ID, metadata tree ID,
+#            then the offsets of the key, index and data regions
+#   keys     "<path>\0<stream>" for each entry, in index order
+#   index    one fixed size record per entry, sorted by key: key offset and length, state,
+#            data commit with the metadata, metadata blob ID, and data offset and length
+#   data     the metadata, stored once for each distinct blob
+
+class MetadataSnapshotFormatError(Exception):
+	"""File is not a metagit snapshot"""
+	pass
+
+
+class MetadataSnapshotEntry:
+
+	def __init__(self, path, streamname, state, datacommitid, blobid, data):
+		self.path = path
+		self.streamname = streamname
+		self.state = state                # "applies" or "inherited"
+		self.datacommitid = datacommitid  # Data commit the metadata was attached to
+		self.blobid = blobid              # Metadata blob ID
+		self.data = data
+
+	def as_dict(self):
+		return {
+			"path": self.path,
+			"stream": self.streamname,
+			"state": self.state,
+			"datacommit": self.datacommitid,
+			"blobid": self.blobid}
+
+
+class MetadataSnapshotFile:
+	magic = "MGSN"
+	version = 1
+	header = struct.Struct(">4sII40s40sQQQ")
+	record = struct.Struct(">QHB20s20sQI")
+	states = ["applies", "inherited"]
+
+	def __init__(self, filename):
+		self.file = open(filename, "rb")
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if len(self.map) < MetadataSnapshotFile.header.size:
+			raise MetadataSnapshotFormatError("Not a metagit snapshot")
+		magic, version, self.count, self.datacommitid, self.metadatatreeid, self.keysoffset, self.indexoffset, self.dataoffset = MetadataSnapshotFile.header.unpack_from(self.map, 0)
+		if magic != MetadataSnapshotFile.magic or version != MetadataSnapshotFile.version:
+			raise MetadataSnapshotFormatError("Not a metagit snapshot")
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def __len__(self):
+		return self.count
+
+	# Writes a snapshot of entries, a list of (path, stream, state, data commit ID, blob ID),
+	# where readblob returns the metadata for a blob ID
+	@staticmethod
+	def write(outfile, datacommitid, metadatatreeid, entries, readblob):
+		entries = sorted(entries, key=lambda entry: MetadataSnapshotFile.make_key(entry[0], entry[1]))
+
+		keys = [MetadataSnapshotFile.make_key(path, streamname) for path, streamname, state, datacommitid, blobid in entries]
+		keysoffset = MetadataSnapshotFile.header.size
+		indexoffset = keysoffset + sum(len(key) for key in keys)
+		dataoffset = indexoffset + len(entries) * MetadataSnapshotFile.record.size
+
+		outfile.write(MetadataSnapshotFile.header.pack(MetadataSnapshotFile.magic, MetadataSnapshotFile.version, len(entries), datacommitid, metadatatreeid, keysoffset, indexoffset, dataoffset))
+		for key in keys:
+			outfile.write(key)
+
+		# Lay out the data for each distinct blob before writing the index which points at it
+		blobs = []
+		bloboffsets = {}
+		position = dataoffset
+		for path, streamname, state, entrycommitid, blobid in entries:
+			if blobid not in bloboffsets:
+				data = readblob(blobid)
+				bloboffsets[blobid] = (position, len(data))
+				blobs.append(data)
+				position += len(data)
+
+		keyposition = keysoffset
+		for key, (path, streamname, state, entrycommitid, blobid) in zip(keys, entries):
+			blobposition, bloblength = bloboffsets[blobid]
+			outfile.write(MetadataSnapshotFile.record.pack(keyposition, len(key), MetadataSnapshotFile.states.index(state), binascii.unhexlify(entrycommitid), binascii.unhexlify(blobid), blobposition, bloblength))
+			keyposition += len(key)
+
+		for data in blobs:
+			outfile.write(data)
+
+	@staticmethod
+	def make_key(path, streamname):
+		return "%s\0%s" % (os.path.normpath(path).strip(os.sep), streamname)
+
+	def read_record(self, position):
+		return MetadataSnapshotFile.record.unpack_from(self.map, self.indexoffset + position * MetadataSnapshotFile.record.size)
+
+	def read_key(self, position):
+		keyoffset, keylength = self.read_record(position)[0:2]
+		return self.map[keyoffset:keyoffset + keylength]
+
+	def read_entry(self, position):
+		keyoffset, keylength, state, datacommitid, blobid, dataoffset, datalength = self.read_record(position)
+		path, sep, streamname = self.map[keyoffset:keyoffset + keylength].partition("\0")
+		return MetadataSnapshotEntry(path, streamname, MetadataSnapshotFile.states[state], binascii.hexlify(datacommitid), binascii.hexlify(blobid), self.map[dataoffset:dataoffset + datalength])
+
+	# Returns the position of the first key which is not less than key
+	def bisect(self, key):
+		low, high = 0, self.count
+		while low < high:
+			middle = (low + high) // 2
+			if self.read_key(middle) < key:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	# Returns the MetadataSnapshotEntry for path in a stream, or None if it has no metadata
+	def lookup(self, path, streamname="metadata"):
+		key = MetadataSnapshotFile.make_key(path, streamname)
+		position = self.bisect(key)
+		if position < self.count and self.read_key(position) == key:
+			return self.read_entry(position)
+		return None
+
+	# Returns the entries for path in every stream
+	def lookup_streams(self, path):
+		prefix = MetadataSnapshotFile.make_key(path, "")
+		entries = []
+		position = self.bisect(prefix)
+		while position < self.count and self.read_key(position).startswith(prefix):
+			entries.append(self.read_entry(position))
+			position += 1
+		return entries
+
+	def __iter__(self):
+		for position in range(self.count):
+			yield self.read_entry(position)